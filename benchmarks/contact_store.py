@@ -0,0 +1,107 @@
+"""
+memory of the contact layout, two unslotted objects per contact (the former layout) vs ContactStore,
+loaded as by the client: members through set_chatroom_members with the reverse membership index,
+then once more after a text message with an @ built the mention index of every chatroom
+
+usage: python -m benchmarks.contact_store [friends] [chatrooms] [members_per_chatroom]
+"""
+import sys
+import tracemalloc
+
+from webwx.contacts import ContactStore
+from webwx.models import ChatroomMember
+from webwx.utils import replace_emoji_in_name
+
+
+class LegacyContact:
+    def __init__(self, user_dict):
+        self.username = user_dict['UserName']
+        self.head_img_url = user_dict['HeadImgUrl']
+        self.nickname = replace_emoji_in_name(user_dict['NickName'])
+        self.remark_name = replace_emoji_in_name(user_dict['RemarkName'])
+        self.sex = user_dict['Sex']
+
+
+class LegacyChatRoom(LegacyContact):
+    def __init__(self, user_dict):
+        super().__init__(user_dict)
+        self.member_list = {}
+
+
+class LegacyChatroomMember:
+    def __init__(self, user_dict):
+        self.username = user_dict['UserName']
+        self.nickname = replace_emoji_in_name(user_dict['NickName'])
+        self.display_name = replace_emoji_in_name(user_dict['DisplayName'])
+
+
+def gen_contacts_json(friend_count, chatroom_count, member_count):
+    contacts_json = []
+    for i in range(friend_count):
+        contacts_json.append({'UserName': f'@{i:064x}', 'HeadImgUrl': f'/cgi-bin/mmwebwx-bin/webwxgeticon?u={i}',
+                              'NickName': f'nickname{i}', 'RemarkName': f'remark{i}', 'Sex': i % 3,
+                              'VerifyFlag': 0})
+    for i in range(chatroom_count):
+        members = [{'UserName': f'@{i * member_count + j:064x}', 'NickName': f'member{j}',
+                    'DisplayName': f'display{j}'} for j in range(member_count)]
+        contacts_json.append({'UserName': f'@@{i:064x}', 'HeadImgUrl': f'/cgi-bin/mmwebwx-bin/webwxgetheadimg?c={i}',
+                              'NickName': f'chatroom{i}', 'RemarkName': '', 'Sex': 0, 'VerifyFlag': 0,
+                              'MemberList': members})
+    return contacts_json
+
+
+def load_legacy(contacts_json):
+    contacts = {}
+    friends = {}
+    chatrooms = {}
+    for contact_json in contacts_json:
+        username = contact_json['UserName']
+        contacts[username] = LegacyContact(contact_json)
+        if username.startswith('@@'):
+            chatroom = chatrooms[username] = LegacyChatRoom(contact_json)
+            for member in contact_json['MemberList']:
+                chatroom.member_list[member['UserName']] = LegacyChatroomMember(member)
+        else:
+            friends[username] = LegacyContact(contact_json)
+    return contacts, friends, chatrooms
+
+
+def load_store(contacts_json):
+    store = ContactStore([])
+    for contact_json in contacts_json:
+        contact = store.upsert(contact_json)
+        if 'MemberList' in contact_json:
+            store.set_chatroom_members(contact, [ChatroomMember(member) for member in contact_json['MemberList']])
+    return store
+
+
+def load_store_mentioned(contacts_json):
+    store = load_store(contacts_json)
+    for chatroom in store.chatrooms.values():
+        chatroom.mention_index
+    return store
+
+
+def measure(name, load, contacts_json):
+    replace_emoji_in_name.cache_clear()
+    tracemalloc.start()
+    result = load(contacts_json)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<24} {current / 1024 / 1024:8.2f}MiB')
+    return result
+
+
+def main():
+    friend_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chatroom_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    member_count = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    contacts_json = gen_contacts_json(friend_count, chatroom_count, member_count)
+    print(f'{friend_count} friends, {chatroom_count} chatrooms with {member_count} members')
+    measure('two objects, no slots', load_legacy, contacts_json)
+    measure('ContactStore, slots', load_store, contacts_json)
+    measure('  + every mention index', load_store_mentioned, contacts_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+end-to-end ingest and send throughput of WebWxClient, or of CustomClient, against benchmarks.fake_server:
+messages/sec, p50/p99 latency from a message being queued by the server to the return of its handler,
+and memory
+
+usage: python -m benchmarks.e2e [--messages N] [--rate R] [--client webwx|custom] [--latency S] ...
+--client custom publishes to the redis and rabbitmq configured in config.py
+"""
+import argparse
+import os
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from benchmarks.fake_server import FakeWebWxServer
+from webwx.client import WebWxClient
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def _rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_client_class(base, server: FakeWebWxServer):
+    """
+    base with its message handlers timed, and without the login qrcode
+    """
+
+    class BenchClient(base):
+        # sends are measured, not throttled
+        send_rate = send_burst = recipient_send_rate = recipient_send_burst = 1e9
+
+        def __init__(self):
+            super().__init__()
+            server.attach(self)
+            # MsgId -> seconds from queued to handled
+            self.latencies = {}
+            self.handled = threading.Condition()
+
+        def _print_login_qrcode(self, uuid):
+            pass
+
+        def _record(self, msg):
+            now = time.perf_counter()
+            with self.handled:
+                self.latencies[msg.msg_id] = now - server.queued_at[msg.msg_id]
+                self.handled.notify_all()
+
+        def handle_text(self, msg):
+            super().handle_text(msg)
+            self._record(msg)
+
+        def handle_image(self, msg):
+            super().handle_image(msg)
+            self._record(msg)
+
+    return BenchClient
+
+
+def custom_client_class():
+    # imported on demand, CustomClient connects to redis and rabbitmq
+    from run import CustomClient
+    return CustomClient
+
+
+def report(name, latencies, seconds):
+    print(f'{name:<8} {len(latencies):>7} in {seconds:7.2f}s {len(latencies) / seconds:9.1f}/s  '
+          f'p50 {percentile(latencies, 0.5) * 1000:8.1f}ms  p99 {percentile(latencies, 0.99) * 1000:8.1f}ms')
+
+
+def ingest(client, server, messages, rate, timeout):
+    receiving = threading.Thread(target=client.start_receiving, name='receiving', daemon=True)
+    receiving.start()
+    start = time.perf_counter()
+    server.produce(messages, rate)
+    deadline = start + timeout
+    with client.handled:
+        while len(client.latencies) < messages and time.perf_counter() < deadline:
+            client.handled.wait(deadline - time.perf_counter())
+        latencies = list(client.latencies.values())
+    report('ingest', latencies, time.perf_counter() - start)
+    if len(latencies) < messages:
+        print(f'timeout: {messages - len(latencies)} messages not handled')
+
+
+def send(client, server, count, image_size):
+    """
+    count texts then count images, images are uploaded once and sent by cached MediaId afterwards
+    """
+    recipients = server.friends + server.chatrooms
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        sent_at = time.perf_counter()
+        client.webwxsendmsg(recipients[i % len(recipients)], f'bench {i}')
+        latencies.append(time.perf_counter() - sent_at)
+    report('text', latencies, time.perf_counter() - start)
+
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as f:
+        f.write(os.urandom(image_size))
+    try:
+        latencies = []
+        start = time.perf_counter()
+        for i in range(count):
+            sent_at = time.perf_counter()
+            client.webwxsendmsgimg(recipients[i % len(recipients)], f.name)
+            latencies.append(time.perf_counter() - sent_at)
+        report('image', latencies, time.perf_counter() - start)
+    finally:
+        os.unlink(f.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000, help='messages to ingest')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 queues all at once')
+    parser.add_argument('--sends', type=int, default=200, help='texts and images to send')
+    parser.add_argument('--friends', type=int, default=2000)
+    parser.add_argument('--chatrooms', type=int, default=100)
+    parser.add_argument('--members', type=int, default=200, help='per chatroom')
+    parser.add_argument('--images', type=float, default=0.1, help='share of images among the messages')
+    parser.add_argument('--image-size', type=int, default=64 * 1024, help='bytes')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--media-latency', type=float, default=None,
+                        help='seconds added to the image downloads instead')
+    parser.add_argument('--client', choices=('webwx', 'custom'), default='webwx')
+    parser.add_argument('--tracemalloc', action='store_true', help='peak of the python heap too, slower')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    latencies = {}
+    if args.media_latency is not None:
+        latencies['webwxgetmsgimg'] = args.media_latency
+    server = FakeWebWxServer(friends=args.friends, chatrooms=args.chatrooms, members=args.members,
+                             image_ratio=args.images, image_size=args.image_size, latency=args.latency,
+                             latencies=latencies).start()
+    base = custom_client_class() if args.client == 'custom' else WebWxClient
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = _rss_mib()
+
+    client = bench_client_class(base, server)()
+    start = time.perf_counter()
+    client.wait_for_login()
+    print(f'login    {len(client.contacts):>7} contacts in {time.perf_counter() - start:.2f}s')
+    ingest(client, server, args.messages, args.rate, args.timeout)
+    if args.sends:
+        send(client, server, args.sends, args.image_size)
+
+    print(f'requests {dict(server.requests.most_common())}')
+    print(f'max rss  {_rss_mib():.1f}MiB, {rss_before:.1f}MiB before login')
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f'python heap {current / 2 ** 20:.1f}MiB, peak {peak / 2 ** 20:.1f}MiB')
+    # the receiving loop and the worker pools never return
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
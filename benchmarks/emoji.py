@@ -0,0 +1,66 @@
+"""
+emoji unescaping of contact names and message bodies, original re.sub per call vs webwx.utils
+
+usage: python -m benchmarks.emoji
+"""
+import random
+import re
+import timeit
+
+from webwx import utils
+
+EMOJI_DICT = utils.emoji_dict()
+
+
+def replace_emoji_original(text):
+    def replace_func(match):
+        if match:
+            return EMOJI_DICT.get(match.group(1), '')
+
+    return re.sub(r'<span class="emoji emoji([a-zA-Z0-9]+)"></span>', replace_func, text)
+
+
+def gen_names(count, distinct):
+    random.seed(0)
+    codes = list(EMOJI_DICT)
+    names = []
+    for i in range(distinct):
+        name = f'user{i}'
+        # roughly one name out of five carries emoji
+        if i % 5 == 0:
+            name += ''.join(f'<span class="emoji emoji{random.choice(codes)}"></span>' for _ in range(2))
+        names.append(name)
+    # contact updates and chatroom members repeat the same names over and over
+    return [random.choice(names) for _ in range(count)]
+
+
+def gen_messages(count):
+    random.seed(1)
+    codes = list(EMOJI_DICT)
+    messages = []
+    for i in range(count):
+        text = '今天晚上一起吃饭吗？我在公司楼下等你' * random.randint(1, 5)
+        if i % 10 == 0:
+            text += f'<span class="emoji emoji{random.choice(codes)}"></span>'
+        messages.append(text)
+    return messages
+
+
+def bench(name, func, texts, number=5):
+    seconds = min(timeit.repeat(lambda: [func(text) for text in texts], number=1, repeat=number))
+    print(f'{name:<32} {seconds * 1000:8.2f}ms  {seconds / len(texts) * 1e9:8.0f}ns/text')
+
+
+def main():
+    names = gen_names(50000, 5000)
+    messages = gen_messages(50000)
+    assert [replace_emoji_original(n) for n in names] == [utils.replace_emoji_in_name(n) for n in names]
+    assert [replace_emoji_original(m) for m in messages] == [utils.replace_emoji(m) for m in messages]
+    bench('names: original', replace_emoji_original, names)
+    bench('names: replace_emoji_in_name', utils.replace_emoji_in_name, names)
+    bench('messages: original', replace_emoji_original, messages)
+    bench('messages: replace_emoji', utils.replace_emoji, messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""
+a local stand-in of the WebWx endpoints used by the client, for the end-to-end benchmarks
+
+Login succeeds at once, synccheck long-polls until messages are queued, webwxsync drains them.
+Messages are queued at a fixed rate, or all at once, from the friends and chatrooms of the account,
+the time each was queued is kept to measure the ingest latency.
+
+usage: python -m benchmarks.fake_server [port]
+serves until interrupted, see FakeWebWxServer.attach for the client attributes to point at it
+"""
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from typing import Dict
+from urllib.parse import parse_qs, urlsplit
+
+from webwx.utils import ThreadingHTTPServer
+
+# start of a JPEG, the rest of the fake images is random
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+
+
+def _contact_json(username, nickname, verify_flag=0, member_list=()):
+    return {
+        'UserName':    username,
+        'NickName':    nickname,
+        'RemarkName':  '',
+        'HeadImgUrl':  f'/cgi-bin/mmwebwx-bin/webwxgeticon?username={username}',
+        'Sex':         0 if username.startswith('@@') else 1,
+        'VerifyFlag':  verify_flag,
+        'DisplayName': '',
+        'MemberCount': len(member_list),
+        'MemberList':  list(member_list)
+    }
+
+
+class FakeWebWxServer:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, port=0, host='127.0.0.1', friends=500, chatrooms=50, members=100, image_ratio=0.1,
+                 image_size=64 * 1024, latency=0.0, latencies: Dict[str, float] = None, sync_batch_size=100,
+                 hold=1.0):
+        """
+        :param members: per chatroom, fetched by webwxbatchgetcontact on its first message
+        :param image_ratio: share of the queued messages that are images
+        :param image_size: bytes of a full image, thumbnails are a sixteenth
+        :param latency: seconds added to every response
+        :param latencies: endpoint -> seconds added to its responses instead, e.g. {'webwxgetmsgimg': 0.2}
+        :param sync_batch_size: max AddMsgList entries per webwxsync
+        :param hold: seconds synccheck waits for a message before answering selector 0
+        """
+        self.friend_count = friends
+        self.chatroom_count = chatrooms
+        self.member_count = members
+        self.image_ratio = image_ratio
+        self.image_size = image_size
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.sync_batch_size = sync_batch_size
+        self.hold = hold
+
+        self.user = _contact_json('@self', 'bench')
+        self.friends = [f'@friend{i}' for i in range(friends)]
+        self.chatrooms = [f'@@chatroom{i}' for i in range(chatrooms)]
+        self._image = JPEG_HEADER + os.urandom(max(0, image_size - len(JPEG_HEADER)))
+        self._thumbnail = self._image[:max(len(JPEG_HEADER), image_size // 16)]
+
+        self._queue = collections.deque()
+        self._queue_changed = threading.Condition()
+        self._sync_key = itertools.count(1)
+        # MsgIds differ between runs, for the SeenWindow backends kept across runs
+        self._msg_ids = itertools.count(int(time.time() * 1000) * 1000)
+        self._media_ids = itertools.count(1)
+        # MsgId -> perf_counter when it was queued
+        self.queued_at: Dict[str, float] = {}
+        # endpoint -> requests served
+        self.requests = collections.Counter()
+
+        self._routes = {
+            'jslogin':               self._jslogin,
+            'login':                 self._login,
+            'webwxnewloginpage':     self._webwxnewloginpage,
+            'webwxpushloginurl':     lambda query, body: self._json({'ret': 0, 'uuid': 'fakeuuid'}),
+            'webwxinit':             self._webwxinit,
+            'webwxstatusnotify':     self._ok,
+            'webwxgetcontact':       self._webwxgetcontact,
+            'webwxbatchgetcontact':  self._webwxbatchgetcontact,
+            'synccheck':             self._synccheck,
+            'webwxsync':             self._webwxsync,
+            'webwxgetmsgimg':        self._webwxgetmsgimg,
+            'webwxgetpubliclinkimg': self._webwxgetmsgimg,
+            'webwxuploadmedia':      self._webwxuploadmedia,
+            'webwxsendmsg':          self._send,
+            'webwxsendmsgimg':       self._send,
+            'webwxsendappmsg':       self._send,
+            'webwxrevokemsg':        self._ok,
+            'webwxoplog':            self._ok,
+            'webwxupdatechatroom':   self._ok,
+            'webwxlogout':           lambda query, body: (301, 'text/plain', b'', {'Location': '/'}),
+        }
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, as with the real servers
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written apart, Nagle would hold the body until the delayed ack
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._dispatch(b'')
+
+            def do_POST(self):
+                self._dispatch(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def _dispatch(self, body):
+                url = urlsplit(self.path)
+                endpoint = url.path.rsplit('/', 1)[-1]
+                route = server._routes.get(endpoint)
+                if route is None:
+                    self.send_error(404)
+                    return
+                server.requests[endpoint] += 1
+                delay = server.latencies.get(endpoint, server.latency)
+                if delay:
+                    time.sleep(delay)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                status, content_type, content, headers = route(query, body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f'{host}:{port}'
+
+    @property
+    def uri(self):
+        return 'http://' + self.address
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def attach(self, client):
+        """
+        point a WebWxClient at this server instead of WeChat
+        """
+        client.login_uri = self.uri
+        client.upload_uri = self.uri + '/cgi-bin/mmwebwx-bin'
+        client.sync_scheme = 'http'
+        client.sync_hosts = [self.address]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake-webwx', daemon=True).start()
+        self.logger.info(f'Serving fake WebWx on {self.uri}')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def produce(self, count, rate=0):
+        """
+        queue count messages from a background thread
+        :param rate: messages per second, 0 queues all at once
+        :return: the producing thread
+        """
+
+        def run():
+            start = time.perf_counter()
+            produced = 0
+            while produced < count:
+                due = count if not rate else min(count, int((time.perf_counter() - start) * rate) + 1)
+                if due > produced:
+                    self.queue([self.gen_add_msg() for _ in range(due - produced)])
+                    produced = due
+                else:
+                    time.sleep(min(0.01, 1 / rate))
+
+        thread = threading.Thread(target=run, name='fake-webwx-producer', daemon=True)
+        thread.start()
+        return thread
+
+    def gen_add_msg(self) -> dict:
+        msg_id = str(next(self._msg_ids))
+        is_image = random.random() < self.image_ratio
+        if self.chatrooms and random.random() < 0.5:
+            index = random.randrange(self.chatroom_count)
+            from_username = self.chatrooms[index]
+            member = f'@member{index}_{random.randrange(self.member_count)}' if self.member_count else '@friend0'
+            if is_image:
+                content = f'{member}:<br/>'
+            else:
+                content = f'{member}:<br/>@member{index}_0 今天晚上一起吃饭吗？[微笑] {msg_id}'
+        else:
+            from_username = random.choice(self.friends)
+            content = '' if is_image else f'今天晚上一起吃饭吗？[微笑] {msg_id}'
+        return {
+            'MsgId':        msg_id,
+            'FromUserName': from_username,
+            'ToUserName':   self.user['UserName'],
+            'MsgType':      3 if is_image else 1,
+            'Content':      content,
+            'Status':       3,
+            'ImgStatus':    2 if is_image else 1,
+            'CreateTime':   int(time.time()),
+            'SubMsgType':   0,
+            'AppMsgType':   0,
+            'Url':          '',
+            'FileName':     '',
+            'NewMsgId':     int(msg_id)
+        }
+
+    def queue(self, add_msg_list):
+        now = time.perf_counter()
+        with self._queue_changed:
+            for add_msg in add_msg_list:
+                self.queued_at[add_msg['MsgId']] = now
+            self._queue.extend(add_msg_list)
+            self._queue_changed.notify_all()
+
+    @staticmethod
+    def _json(dic, headers=None):
+        return 200, 'application/json; charset=UTF-8', json.dumps(dic, ensure_ascii=False).encode(), headers or {}
+
+    @staticmethod
+    def _text(text, headers=None):
+        return 200, 'text/javascript', text.encode(), headers or {}
+
+    def _ok(self, query, body):
+        return self._json({'BaseResponse': {'Ret': 0, 'ErrMsg': ''}})
+
+    def _jslogin(self, query, body):
+        return self._text('window.QRLogin.code = 200; window.QRLogin.uuid = "fakeuuid";')
+
+    def _login(self, query, body):
+        # scanned and confirmed at once
+        redirect_uri = (f'{self.uri}/cgi-bin/mmwebwx-bin/webwxnewloginpage?ticket=fake&uuid={query.get("uuid")}'
+                        f'&lang=zh_CN&scan={int(time.time())}')
+        return self._text(f'window.code=200;\nwindow.redirect_uri="{redirect_uri}";')
+
+    def _webwxnewloginpage(self, query, body):
+        xml = ('<error><ret>0</ret><message></message><skey>@crypt_fake_skey</skey><wxsid>fakesid</wxsid>'
+               '<wxuin>1234567890</wxuin><pass_ticket>fakepassticket</pass_ticket><isgrayscale>1</isgrayscale>'
+               '</error>')
+        return 200, 'text/plain', xml.encode(), {'Set-Cookie': 'webwx_data_ticket=fakedataticket; Path=/'}
+
+    def _sync_key_dic(self):
+        return {'Count': 1, 'List': [{'Key': 1, 'Val': next(self._sync_key)}]}
+
+    def _webwxinit(self, query, body):
+        return self._json({
+            'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+            'User':         self.user,
+            'ContactList':  [_contact_json(username, username[1:]) for username in self.friends[:10]],
+            'SyncKey':      self._sync_key_dic()
+        })
+
+    def _webwxgetcontact(self, query, body):
+        member_list = [_contact_json(username, username[1:]) for username in self.friends]
+        # chatroom members are missing here, as with the real endpoint
+        member_list.extend(_contact_json(username, username[2:]) for username in self.chatrooms)
+        return self._json({'BaseResponse': {'Ret': 0, 'ErrMsg': ''}, 'MemberCount': len(member_list),
+                           'MemberList': member_list, 'Seq': 0})
+
+    def _webwxbatchgetcontact(self, query, body):
+        contact_list = []
+        for item in json.loads(body)['List']:
+            username = item['UserName']
+            if username.startswith('@@'):
+                index = username[len('@@chatroom'):]
+                members = [{'UserName': f'@member{index}_{i}', 'NickName': f'member{index}_{i}',
+                            'DisplayName': f'群昵称{i}' if i % 2 else '', 'AttrStatus': 0}
+                           for i in range(self.member_count)]
+                contact_list.append(_contact_json(username, username[2:], member_list=members))
+            else:
+                contact_list.append(_contact_json(username, username[1:]))
+        return self._json({'BaseResponse': {'Ret': 0, 'ErrMsg': ''}, 'Count': len(contact_list),
+                           'ContactList': contact_list})
+
+    def _synccheck(self, query, body):
+        with self._queue_changed:
+            self._queue_changed.wait_for(lambda: self._queue, self.hold)
+            selector = '2' if self._queue else '0'
+        return self._text(f'window.synccheck={{retcode:"0",selector:"{selector}"}}')
+
+    def _webwxsync(self, query, body):
+        with self._queue_changed:
+            count = min(len(self._queue), self.sync_batch_size)
+            add_msg_list = [self._queue.popleft() for _ in range(count)]
+        sync_key = self._sync_key_dic()
+        return self._json({
+            'BaseResponse':           {'Ret': 0, 'ErrMsg': ''},
+            'AddMsgCount':            len(add_msg_list),
+            'AddMsgList':             add_msg_list,
+            'ModContactCount':        0,
+            'ModContactList':         [],
+            'DelContactCount':        0,
+            'DelContactList':         [],
+            'ModChatRoomMemberCount': 0,
+            'ModChatRoomMemberList':  [],
+            'SyncKey':                sync_key,
+            'SyncCheckKey':           sync_key,
+            'ContinueFlag':           0
+        })
+
+    def _webwxgetmsgimg(self, query, body):
+        image = self._thumbnail if query.get('type') == 'slave' else self._image
+        return 200, 'image/jpeg', image, {}
+
+    def _webwxuploadmedia(self, query, body):
+        # every chunk answers a MediaId, the client keeps the last one
+        return self._json({'BaseResponse': {'Ret': 0, 'ErrMsg': ''}, 'MediaId': f'@crypt_media{next(self._media_ids)}',
+                           'StartPos': len(body), 'CDNThumbImgHeight': 0, 'CDNThumbImgWidth': 0})
+
+    def _send(self, query, body):
+        msg_id = str(next(self._msg_ids))
+        return self._json({'BaseResponse': {'Ret': 0, 'ErrMsg': ''}, 'MsgID': msg_id, 'LocalID': msg_id})
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = FakeWebWxServer(port).start()
+    # a message per second for a client connected by hand
+    server.produce(sys.maxsize, rate=1)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
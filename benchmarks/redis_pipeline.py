@@ -0,0 +1,74 @@
+"""
+contact persistence round trips and wall time, one command per contact vs pipelined batches
+
+usage: python -m benchmarks.redis_pipeline [friends] [chatrooms]
+requires the redis configured in config.py, keys are written under chatbot:bench:
+"""
+import sys
+import time
+
+from redis import StrictRedis
+
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_BATCH_SIZE
+from storage import RedisBatchWriter
+
+PREFIX = 'chatbot:bench:'
+
+
+def gen_contacts(friend_count, chatroom_count):
+    contacts = {}
+    for i in range(friend_count):
+        contacts[f'@friend{i}'] = {'username': f'@friend{i}', 'nickname': f'nickname{i}',
+                                   'remark_name': f'remark{i}', 'head_img_url': f'/cgi-bin/head?u={i}', 'sex': 1}
+    for i in range(chatroom_count):
+        contacts[f'@@chatroom{i}'] = {'username': f'@@chatroom{i}', 'nickname': f'chatroom{i}',
+                                      'remark_name': '', 'head_img_url': f'/cgi-bin/head?c={i}', 'sex': 0}
+    return contacts
+
+
+def persist_one_by_one(r, contacts):
+    for username, contact in contacts.items():
+        r.hset(PREFIX + 'contact:' + username, mapping=contact)
+    for username, contact in contacts.items():
+        r.hset(PREFIX + 'username_nickname_mapping', username, contact['nickname'])
+        r.hset(PREFIX + 'username_remark_name_mapping', username, contact['remark_name'])
+    return len(contacts) * 3
+
+
+def persist_batched(r, contacts, batch_size):
+    with RedisBatchWriter(r, batch_size) as batch:
+        for username, contact in contacts.items():
+            batch.hmset(PREFIX + 'contact:' + username, contact)
+        for username, contact in contacts.items():
+            batch.hset(PREFIX + 'username_nickname_mapping', username, contact['nickname'])
+            batch.hset(PREFIX + 'username_remark_name_mapping', username, contact['remark_name'])
+    return batch.round_trips
+
+
+def clean(r):
+    for key in r.scan_iter(PREFIX + '*', count=1000):
+        r.unlink(key)
+
+
+def main():
+    friend_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    chatroom_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    r = StrictRedis(REDIS_HOST, REDIS_PORT, REDIS_DB, decode_responses=True)
+    contacts = gen_contacts(friend_count, chatroom_count)
+    clean(r)
+    print(f'{len(contacts)} contacts')
+
+    start = time.perf_counter()
+    round_trips = persist_one_by_one(r, contacts)
+    print(f'one by one:    {round_trips:>6} round trips {time.perf_counter() - start:8.3f}s')
+    clean(r)
+
+    for batch_size in (100, REDIS_BATCH_SIZE, 5000):
+        start = time.perf_counter()
+        round_trips = persist_batched(r, contacts, batch_size)
+        print(f'batch {batch_size:>5}:   {round_trips:>6} round trips {time.perf_counter() - start:8.3f}s')
+        clean(r)
+
+
+if __name__ == '__main__':
+    main()
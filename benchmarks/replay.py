@@ -0,0 +1,106 @@
+"""
+handle throughput on recorded traffic: a sync log written with SYNC_LOG set in config.py is fed through
+WebWxClient.handle offline, as fast as it goes, messages are encoded as for publishing by the handlers
+
+usage: python -m benchmarks.replay LOG [--repeat N] [--profile PATH] [--client webwx|custom]
+       python -m benchmarks.replay LOG --record N   records N messages from benchmarks.fake_server into LOG first
+--client custom publishes to the redis and rabbitmq configured in config.py, with SEEN_MSGS_TTL set the
+messages of a previous run are dropped as replayed
+"""
+import argparse
+import cProfile
+import os
+import threading
+import time
+
+from benchmarks.e2e import bench_client_class, custom_client_class, ingest
+from benchmarks.fake_server import FakeWebWxServer
+from webwx.client import WebWxClient
+from webwx.recording import ReplayClient, SyncLog, SyncRecorder
+
+
+def record(path, messages):
+    server = FakeWebWxServer(friends=2000, chatrooms=100, members=200).start()
+    client = bench_client_class(WebWxClient, server)()
+    client.recorder = SyncRecorder(path)
+    client.wait_for_login()
+    ingest(client, server, messages, 0, 300)
+    client.recorder.close()
+    server.stop()
+
+
+def replay_client_class(base):
+    class Replaying(ReplayClient, base):
+        def __init__(self):
+            super().__init__()
+            self.handled = 0
+            self.encoded_bytes = 0
+            self._handled_lock = threading.Lock()
+
+        def _count(self, msg):
+            encoded = msg.encode(self.serializer)
+            with self._handled_lock:
+                self.handled += 1
+                self.encoded_bytes += len(encoded)
+
+        def handle_text(self, msg):
+            super().handle_text(msg)
+            self._count(msg)
+
+        def handle_image(self, msg):
+            super().handle_image(msg)
+            self._count(msg)
+
+        def handle_emotion(self, msg):
+            super().handle_emotion(msg)
+            self._count(msg)
+
+        def handle_location(self, msg):
+            super().handle_location(msg)
+            self._count(msg)
+
+        def handle_link(self, msg):
+            super().handle_link(msg)
+            self._count(msg)
+
+    return Replaying
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log')
+    parser.add_argument('--record', type=int, default=0, help='messages to record from the fake server first')
+    parser.add_argument('--repeat', type=int, default=3, help='replays, each by a fresh client')
+    parser.add_argument('--profile', help='cProfile stats of the last replay are written here')
+    parser.add_argument('--client', choices=('webwx', 'custom'), default='webwx')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.log, args.record)
+    cls = replay_client_class(custom_client_class() if args.client == 'custom' else WebWxClient)
+    with SyncLog(args.log) as sync_log:
+        counts = {kind.name.lower(): count for kind, count in sync_log.counts.items()}
+        print(f'{args.log}: {os.path.getsize(args.log) / 2 ** 20:.1f}MiB {counts}')
+        for i in range(args.repeat):
+            client = cls()
+            profile = cProfile.Profile() if args.profile and i == args.repeat - 1 else None
+            start = time.perf_counter()
+            if profile:
+                profile.enable()
+            responses = client.replay(sync_log)
+            if profile:
+                profile.disable()
+            seconds = time.perf_counter() - start
+            print(f'replay {i}: {responses} responses, {client.handled} messages in {seconds:.3f}s, '
+                  f'{client.handled / seconds:.0f} messages/s, {seconds / max(1, client.handled) * 1e6:.1f}us/message, '
+                  f'{client.encoded_bytes / max(1, client.handled):.0f}B encoded/message')
+            client.media_fetcher.shutdown()
+            if profile:
+                profile.dump_stats(args.profile)
+                print(f'profile of the replaying thread written to {args.profile}')
+    # the receiving loop of a recording never returns
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
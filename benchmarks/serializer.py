@@ -0,0 +1,78 @@
+"""
+payload size and encode time of published messages and persisted contacts, json.dumps(msg.json) per call
+(the former _publish) vs webwx.serializer backends, every message is published once as in production
+
+usage: python -m benchmarks.serializer [messages]
+"""
+import json
+import sys
+import timeit
+
+from webwx.models import Friend, ChatRoom, Msg, TextMsg
+from webwx.serializer import get_serializer, RedisHashSerializer
+
+
+def gen_contacts(count):
+    return [Friend({'UserName': f'@{i:064x}', 'HeadImgUrl': f'/cgi-bin/mmwebwx-bin/webwxgeticon?u={i}',
+                    'NickName': f'昵称{i}', 'RemarkName': f'remark{i}', 'Sex': i % 3}) for i in range(count)]
+
+
+def gen_messages(count, contacts):
+    chatroom = ChatRoom({'UserName': '@@chatroom', 'HeadImgUrl': '', 'NickName': 'chatroom', 'RemarkName': '',
+                         'Sex': 0})
+    messages = []
+    for i in range(count):
+        msg = Msg(str(i), contacts[i % len(contacts)], chatroom, '', 1500000000 + i)
+        messages.append(TextMsg(msg, '今天晚上一起吃饭吗？我在公司楼下等你' * (i % 5 + 1), chatroom))
+    return messages
+
+
+def _size(encoded):
+    if isinstance(encoded, dict):
+        return sum(len(str(key)) + len(str(value)) for key, value in encoded.items())
+    return len(encoded)
+
+
+def bench(name, func, items, number=5):
+    seconds = min(timeit.repeat(lambda: [func(item) for item in items], number=1, repeat=number))
+    size = sum(_size(func(item)) for item in items) / len(items)
+    print(f'{name:<40} {seconds * 1000:8.2f}ms  {seconds / len(items) * 1e9:8.0f}ns/item  {size:6.0f}B/item')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    contacts = gen_contacts(1000)
+    messages = gen_messages(count, contacts)
+    names = ['json', 'orjson', 'msgpack']
+    serializers = []
+    for name in names:
+        try:
+            serializers.append(get_serializer(name))
+        except ValueError as e:
+            print(f'skip {name}: {e}')
+
+    def former_publish(msg):
+        # dict rebuilt twice, once for the log line
+        msg.invalidate()
+        msg.json
+        msg.invalidate()
+        return json.dumps(msg.json).encode()
+
+    bench('publish: json.dumps, rebuilt', former_publish, messages)
+    for serializer in serializers:
+        def publish(msg, serializer=serializer):
+            # a fresh message, the log line and the publish share its json
+            msg.invalidate()
+            msg.json
+            return msg.encode(serializer)
+
+        bench(f'publish: {serializer.name}', publish, messages)
+
+    # contacts are not cached, see Contact
+    redis_hash = RedisHashSerializer()
+    bench('contact redis hash', lambda contact: contact.encode(redis_hash), contacts)
+    print('sex written as', repr(contacts[1].encode(redis_hash)['sex']))
+
+
+if __name__ == '__main__':
+    main()
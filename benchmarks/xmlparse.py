@@ -0,0 +1,84 @@
+"""
+xml extraction of login, emotion and link payloads, minidom (the former parsing) vs webwx.xmlparse
+
+usage: python -m benchmarks.xmlparse
+"""
+import timeit
+from xml.dom import minidom
+
+from webwx import xmlparse
+
+LOGIN_XML = '<error><ret>0</ret><message></message><skey>@crypt_3f8b5a2c_0123456789abcdef0123456789abcdef</skey>' \
+            '<wxsid>Yk3pTq8wZ1abcdEF</wxsid><wxuin>1234567890</wxuin>' \
+            '<pass_ticket>abcdEFGH1234%2Bijkl5678MNOPqrst9012UVWXyz</pass_ticket><isgrayscale>1</isgrayscale></error>'
+
+EMOTION_XML = '<msg><emoji fromusername="wxid_sender" tousername="wxid_receiver" type="2" idbuffer="media:0_0" ' \
+              'md5="0123456789abcdef0123456789abcdef" len="102400" productid="" androidmd5="" androidlen="0" ' \
+              's60v3md5="" s60v3len="0" s60v5md5="" s60v5len="0" ' \
+              'cdnurl="http://emoji.qpic.cn/wx_emoji/0123456789abcdef/" designerid="" thumburl="" ' \
+              'encrypturl="" aeskey="" width="240" height="240"></emoji></msg>'
+
+LINK_XML = '<msg><appmsg appid="" sdkver="0"><title>今天晚上一起吃饭吗</title><des>我在公司楼下等你</des>' \
+           '<action></action><type>5</type><showtype>0</showtype><content></content>' \
+           '<url>http://mp.weixin.qq.com/s?__biz=MzA5&amp;mid=2650&amp;idx=1&amp;sn=abcdef</url>' \
+           '<dataurl></dataurl><lowurl></lowurl><thumburl>http://mmbiz.qpic.cn/mmbiz_jpg/abcdef/0</thumburl>' \
+           '<mmreader><category type="20" count="1"><name>公众号</name><topnew><cover></cover><width>0</width>' \
+           '<height>0</height><digest></digest></topnew>' + \
+           '<item><itemshowtype>0</itemshowtype><title>今天晚上一起吃饭吗</title><url></url><digest></digest>' \
+           '</item>' * 8 + \
+           '</category><publisher><username>gh_abcdef</username><nickname>公众号</nickname></publisher>' \
+           '</mmreader></appmsg><fromusername>gh_abcdef</fromusername><appinfo><version>1</version>' \
+           '<appname>公众号</appname></appinfo></msg>'
+
+
+def login_minidom(xml):
+    values = {}
+    for node in minidom.parseString(xml).documentElement.childNodes:
+        if node.nodeName in ('skey', 'wxsid', 'wxuin', 'pass_ticket'):
+            values[node.nodeName] = node.childNodes[0].data
+    return values
+
+
+def login_xmlparse(xml):
+    return xmlparse.find_texts(xml, ('skey', 'wxsid', 'wxuin', 'pass_ticket'))
+
+
+def emotion_minidom(xml):
+    return minidom.parseString(xml).documentElement.getElementsByTagName('emoji')[0].getAttribute('cdnurl')
+
+
+def emotion_xmlparse(xml):
+    return xmlparse.find_attrs(xml, 'emoji').get('cdnurl', '')
+
+
+def _text(root, tag):
+    nodes = root.getElementsByTagName(tag)
+    return nodes[0].firstChild.data if nodes and nodes[0].firstChild else ''
+
+
+def link_minidom(xml):
+    appmsg = minidom.parseString(xml).documentElement.getElementsByTagName('appmsg')[0]
+    return {path: _text(appmsg, path.split('/')[1]) for path in ('appmsg/type', 'appmsg/title', 'appmsg/url',
+                                                                 'appmsg/des')}
+
+
+def link_xmlparse(xml):
+    return xmlparse.find_texts(xml, ('appmsg/type', 'appmsg/title', 'appmsg/url', 'appmsg/des'))
+
+
+def bench(name, func, xml, number=20000):
+    seconds = min(timeit.repeat(lambda: func(xml), number=number, repeat=5))
+    print(f'{name:<24} {seconds / number * 1e6:8.2f}us')
+
+
+def main():
+    for name, xml, former, current in (('login', LOGIN_XML, login_minidom, login_xmlparse),
+                                       ('emotion', EMOTION_XML, emotion_minidom, emotion_xmlparse),
+                                       ('link', LINK_XML, link_minidom, link_xmlparse)):
+        assert former(xml) == current(xml), name
+        bench(f'{name}: minidom', former, xml)
+        bench(f'{name}: xmlparse', current, xml)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,65 @@ RABBIT_HOST = 'localhost'
 RABBIT_PORT = 5672
 RECEIVE_QUEUE = 'chatbot.receive'
 SEND_QUEUE = 'chatbot.send'
+# send queue consumer threads, messages to the same recipient are always sent in order
+SEND_WORKERS = 4
+# unacked messages rabbitmq may push to the send consumer
+SEND_PREFETCH_COUNT = 16
+# messages failed SEND_MAX_ATTEMPTS times, and malformed or unsupported commands at once, are moved to this queue
+SEND_DEAD_LETTER_QUEUE = 'chatbot.send.dead'
+SEND_MAX_ATTEMPTS = 5
+# seconds, doubled on every retry
+SEND_RETRY_BASE_DELAY = 2
+SEND_RETRY_MAX_DELAY = 300
+# messages per second and burst of the whole account, and of a single recipient
+SEND_RATE = 2
+SEND_BURST = 5
+RECIPIENT_SEND_RATE = 0.5
+RECIPIENT_SEND_BURST = 3
 
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 REDIS_DB = 0
+# max redis commands per pipeline round trip
+REDIS_BATCH_SIZE = 500
+
+# parallel downloads of incoming images and locations
+MEDIA_FETCH_WORKERS = 4
+# seconds
+MEDIA_FETCH_TIMEOUT = 30
+# MediaId of uploaded files reused by later sends of the same file
+MEDIA_ID_CACHE_SIZE = 1024
+# seconds
+MEDIA_ID_CACHE_TTL = 6 * 3600
+# 'full' downloads every inbound image, 'thumbnail' only its thumbnail, the full image is published on
+# a FETCH_FULL_IMAGE event
+IMAGE_INGEST_MODE = 'full'
+# thumbnail messages whose full image can still be fetched
+THUMBNAIL_MSGS_SIZE = 1024
+# messages waiting to be published before the receive loop blocks
+PUBLISH_MAX_PENDING = 10000
+# messages published between processing the broker's confirms
+PUBLISH_BATCH_SIZE = 100
+# json encoding of the webwx requests and redis values, None for orjson if installed else json
+SERIALIZER = None
+# encoding of the received messages, None as SERIALIZER, 'msgpack' if the consumers decode msgpack
+PUBLISH_SERIALIZER = None
+# MsgIds remembered to drop replayed messages, and seconds they are kept in redis across restarts,
+# 0 to deduplicate in memory only
+SEEN_MSGS_SIZE = 10000
+SEEN_MSGS_TTL = 24 * 3600
+# port of the local prometheus endpoint /metrics, 0 disables the metrics
+METRICS_PORT = 0
+# record spans of the ingest and send stages, served as Chrome trace JSON on /debug/trace of the metrics port
+TRACING = False
+# on SIGUSR1 the threads are sampled for PROFILE_SECONDS and the folded stacks written to PROFILE_DIR
+PROFILE_SECONDS = 30
+PROFILE_DIR = 'profiles'
+# how inbound images are published: 'inline' as base64_content, 'blob' as a reference into BLOB_STORE_DIR
+PUBLISH_MEDIA_MODE = 'inline'
+BLOB_STORE_DIR = 'blobs'
+# the least recently used blobs are deleted above this size
+BLOB_STORE_MAX_BYTES = 1024 * 1024 * 1024
+# webwxsync responses and the contacts and media they need are appended to this log for benchmarks.replay,
+# None to not record
+SYNC_LOG = None
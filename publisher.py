@@ -0,0 +1,181 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque, OrderedDict
+
+import pika
+from pika.spec import Basic
+
+from webwx import metrics
+
+PUBLISH_CONFIRM_SECONDS = metrics.histogram('chatbot_publish_confirm_seconds',
+                                            'seconds between publishing and the broker confirm')
+PUBLISH_NACKED = metrics.counter('chatbot_publish_nacked_total', 'messages nacked by the broker, published again')
+
+
+class Publisher:
+    """
+    publish to a queue from a dedicated thread owning its connection
+
+    publish only enqueues the body, the caller never waits for the broker unless max_pending bodies are
+    queued already. Bodies are published in batches with publisher confirms, the ones nacked by the broker
+    or not confirmed when the connection was lost are published again after reconnecting.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, connection_parameters: pika.ConnectionParameters, queue_name, max_pending=10000,
+                 batch_size=100, max_unconfirmed=1000, reconnect_delay=5):
+        """
+        :param max_pending: bodies queued before publish blocks
+        :param batch_size: bodies published before the connection's other events are processed
+        :param max_unconfirmed: bodies published but not confirmed yet before publishing pauses
+        :param reconnect_delay: seconds between connection attempts
+        """
+        self.connection_parameters = connection_parameters
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.max_unconfirmed = max_unconfirmed
+        self.reconnect_delay = reconnect_delay
+        self.confirmed = 0
+        self.nacked = 0
+        # exponential moving average of the seconds between publishing and the broker's confirm
+        self.confirm_latency = 0.0
+        self._queue = queue.Queue(max_pending)
+        # published again before the queue, only touched by the publisher thread
+        self._retry = deque()
+        # delivery tag -> (body, published at), oldest first
+        self._unconfirmed = OrderedDict()
+        self._delivery_tag = 0
+        self._conn: pika.SelectConnection = None
+        self._channel = None
+        self._flush_scheduled = False
+        # guards the connection state shared with the publishing threads
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+        metrics.QUEUE_DEPTH.set_function(lambda: self.pending, 'publish')
+
+    @property
+    def pending(self) -> int:
+        """
+        bodies queued, waiting for a retry or for their confirm
+        """
+        return self._queue.qsize() + len(self._retry) + len(self._unconfirmed)
+
+    def start(self):
+        self._thread.start()
+
+    def publish(self, body, timeout=None):
+        """
+        :param timeout: seconds to wait while max_pending bodies are queued, forever if None
+        :raise queue.Full: the queue stayed full for timeout seconds
+        """
+        self._queue.put(body, timeout=timeout)
+        with self._lock:
+            if self._flush_scheduled or self._channel is None:
+                # a flush is coming, or the channel is not ready and flushes once it is
+                return
+            self._flush_scheduled = True
+            self._conn.ioloop.add_callback_threadsafe(self._flush)
+
+    def _run(self):
+        while True:
+            conn = pika.SelectConnection(self.connection_parameters,
+                                         on_open_callback=self._on_connection_open,
+                                         on_open_error_callback=self._on_connection_closed,
+                                         on_close_callback=self._on_connection_closed)
+            with self._lock:
+                self._conn = conn
+            conn.ioloop.start()
+            with self._lock:
+                self._conn = None
+                self._channel = None
+                self._flush_scheduled = False
+            conn.ioloop.close()
+            if self._unconfirmed:
+                self.logger.warning(f'{len(self._unconfirmed)} messages not confirmed, publish them again')
+                self._retry.extendleft(reversed([body for body, _ in self._unconfirmed.values()]))
+                self._unconfirmed.clear()
+            time.sleep(self.reconnect_delay)
+
+    def _on_connection_open(self, conn):
+        conn.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, conn, error):
+        self.logger.warning(f'Publisher connection closed: {error}, reconnect in {self.reconnect_delay}s')
+        conn.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.queue_declare(queue=self.queue_name, callback=lambda _: channel.confirm_delivery(
+            self._on_delivery_confirmation, callback=lambda _: self._on_channel_ready(channel)))
+
+    def _on_channel_closed(self, channel, error):
+        self.logger.warning(f'Publisher channel closed: {error}')
+        with self._lock:
+            self._channel = None
+            conn = self._conn
+        if conn is not None and not (conn.is_closing or conn.is_closed):
+            conn.close()
+
+    def _on_channel_ready(self, channel):
+        # delivery tags start over on every channel
+        self._delivery_tag = 0
+        with self._lock:
+            self._channel = channel
+            self._flush_scheduled = False
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+            channel = self._channel
+        if channel is None or not channel.is_open:
+            return
+        published = 0
+        while published < self.batch_size and len(self._unconfirmed) < self.max_unconfirmed:
+            if self._retry:
+                body = self._retry.popleft()
+            else:
+                try:
+                    body = self._queue.get_nowait()
+                except queue.Empty:
+                    return
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = (body, time.monotonic())
+            channel.basic_publish(exchange='', routing_key=self.queue_name, body=body)
+            published += 1
+        if published == self.batch_size:
+            # more may be waiting, process the confirms and heartbeats received meanwhile first
+            with self._lock:
+                if self._flush_scheduled:
+                    return
+                self._flush_scheduled = True
+            self._conn.ioloop.call_later(0, self._flush)
+        # otherwise paused by max_unconfirmed until confirms arrive
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        nacked = isinstance(method, Basic.Nack)
+        if method.multiple:
+            delivery_tags = []
+            for delivery_tag in self._unconfirmed:
+                if delivery_tag > method.delivery_tag:
+                    break
+                delivery_tags.append(delivery_tag)
+        else:
+            delivery_tags = [method.delivery_tag]
+        now = time.monotonic()
+        for delivery_tag in delivery_tags:
+            body, published_at = self._unconfirmed.pop(delivery_tag)
+            if nacked:
+                self.nacked += 1
+                PUBLISH_NACKED.inc()
+                self._retry.append(body)
+            else:
+                self.confirmed += 1
+                self.confirm_latency += ((now - published_at) - self.confirm_latency) * 0.1
+                PUBLISH_CONFIRM_SECONDS.observe(now - published_at)
+        if nacked:
+            self.logger.warning(f'{len(delivery_tags)} messages nacked, publish them again')
+        self._flush()
@@ -1,65 +1,98 @@
 import functools
-import json
 import random
 import threading
+from contextlib import contextmanager
 from logging.config import dictConfig
 import pika
 import yaml
-from apscheduler.schedulers.background import BackgroundScheduler
 from redis import StrictRedis
 
-from config import RABBIT_HOST, RABBIT_PORT, RECEIVE_QUEUE, SEND_QUEUE, REDIS_HOST, REDIS_PORT, REDIS_DB
+from config import RABBIT_HOST, RABBIT_PORT, RECEIVE_QUEUE, SEND_QUEUE, REDIS_HOST, REDIS_PORT, REDIS_DB, \
+    MEDIA_FETCH_WORKERS, MEDIA_FETCH_TIMEOUT, REDIS_BATCH_SIZE, SEND_WORKERS, SEND_PREFETCH_COUNT, \
+    SEND_DEAD_LETTER_QUEUE, SEND_MAX_ATTEMPTS, SEND_RETRY_BASE_DELAY, SEND_RETRY_MAX_DELAY, SEND_RATE, SEND_BURST, \
+    RECIPIENT_SEND_RATE, RECIPIENT_SEND_BURST, MEDIA_ID_CACHE_SIZE, MEDIA_ID_CACHE_TTL, PUBLISH_MEDIA_MODE, \
+    BLOB_STORE_DIR, BLOB_STORE_MAX_BYTES, IMAGE_INGEST_MODE, THUMBNAIL_MSGS_SIZE, PUBLISH_MAX_PENDING, \
+    PUBLISH_BATCH_SIZE, SERIALIZER, PUBLISH_SERIALIZER, SEEN_MSGS_SIZE, SEEN_MSGS_TTL, METRICS_PORT, \
+    TRACING, PROFILE_SECONDS, PROFILE_DIR, SYNC_LOG
+from publisher import Publisher
+from sender import PermanentSendError, SendEngine
+from storage import RedisBatchWriter, RedisHashMirror, RedisKeyspace, RedisSeenSet
+from webwx import metrics, tracing
+from webwx.blobstore import FileSystemBlobStore
 from webwx.client import WebWxClient
 from webwx.enums import MsgType, EventType
+from webwx.recording import SyncRecorder
+from webwx.serializer import get_serializer, RedisHashSerializer
+
+PERSIST_SECONDS = metrics.histogram('chatbot_redis_persist_seconds', 'seconds to persist to redis', ('operation',))
+REDIS_ROUND_TRIPS = metrics.counter('chatbot_redis_round_trips_total', 'redis pipelines executed', ('operation',))
+PUBLISHED = metrics.counter('chatbot_published_total', 'messages handed to the publisher', ('msg_type',))
+PUBLISHED_BYTES = metrics.counter('chatbot_published_bytes_total', 'encoded bytes handed to the publisher')
 
 
 class CustomClient(WebWxClient):
+    media_fetch_workers = MEDIA_FETCH_WORKERS
+    media_fetch_timeout = MEDIA_FETCH_TIMEOUT
+    send_rate = SEND_RATE
+    send_burst = SEND_BURST
+    recipient_send_rate = RECIPIENT_SEND_RATE
+    recipient_send_burst = RECIPIENT_SEND_BURST
+    media_id_cache_size = MEDIA_ID_CACHE_SIZE
+    media_id_cache_ttl = MEDIA_ID_CACHE_TTL
+    image_ingest_mode = IMAGE_INGEST_MODE
+    thumbnail_msgs_size = THUMBNAIL_MSGS_SIZE
+    seen_msgs_size = SEEN_MSGS_SIZE
+    serializer = get_serializer(SERIALIZER)
+    publish_serializer = get_serializer(PUBLISH_SERIALIZER)
 
     def __init__(self):
         super().__init__()
+        if PUBLISH_MEDIA_MODE == 'blob':
+            self.blob_store = FileSystemBlobStore(BLOB_STORE_DIR, BLOB_STORE_MAX_BYTES)
+        if SYNC_LOG:
+            self.recorder = SyncRecorder(SYNC_LOG)
         self.r = StrictRedis(REDIS_HOST, REDIS_PORT, REDIS_DB, decode_responses=True)
-        keys = self.r.keys('chatbot:*')
-        if keys:
-            self.r.delete(*keys)
-        self.conn = pika.BlockingConnection(pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT))
-        self.receive_channel = self.conn.channel()
-        self.receive_channel.queue_declare(queue=RECEIVE_QUEUE)
-
-        # rabbitmq heartbeat keeping thread
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(lambda conn: conn.process_data_events(), 'interval',
-                          seconds=10, args=[self.conn])
-        scheduler.start()
+        # this login writes under a fresh generation, the previous one stays readable until after_login
+        self.keyspace = RedisKeyspace(self.r)
+        self.redis_mirror = RedisHashMirror()
+        self.redis_hash_serializer = RedisHashSerializer(self.serializer)
+        if SEEN_MSGS_TTL:
+            # messages replayed to a restarted process are dropped too
+            self.seen_msgs.backend = RedisSeenSet(self.r, ttl=SEEN_MSGS_TTL)
+        # owns its connection, handlers only enqueue
+        self.publisher = Publisher(pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT), RECEIVE_QUEUE,
+                                   max_pending=PUBLISH_MAX_PENDING, batch_size=PUBLISH_BATCH_SIZE)
+        self.publisher.start()
 
     def after_login(self):
-        # persist cookie
-        self.r.hmset("chatbot:client:cookie", self.session.cookies.get_dict())
-        # chatid is webwx's username
-        self.r.set('chatbot:client:self_chatid', self.user.username)
-        username_dict = {}
-        nickname_dict = {}
-        remark_name_dict = {}
-        for contact in self.contacts.values():
-            username = contact.username
-            nickname_dict[username] = contact.nickname
-            # set a default remark name when contact has no remark name
-            if not contact.remark_name:
-                # do not record record without remark name
-                remark_name = self._gen_remark_name(contact.nickname)
-                # do not to modify redis data immediately
-                # modify it when receiving webwx message and the function handle_modify_contacts called
-                self.webwxoplog(contact.username, remark_name)
-            else:
-                username_dict[username] = contact.remark_name
-                remark_name_dict[contact.remark_name] = username
-        if username_dict:
-            self.r.hmset('chatbot:client:username_remark_name_mapping', username_dict)
-        if nickname_dict:
-            self.r.hmset('chatbot:client:username_nickname_mapping', nickname_dict)
-        if remark_name_dict:
-            self.r.hmset('chatbot:client:remark_name_username_mapping', remark_name_dict)
-
-        self._persist_contact_data()
+        with self._redis_batch('after_login') as batch:
+            # persist cookie
+            batch.hmset(self.keyspace.key('client:cookie'), self.session.cookies.get_dict())
+            # chatid is webwx's username
+            batch.set(self.keyspace.key('client:self_chatid'), self.user.username)
+            username_dict = {}
+            nickname_dict = {}
+            remark_name_dict = {}
+            for contact in self.contacts.values():
+                username = contact.username
+                nickname_dict[username] = contact.nickname
+                # set a default remark name when contact has no remark name
+                if not contact.remark_name:
+                    # do not record record without remark name
+                    remark_name = self._gen_remark_name(contact.nickname)
+                    # do not to modify redis data immediately
+                    # modify it when receiving webwx message and the function handle_modify_contacts called
+                    self.webwxoplog(contact.username, remark_name)
+                else:
+                    username_dict[username] = contact.remark_name
+                    remark_name_dict[contact.remark_name] = username
+            self.redis_mirror.write(batch, self.keyspace.key('client:username_remark_name_mapping'), username_dict)
+            self.redis_mirror.write(batch, self.keyspace.key('client:username_nickname_mapping'), nickname_dict)
+            self.redis_mirror.write(batch, self.keyspace.key('client:remark_name_username_mapping'), remark_name_dict)
+
+            self._persist_contact_data(batch)
+        # readers switch to this generation at once, older ones are reclaimed in background
+        self.keyspace.activate()
 
     def handle_text(self, msg):
         self._publish(msg)
@@ -73,30 +106,52 @@ class CustomClient(WebWxClient):
     def handle_location(self, msg):
         self._publish(msg)
 
+    def handle_link(self, msg):
+        self._publish(msg)
+
     def handle_update_contacts(self, username_list):
-        for username in username_list:
-            if username in self.chatrooms:
-                self._update_chatroom_member_data(self.chatrooms[username])
-            # update username remark_name mapping
-            self.r.hset('chatbot:client:remark_name_username_mapping', self.contacts[username].remark_name, username)
-            old_remark_name = self.r.hget('chatbot:client:username_remark_name_mapping', username)
-            # remove the old remark name
-            self.r.hdel('chatbot:client:remark_name_username_mapping', old_remark_name)
-            self.r.hset('chatbot:client:username_remark_name_mapping', username,
-                        self.contacts[username].remark_name)
-            self.r.hset('chatbot:client:username_nickname_mapping', username, self.contacts[username].nickname)
-
-    def _persist_contact_data(self):
-        for special_user in self.special_users.values():
-            self.r.hmset('chatbot:client:special_user:' + special_user.username, special_user.json)
-        for chatroom in self.chatrooms.values():
-            self.r.hmset('chatbot:client:media_platform:' + chatroom.username, chatroom.json)
-        for media_platform in self.media_platforms.values():
-            self.r.hmset('chatbot:client:media_platform:' + media_platform.username, media_platform.json)
-        for friend in self.friends.values():
-            self.r.hmset('chatbot:client:friend:' + friend.username, friend.json)
-
-    def _update_chatroom_member_data(self, chatroom):
+        # read every old remark name in one round trip
+        old_remark_names = self.r.hmget(self.keyspace.key('client:username_remark_name_mapping'), username_list) \
+            if username_list else []
+        with self._redis_batch('update_contacts') as batch:
+            for username, old_remark_name in zip(username_list, old_remark_names):
+                contact = self.contacts[username]
+                self._persist_contact(contact, batch)
+                if username in self.chatrooms:
+                    self._update_chatroom_member_data(self.chatrooms[username], batch)
+                # remove the old remark name
+                if old_remark_name and old_remark_name != contact.remark_name:
+                    self.redis_mirror.hdel(batch, self.keyspace.key('client:remark_name_username_mapping'),
+                                           old_remark_name)
+                # update username remark_name mapping
+                self.redis_mirror.write(batch, self.keyspace.key('client:remark_name_username_mapping'),
+                                        {contact.remark_name: username})
+                self.redis_mirror.write(batch, self.keyspace.key('client:username_remark_name_mapping'),
+                                        {username: contact.remark_name})
+                self.redis_mirror.write(batch, self.keyspace.key('client:username_nickname_mapping'),
+                                        {username: contact.nickname})
+
+    def _persist_contact_data(self, batch):
+        for contacts in (self.special_users, self.chatrooms, self.media_platforms, self.friends):
+            for contact in contacts.values():
+                self._persist_contact(contact, batch)
+
+    def _persist_contact(self, contact, batch):
+        if contact.username in self.special_users:
+            key = 'client:special_user:'
+        elif contact.username in self.chatrooms:
+            key = 'client:chatroom:'
+        elif contact.username in self.media_platforms:
+            key = 'client:media_platform:'
+        elif contact.username in self.friends:
+            key = 'client:friend:'
+        else:
+            return
+        # only the fields changed since the last write are sent
+        self.redis_mirror.write(batch, self.keyspace.key(key + contact.username),
+                                contact.encode(self.redis_hash_serializer))
+
+    def _update_chatroom_member_data(self, chatroom, batch):
         chatroom_username_nickname_dict = {}
         chatroom_username_display_name_dict = {}
         member_list = chatroom.member_list
@@ -104,57 +159,93 @@ class CustomClient(WebWxClient):
             # set user nickname who is not your friend but in the chatroom
             chatroom_username_nickname_dict[member.username] = member.nickname
             chatroom_username_display_name_dict[member.username] = member.display_name
-        self.r.hmset('chatbot:client:username_nickname_mapping', chatroom_username_nickname_dict)
-        self.r.hmset('chatbot:client:chatroom:' + chatroom.username + ':username_display_name_mapping',
-                     chatroom_username_display_name_dict)
+        self.redis_mirror.write(batch, self.keyspace.key('client:username_nickname_mapping'),
+                                chatroom_username_nickname_dict)
+        # members who left the chatroom are deleted
+        key = self.keyspace.key('client:chatroom:' + chatroom.username + ':username_display_name_mapping')
+        self.redis_mirror.write(batch, key, chatroom_username_display_name_dict, replace=True)
+
+    @contextmanager
+    def _redis_batch(self, operation):
+        with PERSIST_SECONDS.time(operation), RedisBatchWriter(self.r, REDIS_BATCH_SIZE) as batch:
+            yield batch
+        REDIS_ROUND_TRIPS.inc(operation, amount=batch.round_trips)
 
     def _publish(self, msg):
-        self.logger.info(msg.json)
-        self.receive_channel.basic_publish(exchange='', routing_key=RECEIVE_QUEUE,
-                                           body=json.dumps(msg.json))
+        # json, including the base64 of images, and its encoding
+        with tracing.span('encode', msg_id=msg.msg_id):
+            body = msg.json
+            encoded = msg.encode(self.publish_serializer)
+        # never log the image payload
+        self.logger.info({k: v for k, v in body.items() if k != 'base64_content'})
+        PUBLISHED.inc(msg.msg_type.name)
+        PUBLISHED_BYTES.inc(amount=len(encoded))
+        # only waits while the publisher queue is full
+        with tracing.span('publish', msg_id=msg.msg_id):
+            self.publisher.publish(encoded)
 
     @staticmethod
     def _gen_remark_name(nickname):
         return nickname + str(random.randint(100, 999))
 
 
-def send(ch, method, properties, msg, webwx_client: WebWxClient):
-    msg = json.loads(msg.decode())
+def send(msg, webwx_client: WebWxClient):
+    """
+    :raise PermanentSendError: the event_type or msg_type is unknown or unsupported, the message is dead lettered
+    """
     webwx_client.logger.info(msg)
     to = msg['to_username']
-    event_type = EventType[msg['event_type']]
-    content = msg['content']
     try:
-        if event_type == EventType.SEND_MESSAGE:
+        event_type = EventType(msg['event_type'])
+    except ValueError:
+        raise PermanentSendError(f"Unknown event_type {msg['event_type']}")
+    content = msg['content']
+    if event_type == EventType.SEND_MESSAGE:
+        try:
             msg_type = MsgType(msg['msg_type'])
-            if msg_type == MsgType.TEXT:
-                webwx_client.webwxsendmsg(to, content)
-            elif msg_type == MsgType.IMAGE:
-                webwx_client.webwxsendmsgimg(to, content)
-            elif msg_type == MsgType.FILE:
-                webwx_client.webwxsendappmsg(to, content)
-        elif event_type == EventType.MODIFY_FRIEND_REMARK_NAME:
-            client.webwxoplog(to, content)
-        elif event_type == EventType.MODIFY_FRIEND_REMARK_NAME:
-            client.webwxupdatechatroom(to, content)
-    except Exception as e:
-        webwx_client.logger.error(e)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        except ValueError:
+            raise PermanentSendError(f"Unknown msg_type {msg['msg_type']}")
+        if msg_type == MsgType.TEXT:
+            return webwx_client.webwxsendmsg(to, content)
+        elif msg_type == MsgType.IMAGE:
+            return webwx_client.webwxsendmsgimg(to, content)
+        elif msg_type == MsgType.FILE:
+            return webwx_client.webwxsendappmsg(to, content)
+        raise PermanentSendError(f'Sending msg_type {msg_type.name} is not supported')
+    elif event_type == EventType.FETCH_FULL_IMAGE:
+        image_msg = webwx_client.fetch_full_image(content)
+        if image_msg is None:
+            return False
+        webwx_client.handle_image(image_msg)
+        return True
+    elif event_type == EventType.MODIFY_FRIEND_REMARK_NAME:
+        return webwx_client.webwxoplog(to, content)
+    elif event_type == EventType.MODIFY_CHATROOM_NAME:
+        return webwx_client.webwxupdatechatroom(to, content)
+    raise PermanentSendError(f'event_type {event_type.name} is not a send command')
 
 
 def consume(webwx_client):
-    cb = functools.partial(send, webwx_client=webwx_client)
-    conn = pika.BlockingConnection(pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT))
-    channel = conn.channel()
-    channel.queue_declare(queue=SEND_QUEUE)
-    channel.basic_consume(cb, queue=SEND_QUEUE)
-    channel.start_consuming()
+    engine = SendEngine(pika.ConnectionParameters(RABBIT_HOST, RABBIT_PORT), SEND_QUEUE,
+                        functools.partial(send, webwx_client=webwx_client),
+                        workers=SEND_WORKERS, prefetch_count=SEND_PREFETCH_COUNT,
+                        dead_letter_queue=SEND_DEAD_LETTER_QUEUE, max_attempts=SEND_MAX_ATTEMPTS,
+                        retry_base_delay=SEND_RETRY_BASE_DELAY, retry_max_delay=SEND_RETRY_MAX_DELAY)
+    engine.start()
 
 
 if __name__ == '__main__':
     with open('logging.yaml', 'rt') as f:
         config = yaml.safe_load(f.read())
     dictConfig(config)
+    if TRACING:
+        tracing.TRACER.enable()
+    # kill -USR1 <pid> profiles for PROFILE_SECONDS
+    tracing.install_signal_handler(PROFILE_SECONDS, PROFILE_DIR)
+    if METRICS_PORT:
+        metrics_server = metrics.MetricsServer(METRICS_PORT)
+        metrics_server.routes.update(tracing.debug_routes())
+        metrics_server.start()
     client = CustomClient()
     client.wait_for_login()
     threading.Thread(target=consume, args=[client]).start()
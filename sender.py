@@ -0,0 +1,260 @@
+import functools
+import heapq
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import List, Dict
+
+import pika
+
+from webwx import metrics, tracing
+from webwx.ratelimit import RateLimited
+
+SEND_SECONDS = metrics.histogram('chatbot_send_seconds', 'handler latency of a send queue message', ('result',))
+SEND_DEAD_LETTERED = metrics.counter('chatbot_send_dead_lettered_total',
+                                    'messages failed max_attempts times or malformed')
+SEND_RETRIES = metrics.counter('chatbot_send_retries_total', 'failed sends scheduled for a retry')
+SEND_RATE_LIMITED = metrics.counter('chatbot_send_rate_limited_total', 'sends deferred by the rate limiter')
+
+
+class PermanentSendError(Exception):
+    """
+    raised by a handler for a message that can never be sent, e.g. an unsupported event_type,
+    it is dead lettered at once instead of retried
+    """
+    pass
+
+
+class RetryScheduler:
+    """
+    delayed queue, callbacks are run on the scheduler thread once their delay elapsed
+    """
+
+    def __init__(self):
+        self._heap = []
+        # tie breaker, callbacks are not comparable
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='send-retry', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def schedule(self, delay, callback):
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), callback))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            callback()
+
+
+class _SendTask:
+    __slots__ = ('delivery_tag', 'msg', 'to', 'attempts', 'retrying', 'error')
+
+    def __init__(self, delivery_tag, msg):
+        self.delivery_tag = delivery_tag
+        self.msg = msg
+        self.to = msg['to_username']
+        self.attempts = 0
+        # the task failed before and blocks the later messages of its recipient
+        self.retrying = False
+        self.error = ''
+
+
+class SendEngine:
+    """
+    consume the send queue and run the handler on several worker threads
+
+    Every message of a recipient goes to the same worker so messages to one to_username keep their order,
+    while a slow upload only holds back the recipients sharing its worker. A message is acked only
+    after the handler succeeded or it was moved to the dead letter queue.
+
+    A failed message is retried with exponential backoff, later messages of its recipient are held
+    back until it is sent or dead lettered. A message the handler refused with RateLimited is deferred
+    the same way, without counting an attempt, so a rate limited recipient never holds its worker.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, connection_parameters: pika.ConnectionParameters, queue_name, handler,
+                 workers=4, prefetch_count=16, dead_letter_queue=None, max_attempts=5,
+                 retry_base_delay=2, retry_max_delay=300):
+        """
+        :param handler: called with the decoded message on a worker thread, a falsy result or
+                        an exception is a failure, PermanentSendError, ValueError and KeyError
+                        are not retried
+        :param workers: number of worker threads
+        :param prefetch_count: unacked messages the broker may push to this consumer
+        :param dead_letter_queue: queue receiving the malformed messages and the ones failed max_attempts times,
+                                  dropped if None
+        :param max_attempts: attempts before a message is dead lettered
+        :param retry_base_delay: seconds before the first retry, doubled on every further retry
+        :param retry_max_delay: upper bound of the retry delay in seconds
+        """
+        self.connection_parameters = connection_parameters
+        self.queue_name = queue_name
+        self.handler = handler
+        self.workers = workers
+        self.prefetch_count = prefetch_count
+        self.dead_letter_queue = dead_letter_queue
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.conn: pika.BlockingConnection = None
+        self.channel = None
+        self.retry_scheduler = RetryScheduler()
+        self.dead_lettered = 0
+        self._lanes: List[queue.Queue] = [queue.Queue() for _ in range(workers)]
+        # recipient -> messages held back behind a retrying one
+        self._blocked: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        metrics.QUEUE_DEPTH.set_function(lambda: self.pending, 'send')
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            blocked = sum(len(tasks) for tasks in self._blocked.values())
+        return sum(lane.qsize() for lane in self._lanes) + blocked + len(self.retry_scheduler)
+
+    def start(self):
+        """
+        consume until the connection is closed, blocks the calling thread
+        """
+        self.conn = pika.BlockingConnection(self.connection_parameters)
+        self.channel = self.conn.channel()
+        self.channel.queue_declare(queue=self.queue_name)
+        if self.dead_letter_queue:
+            self.channel.queue_declare(queue=self.dead_letter_queue)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self._start_workers()
+        self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message)
+        self.channel.start_consuming()
+
+    def _start_workers(self):
+        for i, lane in enumerate(self._lanes):
+            threading.Thread(target=self._work, args=[lane], name=f'send-worker-{i}', daemon=True).start()
+
+    def _on_message(self, ch, method, properties, body):
+        try:
+            msg = json.loads(body.decode())
+            if not isinstance(msg, dict) or not isinstance(msg.get('to_username'), str):
+                raise ValueError('not a json object with a to_username')
+            task = _SendTask(method.delivery_tag, msg)
+        except (ValueError, KeyError) as e:
+            self.logger.error(f'Malformed message {body}: {e}')
+            self._dead_letter(body.decode(errors='replace'), 0, repr(e))
+            self._ack(method.delivery_tag)
+            return
+        self._dispatch(task)
+
+    def _dispatch(self, task: _SendTask):
+        self._lanes[hash(task.to) % len(self._lanes)].put(task)
+
+    def _work(self, lane: queue.Queue):
+        while True:
+            task = lane.get()
+            if not task.retrying:
+                with self._lock:
+                    blocked = self._blocked.get(task.to)
+                    if blocked is not None:
+                        # an earlier message of the recipient is waiting for its retry
+                        blocked.append(task)
+                        continue
+            self._process(task)
+
+    def _process(self, task: _SendTask):
+        tasks = deque([task])
+        while tasks:
+            task = tasks.popleft()
+            try:
+                sent = self._send(task)
+            except RateLimited as e:
+                SEND_RATE_LIMITED.inc()
+                self._defer(task, tasks, e.delay)
+                return
+            if sent:
+                self._ack(task.delivery_tag)
+            elif task.attempts < self.max_attempts:
+                delay = min(self.retry_base_delay * 2 ** (task.attempts - 1), self.retry_max_delay)
+                self.logger.warning(f'Sending to {task.to} failed {task.attempts} times, retry in {delay}s')
+                SEND_RETRIES.inc()
+                self._defer(task, tasks, delay)
+                return
+            else:
+                self._dead_letter(task.msg, task.attempts, task.error)
+                self._ack(task.delivery_tag)
+            if task.retrying:
+                # release the messages held back by this one, in order, on this worker
+                with self._lock:
+                    tasks.extend(self._blocked.pop(task.to, ()))
+
+    def _defer(self, task: _SendTask, tasks: deque, delay):
+        """
+        dispatch task again in delay seconds, the later messages of its recipient are held back until then
+        :param tasks: messages released behind task, of the same recipient
+        """
+        with self._lock:
+            blocked = self._blocked.setdefault(task.to, deque())
+            # messages released behind this one go before the ones held back meanwhile
+            blocked.extendleft(reversed(tasks))
+        task.retrying = True
+        self.retry_scheduler.schedule(delay, functools.partial(self._dispatch, task))
+
+    def _send(self, task: _SendTask):
+        """
+        :raise RateLimited: nothing was sent, the attempt is not counted
+        """
+        task.attempts += 1
+        start = time.perf_counter()
+        try:
+            with tracing.span('send', to=task.to, event_type=task.msg.get('event_type'), attempt=task.attempts):
+                success = self.handler(task.msg)
+            if success:
+                SEND_SECONDS.observe(time.perf_counter() - start, 'success')
+                return True
+            task.error = 'webwx returned failure'
+        except RateLimited:
+            task.attempts -= 1
+            raise
+        except (PermanentSendError, ValueError, KeyError) as e:
+            # the message itself is invalid, retrying is useless
+            task.error = repr(e)
+            task.attempts = self.max_attempts
+        except Exception as e:
+            task.error = repr(e)
+        SEND_SECONDS.observe(time.perf_counter() - start, 'failure')
+        self.logger.error(f'Sending {task.msg} failed: {task.error}')
+        return False
+
+    def _dead_letter(self, msg, attempts, error):
+        """
+        :param msg: decoded message, or the body of a malformed one
+        :param attempts: 0 for a malformed message
+        """
+        self.dead_lettered += 1
+        SEND_DEAD_LETTERED.inc()
+        if not self.dead_letter_queue:
+            self.logger.error(f'Dropped {msg} after {attempts} attempts')
+            return
+        body = json.dumps({
+            'msg':      msg,
+            'attempts': attempts,
+            'error':    error
+        })
+        self.conn.add_callback_threadsafe(functools.partial(
+            self.channel.basic_publish, exchange='', routing_key=self.dead_letter_queue, body=body))
+
+    def _ack(self, delivery_tag):
+        # channels are not thread safe, ack on the connection's thread
+        self.conn.add_callback_threadsafe(functools.partial(self.channel.basic_ack, delivery_tag=delivery_tag))
@@ -0,0 +1,247 @@
+import logging
+import threading
+from typing import Dict
+
+from redis import StrictRedis
+
+from webwx.dedup import SeenBackend
+
+
+class RedisBatchWriter:
+    """
+    queue redis write commands on a pipeline and send them every batch_size commands
+
+    usage:
+        with RedisBatchWriter(r, 500) as batch:
+            batch.hset('key', 'field', 'value')
+    """
+
+    def __init__(self, r: StrictRedis, batch_size=500, transaction=False):
+        self.batch_size = batch_size
+        self.pipeline = r.pipeline(transaction=transaction)
+        self.queued = 0
+        # number of pipeline executions, i.e. network round trips
+        self.round_trips = 0
+        # (on_success, on_failure) of the commands queued since the last execution
+        self._callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.pipeline.reset()
+            self._settle(failed=True)
+
+    def after(self, on_success, on_failure):
+        """
+        register callbacks for the commands queued next, called once they are executed or discarded
+        """
+        self._callbacks.append((on_success, on_failure))
+
+    def set(self, name, value):
+        self.pipeline.set(name, value)
+        self._queued()
+
+    def hset(self, name, key, value):
+        self.pipeline.hset(name, key, value)
+        self._queued()
+
+    def hmset(self, name, mapping):
+        if not mapping:
+            return
+        self.pipeline.hset(name, mapping=mapping)
+        self._queued()
+
+    def hdel(self, name, *keys):
+        if not keys:
+            return
+        self.pipeline.hdel(name, *keys)
+        self._queued()
+
+    def delete(self, *names):
+        if not names:
+            return
+        self.pipeline.delete(*names)
+        self._queued()
+
+    def execute(self):
+        if not self.queued:
+            return []
+        self.queued = 0
+        self.round_trips += 1
+        try:
+            results = self.pipeline.execute()
+        except Exception:
+            self._settle(failed=True)
+            raise
+        self._settle(failed=False)
+        return results
+
+    def _settle(self, failed):
+        callbacks, self._callbacks = self._callbacks, []
+        for on_success, on_failure in callbacks:
+            (on_failure if failed else on_success)()
+
+    def _queued(self):
+        self.queued += 1
+        if self.queued >= self.batch_size:
+            self.execute()
+
+
+class RedisHashMirror:
+    """
+    fingerprints of the redis hash fields written by this process, so that only the fields whose
+    value actually changed are written again
+
+    Fingerprints are recorded once the batch they are queued on is executed. A failed batch forgets
+    the hashes it wrote, their next write sends every field again.
+    """
+
+    def __init__(self):
+        # hash name -> field -> fingerprint of the written value
+        self._fingerprints: Dict[str, Dict[str, int]] = {}
+        # hashes whose content is unknown after a failed batch
+        self._unknown = set()
+        self._lock = threading.Lock()
+
+    def write(self, batch: RedisBatchWriter, name, mapping, replace=False):
+        """
+        :param batch: writer the changed fields are queued on
+        :param name: hash name
+        :param mapping: field -> value
+        :param replace: mapping holds the whole hash, fields missing from it are deleted
+        :return: number of fields written or deleted
+        """
+        with self._lock:
+            fingerprints = self._fingerprints.get(name, {})
+            # the fields of a replaced hash left by a failed batch are not known, it is written from scratch
+            recreate = replace and name in self._unknown
+            staged = {}
+            changed = {}
+            for field, value in mapping.items():
+                fingerprint = hash(str(value))
+                if recreate or fingerprints.get(field) != fingerprint:
+                    staged[field] = fingerprint
+                    changed[field] = value
+            removed = [field for field in fingerprints if field not in mapping] if replace else []
+
+        def on_success():
+            with self._lock:
+                fingerprints = self._fingerprints.setdefault(name, {})
+                fingerprints.update(staged)
+                for field in removed:
+                    fingerprints.pop(field, None)
+                if recreate:
+                    self._unknown.discard(name)
+
+        if not changed and not removed and not recreate:
+            return 0
+        batch.after(on_success, lambda: self._forget(name))
+        if recreate:
+            batch.delete(name)
+        batch.hmset(name, changed)
+        batch.hdel(name, *removed)
+        return len(changed) + len(removed)
+
+    def hdel(self, batch: RedisBatchWriter, name, *fields):
+        with self._lock:
+            fingerprints = self._fingerprints.get(name, {})
+            for field in fields:
+                fingerprints.pop(field, None)
+        batch.hdel(name, *fields)
+
+    def clear(self):
+        with self._lock:
+            self._fingerprints.clear()
+            self._unknown.clear()
+
+    def _forget(self, name):
+        with self._lock:
+            self._fingerprints.pop(name, None)
+            self._unknown.add(name)
+
+
+class RedisKeyspace:
+    """
+    generation namespaced key layout
+
+    Every process writes under <prefix>:<generation>:, the pointer <prefix>:generation is flipped to it
+    once the login data are completely persisted, so readers never see a half written or half cleared
+    state. Older generations are reclaimed in a background thread with SCAN + UNLINK.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, r: StrictRedis, prefix='chatbot', reclaim_batch_size=500):
+        self.r = r
+        self.prefix = prefix
+        self.reclaim_batch_size = reclaim_batch_size
+        self.generation = r.incr(prefix + ':generation:seq')
+        self._reclaim_thread = None
+
+    @property
+    def pointer(self):
+        return self.prefix + ':generation'
+
+    def key(self, name):
+        return f'{self.prefix}:{self.generation}:{name}'
+
+    def activate(self):
+        """
+        point readers at this generation and start reclaiming the older ones
+        """
+        # GET and SET in one MULTI instead of SET ... GET, which needs redis 6.2 and redis-py 4
+        pipeline = self.r.pipeline(transaction=True)
+        pipeline.get(self.pointer)
+        pipeline.set(self.pointer, self.generation)
+        previous, _ = pipeline.execute()
+        if previous == str(self.generation):
+            return
+        self.logger.info(f'Redis generation {previous} -> {self.generation}')
+        self._reclaim_thread = threading.Thread(target=self.reclaim, name='redis-reclaim', daemon=True)
+        self._reclaim_thread.start()
+
+    def reclaim(self):
+        """
+        unlink the keys of every generation older than this one, and the keys of the layout
+        without generation
+        """
+        keys = []
+        for key in self.r.scan_iter(self.prefix + ':*', count=self.reclaim_batch_size):
+            if self._is_stale(key):
+                keys.append(key)
+                if len(keys) >= self.reclaim_batch_size:
+                    self.r.unlink(*keys)
+                    keys = []
+        if keys:
+            self.r.unlink(*keys)
+
+    def _is_stale(self, key):
+        segment = key[len(self.prefix) + 1:].split(':', 1)[0]
+        if segment == 'generation':
+            return False
+        if segment == 'client':
+            # layout without generation
+            return True
+        # newer generations belong to a process started after this one
+        return segment.isdigit() and int(segment) < self.generation
+
+
+class RedisSeenSet(SeenBackend):
+    """
+    MsgIds received in the last ttl seconds, one SET NX EX key each, outside of the generations
+    so a restarted process still drops the entries replayed to it
+    """
+
+    def __init__(self, r: StrictRedis, prefix='chatbot:seen', ttl=24 * 3600):
+        self.r = r
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def add_many(self, msg_ids):
+        pipeline = self.r.pipeline(transaction=False)
+        for msg_id in msg_ids:
+            pipeline.set(f'{self.prefix}:{msg_id}', 1, nx=True, ex=self.ttl)
+        return [bool(result) for result in pipeline.execute()]
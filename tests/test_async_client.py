@@ -0,0 +1,54 @@
+import asyncio
+import inspect
+import unittest
+
+from webwx.async_client import AsyncWebWxClient
+from webwx.client import WebWxClient
+from webwx.models import ChatroomMember
+
+# callbacks implemented on the wrapped client, and the helpers the processing loop calls on it
+NOT_WRAPPED = {'after_login', 'apply_init', 'apply_sync', 'conversation_of', 'usernames_of',
+               'handle_add_msg', 'handle_add_msg_list'}
+
+
+def public_methods(cls):
+    return {name: member for name, member in inspect.getmembers(cls, inspect.isfunction)
+            if not name.startswith('_')}
+
+
+class AsyncWebWxClientTest(unittest.TestCase):
+
+    def test_every_public_method_has_a_coroutine(self):
+        wrapped = public_methods(AsyncWebWxClient)
+        for name, method in public_methods(WebWxClient).items():
+            if name in NOT_WRAPPED or name.startswith('handle_'):
+                continue
+            with self.subTest(name):
+                self.assertIn(name, wrapped)
+                self.assertTrue(inspect.iscoroutinefunction(wrapped[name]))
+                self.assertEqual(list(inspect.signature(method).parameters),
+                                 list(inspect.signature(wrapped[name]).parameters))
+
+    def test_wrappers_call_the_client(self):
+        client = WebWxClient()
+        chatroom = client.contact_store.upsert({'UserName': '@@room', 'HeadImgUrl': '', 'NickName': 'room',
+                                                'RemarkName': '', 'Sex': 0, 'VerifyFlag': 0})
+        client.contact_store.set_chatroom_members(chatroom, [
+            ChatroomMember({'UserName': '@alice', 'NickName': 'Alice', 'DisplayName': 'Ali'})])
+        async_client = AsyncWebWxClient(client)
+
+        async def run():
+            return (await async_client.get_user_nickname_in_chatroom('@alice', '@@room'),
+                    await async_client.get_chatrooms_of_user('@alice'))
+
+        loop = asyncio.new_event_loop()
+        try:
+            nickname, chatrooms = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual('Ali', nickname)
+        self.assertEqual([chatroom], list(chatrooms))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import fakeredis
+
+from storage import RedisSeenSet
+from webwx import metrics
+from webwx.dedup import SEEN_MSGS, SeenBackend, SeenWindow
+
+
+def entries(*msg_ids):
+    return [{'MsgId': msg_id} for msg_id in msg_ids]
+
+
+def msg_ids(add_msg_list):
+    return [add_msg['MsgId'] for add_msg in add_msg_list]
+
+
+class CountingBackend(SeenBackend):
+    def __init__(self, backend: SeenBackend):
+        self.backend = backend
+        self.asked = []
+
+    def add_many(self, msg_ids):
+        self.asked.append(list(msg_ids))
+        return self.backend.add_many(msg_ids)
+
+
+class FailingBackend(SeenBackend):
+    def add_many(self, msg_ids):
+        raise ConnectionError('redis is down')
+
+
+class SeenWindowTest(unittest.TestCase):
+
+    def test_duplicates_dropped_in_order(self):
+        window = SeenWindow(10)
+        self.assertEqual(['1', '2', '3'], msg_ids(window.filter(entries('1', '2', '1', '3'))))
+        self.assertEqual(['4'], msg_ids(window.filter(entries('2', '4', '3'))))
+        self.assertEqual((3, 4), (window.hits, window.misses))
+
+    def test_oldest_evicted_beyond_max_size(self):
+        window = SeenWindow(3)
+        window.filter(entries('1', '2', '3', '4'))
+        self.assertEqual(3, len(window))
+        self.assertNotIn('1', window)
+        self.assertEqual(['1'], msg_ids(window.filter(entries('1', '4'))))
+        # 1 came back, 2 is the oldest now
+        self.assertNotIn('2', window)
+        self.assertEqual(['3', '4', '1'], list(window._ring))
+        self.assertEqual(set(window._ring), window._seen)
+
+    def test_clear(self):
+        window = SeenWindow(3)
+        window.filter(entries('1'))
+        window.clear()
+        self.assertEqual(['1'], msg_ids(window.filter(entries('1'))))
+
+
+class SeenWindowBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r = fakeredis.FakeStrictRedis(decode_responses=True)
+
+    def backend(self):
+        return CountingBackend(RedisSeenSet(self.r, ttl=60))
+
+    def test_redis_set_nx_ex(self):
+        seen_set = RedisSeenSet(self.r, prefix='seen', ttl=60)
+        self.assertEqual([True, True], seen_set.add_many(['1', '2']))
+        self.assertEqual([False, True], seen_set.add_many(['1', '3']))
+        self.assertTrue(0 < self.r.ttl('seen:1') <= 60)
+
+    def test_duplicates_across_processes(self):
+        before = SeenWindow(10, self.backend())
+        self.assertEqual(['1', '2'], msg_ids(before.filter(entries('1', '2'))))
+
+        # a restarted process replayed the entries of the former one
+        backend = self.backend()
+        after = SeenWindow(10, backend)
+        self.assertEqual(['3'], msg_ids(after.filter(entries('1', '2', '3'))))
+        self.assertEqual(2, after.hits)
+        # the backend hits are remembered in memory, redis is not asked again
+        self.assertEqual([], msg_ids(after.filter(entries('1', '2', '3'))))
+        self.assertEqual([['1', '2', '3']], backend.asked)
+
+    def test_memory_hits_do_not_reach_the_backend(self):
+        backend = self.backend()
+        window = SeenWindow(10, backend)
+        window.filter(entries('1', '1'))
+        window.filter(entries('1', '2'))
+        self.assertEqual([['1'], ['2']], backend.asked)
+
+    def test_failing_backend_falls_back_to_memory(self):
+        window = SeenWindow(10, FailingBackend())
+        self.assertEqual(['1'], msg_ids(window.filter(entries('1'))))
+        self.assertEqual([], msg_ids(window.filter(entries('1'))))
+
+
+class SeenMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.enabled = metrics.REGISTRY.enabled
+        metrics.REGISTRY.enable()
+
+    def tearDown(self):
+        metrics.REGISTRY.enabled = self.enabled
+
+    def test_results_counted(self):
+        before = dict(SEEN_MSGS._values)
+        r = fakeredis.FakeStrictRedis(decode_responses=True)
+        RedisSeenSet(r).add_many(['1'])
+        window = SeenWindow(10, RedisSeenSet(r))
+        window.filter(entries('1', '2', '2'))
+
+        counted = {labels[0]: value - before.get(labels, 0) for labels, value in SEEN_MSGS._values.items()}
+        self.assertEqual({'new': 1, 'duplicate': 1, 'duplicate_backend': 1}, counted)
+        self.assertIn('chatbot_seen_msgs_total{result="new"}', metrics.REGISTRY.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
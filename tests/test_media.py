@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+import unittest
+from collections import defaultdict
+
+from webwx.media import MediaFetcher
+
+
+class MediaFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fetcher = MediaFetcher(max_workers=4)
+        # conversation -> seqs in the order they were delivered
+        self.delivered = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.fetcher.shutdown()
+
+    def deliver(self, conversation, seq, *content):
+        with self.lock:
+            self.delivered[conversation].append(seq)
+
+    def submit(self, conversation, seq, delay=None, fail=False):
+        """
+        :param delay: seconds the download takes, None for a message without media
+        """
+
+        def fetch():
+            time.sleep(delay)
+            if fail:
+                raise IOError('download failed')
+            return b'content'
+
+        deliver = lambda *content: self.deliver(conversation, seq, *content)
+        self.fetcher.submit(conversation, deliver, None if delay is None else fetch)
+
+    def test_conversation_order_kept_with_slow_downloads(self):
+        rand = random.Random(0)
+        expected = defaultdict(list)
+        for seq in range(200):
+            conversation = f'@conversation{rand.randrange(5)}'
+            # later downloads often finish before earlier ones
+            delay = rand.choice([None, 0, 0.001, 0.005, 0.02])
+            self.submit(conversation, seq, delay)
+            expected[conversation].append(seq)
+
+        self.assertTrue(self.fetcher.join(10))
+        self.assertEqual(dict(expected), dict(self.delivered))
+        self.assertEqual(0, self.fetcher.pending)
+
+    def test_failed_download_is_skipped_without_blocking(self):
+        self.submit('@a', 0, 0.02, fail=True)
+        self.submit('@a', 1)
+        self.submit('@a', 2, 0)
+        self.submit('@b', 3)
+
+        self.assertTrue(self.fetcher.join(10))
+        self.assertEqual({'@a': [1, 2], '@b': [3]}, dict(self.delivered))
+
+    def test_message_without_media_waits_for_earlier_download(self):
+        self.submit('@a', 0, 0.05)
+        self.submit('@a', 1)
+        # delivered on the caller's thread, nothing is pending in its conversation
+        self.submit('@b', 2)
+        self.assertEqual({'@b': [2]}, dict(self.delivered))
+
+        self.assertTrue(self.fetcher.join(10))
+        self.assertEqual([0, 1], self.delivered['@a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
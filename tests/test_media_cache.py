@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from webwx.client import WebWxClient
+from webwx.media_cache import MediaIdCache
+
+
+class MediaIdCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_evicted(self):
+        cache = MediaIdCache(max_entries=2)
+        cache.put('a', None, 'mid-a', 1)
+        cache.put('b', None, 'mid-b', 1)
+        self.assertEqual('mid-a', cache.get('a').media_id)
+        cache.put('c', None, 'mid-c', 1)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('mid-a', cache.get('a').media_id)
+        self.assertEqual('mid-c', cache.get('c').media_id)
+
+    def test_expired_after_ttl(self):
+        cache = MediaIdCache(ttl=60)
+        now = time.monotonic()
+        with mock.patch('webwx.media_cache.time.monotonic', return_value=now):
+            cache.put('a', None, 'mid-a', 1)
+        with mock.patch('webwx.media_cache.time.monotonic', return_value=now + 59):
+            self.assertEqual('mid-a', cache.get('a').media_id)
+        with mock.patch('webwx.media_cache.time.monotonic', return_value=now + 61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_content_hash_hit_aliases_url(self):
+        cache = MediaIdCache()
+        cache.put('/tmp/a.jpg', 'sha', 'mid', 1)
+        self.assertEqual('mid', cache.get('/tmp/b.jpg', 'sha').media_id)
+        self.assertEqual('mid', cache.get('/tmp/b.jpg').media_id)
+        # the content behind a path changed
+        self.assertIsNone(cache.get('/tmp/a.jpg', 'other'))
+
+    def test_invalidate_drops_every_key_of_the_entry(self):
+        cache = MediaIdCache()
+        entry = cache.put('/tmp/a.jpg', 'sha', 'mid', 1)
+        cache.get('/tmp/b.jpg', 'sha')
+        cache.put('/tmp/c.jpg', None, 'mid-c', 1)
+        cache.invalidate(entry)
+
+        self.assertIsNone(cache.get('/tmp/a.jpg'))
+        self.assertIsNone(cache.get('/tmp/b.jpg'))
+        self.assertIsNone(cache.get('/tmp/a.jpg', 'sha'))
+        self.assertEqual('mid-c', cache.get('/tmp/c.jpg').media_id)
+
+    def test_concurrent_misses_upload_once(self):
+        cache = MediaIdCache()
+        uploads = []
+
+        def upload():
+            uploads.append(1)
+            time.sleep(0.05)
+            return 'mid', 1, 'sha'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_upload('a', upload)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(uploads))
+        self.assertEqual(['mid'] * 4, [entry.media_id for entry, _ in results])
+        self.assertEqual([False, True, True, True], sorted(cached for _, cached in results))
+
+    def test_failed_upload_not_cached(self):
+        cache = MediaIdCache()
+        self.assertEqual((None, False), cache.get_or_upload('a', lambda: (None, 0, None)))
+        self.assertEqual(0, len(cache))
+
+
+class SendMediaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = WebWxClient()
+        self.uploads = 0
+
+        def upload(file_url, digest):
+            self.uploads += 1
+            return f'mid{self.uploads}', 1
+
+        self.client._webwxuploadmedia = upload
+        # BaseResponse.Ret of the next sends, and the MediaIds they used
+        self.rets = []
+        self.sent = []
+
+    def send(self, to_username, file_url, media):
+        self.sent.append(media.media_id)
+        return self.rets.pop(0)
+
+    def send_media(self, *rets):
+        self.rets = list(rets)
+        return self.client._send_media('@a', 'http://host/a.jpg', self.send)
+
+    def test_cached_media_id_reused(self):
+        self.assertTrue(self.send_media(0))
+        self.assertTrue(self.send_media(0))
+        self.assertEqual(1, self.uploads)
+        self.assertEqual(['mid1', 'mid1'], self.sent)
+
+    def test_other_failures_keep_the_cached_media_id(self):
+        self.send_media(0)
+        # e.g. throttled, left to the send engine's retry
+        self.assertFalse(self.send_media(1205))
+        self.assertTrue(self.send_media(0))
+        self.assertEqual(1, self.uploads)
+
+    def test_rejected_media_id_uploaded_and_sent_once_more(self):
+        self.send_media(0)
+        self.assertTrue(self.send_media(1, 0))
+        self.assertEqual(['mid1', 'mid1', 'mid2'], self.sent)
+
+        self.assertFalse(self.send_media(1, 1))
+        self.assertEqual(3, self.uploads)
+        self.assertEqual([], self.rets)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from webwx.models import ChatRoom, ChatroomMember, Friend, Msg, TextMsg
+
+
+def member(username, nickname, display_name=''):
+    return ChatroomMember({'UserName': username, 'NickName': nickname, 'DisplayName': display_name})
+
+
+class MentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chatroom = ChatRoom({'UserName': '@@room', 'HeadImgUrl': '', 'NickName': 'room', 'RemarkName': '',
+                                  'Sex': 0})
+        self.chatroom.set_members([
+            member('@alice', 'Alice', 'Ali'),
+            member('@bob', 'Bob'),
+            member('@bobby', 'Bob Jr'),
+            member('@carol', 'Carol', 'Bob'),
+        ])
+        self.sender = Friend({'UserName': '@sender', 'HeadImgUrl': '', 'NickName': 'sender', 'RemarkName': '',
+                              'Sex': 0})
+
+    def mentions(self, text):
+        msg = Msg('1', self.sender, self.chatroom, text, 1500000000)
+        return TextMsg(msg, text, self.chatroom).mentioned_usernames
+
+    def test_display_name_and_nickname(self):
+        self.assertEqual(['@alice'], self.mentions('@Ali\u2005hi'))
+        # the nickname still works when a display name is set
+        self.assertEqual(['@alice'], self.mentions('@Alice\u2005hi'))
+
+    def test_every_member_sharing_a_name(self):
+        # Bob is the nickname of @bob and the display name of @carol
+        self.assertEqual(['@bob', '@carol'], self.mentions('@Bob\u2005hi'))
+
+    def test_terminators(self):
+        for terminator in (' ', '\u2005', '\ufe0f'):
+            with self.subTest(terminator=repr(terminator)):
+                self.assertEqual(['@alice'], self.mentions(f'@Alice{terminator}hi'))
+        self.assertEqual(['@alice'], self.mentions('hi @Alice'))
+        # a name must be followed by a terminator or the end of the text
+        self.assertEqual([], self.mentions('@Alicehi'))
+        self.assertEqual([], self.mentions('mail@Alice.com'))
+
+    def test_longest_name_wins(self):
+        self.assertEqual(['@bobby'], self.mentions('@Bob Jr\u2005hi'))
+        # Ali is a prefix of Alice
+        self.assertEqual(['@alice'], self.mentions('@Alice hi'))
+        self.assertEqual(['@bob', '@carol'], self.mentions('@Bob Sr\u2005hi'))
+
+    def test_several_mentions_in_order_without_duplicates(self):
+        self.assertEqual(['@bobby', '@alice'], self.mentions('@Bob Jr\u2005@Ali\u2005@Alice\u2005hi'))
+
+    def test_not_in_chatroom(self):
+        msg = Msg('1', self.sender, self.sender, '@Alice hi', 1500000000)
+        self.assertEqual([], TextMsg(msg, '@Alice hi').mentioned_usernames)
+
+    def test_index_rebuilt_after_member_update(self):
+        self.assertEqual([], self.mentions('@Dave\u2005hi'))
+        self.chatroom.add_member(member('@dave', 'Dave'))
+        self.assertEqual(['@dave'], self.mentions('@Dave\u2005hi'))
+
+        self.chatroom.set_members([member('@erin', 'Erin', 'Ali')])
+        self.assertEqual(['@erin'], self.mentions('@Ali\u2005hi'))
+        self.assertEqual([], self.mentions('@Dave\u2005hi'))
+
+        self.chatroom.clear_members()
+        self.assertEqual([], self.mentions('@Ali\u2005hi'))
+
+
+if __name__ == '__main__':
+    unittest.main()
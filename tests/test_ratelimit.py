@@ -0,0 +1,44 @@
+import unittest
+
+from webwx.ratelimit import RateLimited, SendRateLimiter, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_refill_up_to_capacity(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = bucket._updated_at
+        for _ in range(2):
+            self.assertEqual(0, bucket.wait_time(now))
+            bucket.take()
+        self.assertAlmostEqual(0.5, bucket.wait_time(now))
+        self.assertEqual(0, bucket.wait_time(now + 0.5))
+        self.assertEqual(0, bucket.wait_time(now + 100))
+        self.assertEqual(2, bucket._tokens)
+
+
+class SendRateLimiterTest(unittest.TestCase):
+
+    def test_refused_send_takes_no_token(self):
+        limiter = SendRateLimiter(rate=100, burst=100, recipient_rate=0.5, recipient_burst=2)
+        self.assertEqual(0, limiter.acquire('@a'))
+        self.assertEqual(0, limiter.acquire('@a'))
+        delay = limiter.acquire('@a')
+        self.assertGreater(delay, 1.9)
+        # refusals do not push the recipient further back
+        self.assertLessEqual(limiter.acquire('@a'), delay)
+        # nor take tokens of the account
+        self.assertEqual(98, int(limiter._account._tokens))
+        self.assertEqual(0, limiter.acquire('@b'))
+
+    def test_check_raises_without_blocking(self):
+        limiter = SendRateLimiter(rate=0.1, burst=1, recipient_rate=10, recipient_burst=10)
+        limiter.check('@a')
+        with self.assertRaises(RateLimited) as cm:
+            limiter.check('@b')
+        self.assertEqual('@b', cm.exception.to_username)
+        self.assertGreater(cm.exception.delay, 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
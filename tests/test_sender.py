@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+import unittest
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pika
+
+from sender import PermanentSendError, SendEngine
+from webwx.ratelimit import RateLimited
+
+
+class FakeConnection:
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+
+class FakeChannel:
+    def __init__(self):
+        self.acked = []
+        self.dead_lettered = []
+        self._lock = threading.Lock()
+        self.done = threading.Condition(self._lock)
+
+    def basic_ack(self, delivery_tag):
+        with self.done:
+            self.acked.append(delivery_tag)
+            self.done.notify_all()
+
+    def basic_publish(self, exchange, routing_key, body):
+        with self._lock:
+            self.dead_lettered.append(json.loads(body))
+
+    def wait_acked(self, count, timeout=10):
+        with self.done:
+            return self.done.wait_for(lambda: len(self.acked) >= count, timeout)
+
+
+class SendEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        # msg seq -> times the handler must still fail it
+        self.failures = {}
+        # recipient -> seqs in the order they were sent
+        self.sent = defaultdict(list)
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def handler(self, msg):
+        seq = msg['seq']
+        with self.lock:
+            self.calls[seq] += 1
+            failure = self.failures.get(seq, 0)
+            if failure == 'permanent':
+                raise PermanentSendError('unsupported')
+            if failure == 'rate_limited':
+                self.failures[seq] = 0
+                raise RateLimited(msg['to_username'], 0.2)
+            if failure:
+                self.failures[seq] = failure - 1
+                return False
+            self.sent[msg['to_username']].append(seq)
+        # let the other lanes interleave
+        time.sleep(0.001)
+        return True
+
+    def start_engine(self, **kwargs):
+        kwargs = dict(dict(workers=3, dead_letter_queue='dead', max_attempts=3, retry_base_delay=0.01,
+                           retry_max_delay=0.05), **kwargs)
+        engine = SendEngine(pika.ConnectionParameters(), 'send', self.handler, **kwargs)
+        engine.conn = FakeConnection()
+        engine.channel = FakeChannel()
+        engine._start_workers()
+        return engine
+
+    @staticmethod
+    def publish(engine, messages):
+        for tag, msg in enumerate(messages, 1):
+            engine._on_message(engine.channel, SimpleNamespace(delivery_tag=tag), None, json.dumps(msg).encode())
+
+    @staticmethod
+    def gen_messages(recipients, count):
+        return [{'to_username': recipients[seq % len(recipients)], 'seq': seq} for seq in range(count)]
+
+    def expected_order(self, messages, skipped=()):
+        order = defaultdict(list)
+        for msg in messages:
+            if msg['seq'] not in skipped:
+                order[msg['to_username']].append(msg['seq'])
+        return dict(order)
+
+    def test_recipient_order_kept_under_retry(self):
+        messages = self.gen_messages(['@a', '@b', '@c', '@d', '@e'], 100)
+        # failed then retried while later messages of the same recipients keep arriving
+        self.failures = {0: 2, 7: 1, 12: 1, 13: 2, 50: 1}
+        engine = self.start_engine()
+        self.publish(engine, messages)
+
+        self.assertTrue(engine.channel.wait_acked(len(messages)))
+        self.assertEqual(self.expected_order(messages), dict(self.sent))
+        self.assertEqual(3, self.calls[0])
+        self.assertEqual(0, engine.dead_lettered)
+        self.assertEqual(0, engine.pending)
+
+    def test_dead_lettered_after_max_attempts_releases_recipient(self):
+        messages = self.gen_messages(['@a', '@b'], 20)
+        self.failures = {4: 100}
+        engine = self.start_engine()
+        self.publish(engine, messages)
+
+        self.assertTrue(engine.channel.wait_acked(len(messages)))
+        self.assertEqual(self.expected_order(messages, skipped={4}), dict(self.sent))
+        self.assertEqual(3, self.calls[4])
+        self.assertEqual([4], [dead['msg']['seq'] for dead in engine.channel.dead_lettered])
+
+    def test_permanent_error_is_not_retried(self):
+        messages = self.gen_messages(['@a'], 5)
+        self.failures = {1: 'permanent'}
+        engine = self.start_engine()
+        self.publish(engine, messages)
+
+        self.assertTrue(engine.channel.wait_acked(len(messages)))
+        self.assertEqual(1, self.calls[1])
+        self.assertEqual({'@a': [0, 2, 3, 4]}, dict(self.sent))
+        self.assertEqual(1, len(engine.channel.dead_lettered))
+
+    def test_rate_limited_recipient_does_not_hold_its_worker(self):
+        # a single worker, @b shares it with the rate limited @a
+        engine = self.start_engine(workers=1)
+        messages = [{'to_username': '@a', 'seq': 0}, {'to_username': '@a', 'seq': 1},
+                    {'to_username': '@b', 'seq': 2}, {'to_username': '@b', 'seq': 3}]
+        self.failures = {0: 'rate_limited'}
+        self.publish(engine, messages)
+
+        self.assertTrue(engine.channel.wait_acked(2, timeout=0.15))
+        self.assertEqual({'@b': [2, 3]}, dict(self.sent))
+        self.assertTrue(engine.channel.wait_acked(len(messages)))
+        self.assertEqual(self.expected_order(messages), dict(self.sent))
+        # waiting for a token is not a failed attempt
+        self.assertEqual([], engine.channel.dead_lettered)
+        self.assertEqual(2, self.calls[0])
+
+    def test_malformed_messages_are_dead_lettered(self):
+        engine = self.start_engine()
+        bodies = [b'"hello"', b'[1]', b'{"seq": 1}', b'{"to_username": ["@a"]}', b'not json', b'\xff']
+        for tag, body in enumerate(bodies, 1):
+            engine._on_message(engine.channel, SimpleNamespace(delivery_tag=tag), None, body)
+        self.publish(engine, self.gen_messages(['@a'], 1))
+
+        self.assertTrue(engine.channel.wait_acked(len(bodies) + 1))
+        self.assertEqual({'@a': [0]}, dict(self.sent))
+        dead = engine.channel.dead_lettered
+        self.assertEqual([body.decode(errors='replace') for body in bodies], [d['msg'] for d in dead])
+        self.assertEqual({0}, {d['attempts'] for d in dead})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+
+import fakeredis
+from redis.exceptions import ConnectionError
+
+from storage import RedisBatchWriter, RedisHashMirror
+
+
+class FailingRedis(fakeredis.FakeStrictRedis):
+    """
+    pipelines fail while failing is set, as if the connection dropped
+    """
+    failing = False
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipeline = super().pipeline(transaction, shard_hint)
+        execute = pipeline.execute
+
+        def failing_execute(*args, **kwargs):
+            if self.failing:
+                raise ConnectionError('connection lost')
+            return execute(*args, **kwargs)
+
+        pipeline.execute = failing_execute
+        return pipeline
+
+
+class RedisHashMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r = FailingRedis(decode_responses=True)
+        self.mirror = RedisHashMirror()
+
+    def write(self, name, mapping, replace=False, batch_size=500):
+        with RedisBatchWriter(self.r, batch_size) as batch:
+            return self.mirror.write(batch, name, mapping, replace)
+
+    def test_unchanged_fields_are_skipped(self):
+        self.assertEqual(2, self.write('h', {'a': 1, 'b': 2}))
+        self.assertEqual(1, self.write('h', {'a': 1, 'b': 3}))
+        self.assertEqual(0, self.write('h', {'a': 1, 'b': 3}))
+        self.assertEqual({'a': '1', 'b': '3'}, self.r.hgetall('h'))
+
+    def test_fields_rewritten_after_failed_batch(self):
+        self.r.failing = True
+        with self.assertRaises(ConnectionError):
+            self.write('h', {'a': 1, 'b': 2})
+        self.r.failing = False
+
+        self.assertEqual(2, self.write('h', {'a': 1, 'b': 2}))
+        self.assertEqual({'a': '1', 'b': '2'}, self.r.hgetall('h'))
+
+    def test_fields_rewritten_after_discarded_batch(self):
+        with self.assertRaises(RuntimeError):
+            with RedisBatchWriter(self.r) as batch:
+                self.mirror.write(batch, 'h', {'a': 1})
+                raise RuntimeError('interrupted')
+
+        self.assertEqual(1, self.write('h', {'a': 1}))
+        self.assertEqual({'a': '1'}, self.r.hgetall('h'))
+
+    def test_flushed_part_of_failed_batch_is_kept(self):
+        with self.assertRaises(ConnectionError):
+            with RedisBatchWriter(self.r, batch_size=1) as batch:
+                self.mirror.write(batch, 'flushed', {'a': 1})
+                self.r.failing = True
+                self.mirror.write(batch, 'failed', {'a': 1})
+        self.r.failing = False
+
+        self.assertEqual(0, self.write('flushed', {'a': 1}))
+        self.assertEqual(1, self.write('failed', {'a': 1}))
+
+    def test_replaced_hash_recreated_after_failed_batch(self):
+        self.write('h', {'a': 1, 'b': 2}, replace=True)
+        self.r.failing = True
+        with self.assertRaises(ConnectionError):
+            self.write('h', {'a': 1, 'c': 3}, replace=True)
+        self.r.failing = False
+
+        # b is not known to the mirror anymore, yet deleted
+        self.write('h', {'a': 1}, replace=True)
+        self.assertEqual({'a': '1'}, self.r.hgetall('h'))
+        self.assertEqual(0, self.write('h', {'a': 1}, replace=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
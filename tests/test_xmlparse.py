@@ -0,0 +1,109 @@
+import unittest
+
+from benchmarks import xmlparse as bench
+from webwx import xmlparse
+from webwx.enums import MsgType
+from webwx.models import EmotionMsg, Friend, LinkMsg, Msg
+
+LINK_XML = '<msg><appmsg appid="" sdkver="0"><title>今天晚上一起吃饭吗</title><des>我在公司楼下等你</des>' \
+           '<action></action><type>5</type><showtype>0</showtype><content></content>' \
+           '<url>http://mp.weixin.qq.com/s?__biz=MzA5&amp;mid=2650&amp;idx=1&amp;sn=abcdef</url>' \
+           '<thumburl>http://mmbiz.qpic.cn/mmbiz_jpg/abcdef/0</thumburl>' \
+           '<mmreader><category type="20" count="1"><name>公众号</name>' \
+           '<item><title>another article</title><url>http://mp.weixin.qq.com/s?sn=other</url></item>' \
+           '</category></mmreader></appmsg><fromusername>gh_abcdef</fromusername></msg>'
+
+
+class XmlParseTest(unittest.TestCase):
+
+    def test_find_texts_by_path(self):
+        values = xmlparse.find_texts(LINK_XML, ('appmsg/type', 'appmsg/title', 'item/title', 'fromusername'))
+        self.assertEqual({'appmsg/type': '5', 'appmsg/title': '今天晚上一起吃饭吗', 'item/title': 'another article',
+                          'fromusername': 'gh_abcdef'}, values)
+
+    def test_first_match_wins(self):
+        self.assertEqual({'title': '今天晚上一起吃饭吗'}, xmlparse.find_texts(LINK_XML, ('title',)))
+
+    def test_missing_paths_left_out(self):
+        self.assertEqual({'appmsg/des': '我在公司楼下等你'},
+                         xmlparse.find_texts(LINK_XML, ('appmsg/des', 'appmsg/lowurl', 'msg/des')))
+
+    def test_entities_and_cdata_unescaped(self):
+        xml = '<msg><appmsg><title>a &lt;b&gt; &amp; &#x4e2d;</title><des><![CDATA[<i>raw</i> &amp;]]></des>' \
+              '</appmsg></msg>'
+        self.assertEqual({'appmsg/title': 'a <b> & 中', 'appmsg/des': '<i>raw</i> &amp;'},
+                         xmlparse.find_texts(xml, ('appmsg/title', 'appmsg/des')))
+        self.assertEqual({'cdnurl': 'http://host/?a=1&b=2'},
+                         xmlparse.find_attrs('<msg><emoji cdnurl="http://host/?a=1&amp;b=2"/></msg>', 'emoji'))
+
+    def test_malformed_keeps_values_found_before_the_error(self):
+        truncated = LINK_XML[:LINK_XML.index('<type>') + 8]
+        self.assertEqual({'appmsg/title': '今天晚上一起吃饭吗'},
+                         xmlparse.find_texts(truncated, ('appmsg/title', 'appmsg/type', 'appmsg/url')))
+        self.assertEqual({}, xmlparse.find_texts('not xml at all', ('title',)))
+        self.assertEqual({}, xmlparse.find_texts('', ('title',)))
+        self.assertEqual({}, xmlparse.find_attrs('<msg><emoji cdnurl="x></msg>', 'emoji'))
+        self.assertEqual({}, xmlparse.find_texts('<msg><title>a &unknown; b</title></msg>', ('title',)))
+
+    def test_find_attrs(self):
+        xml = '<msg><appmsg><emoji cdnurl="nested"/></appmsg><emoji cdnurl="top"/></msg>'
+        self.assertEqual({'cdnurl': 'nested'}, xmlparse.find_attrs(xml, 'emoji'))
+        self.assertEqual({'cdnurl': 'top'}, xmlparse.find_attrs(xml, 'msg/emoji'))
+        self.assertEqual({}, xmlparse.find_attrs(xml, 'img'))
+
+    def test_same_values_as_the_former_minidom_parsing(self):
+        # the minidom parsing replaced by xmlparse, kept by the benchmark as its baseline
+        for name, xml, former, current in (('login', bench.LOGIN_XML, bench.login_minidom, bench.login_xmlparse),
+                                           ('emotion', bench.EMOTION_XML, bench.emotion_minidom,
+                                            bench.emotion_xmlparse),
+                                           ('link', bench.LINK_XML, bench.link_minidom, bench.link_xmlparse),
+                                           ('link', LINK_XML, bench.link_minidom, bench.link_xmlparse)):
+            with self.subTest(name):
+                self.assertEqual(former(xml), current(xml))
+
+    def test_msg_xml(self):
+        self.assertEqual('<msg></msg>', xmlparse.msg_xml('@sender:<br/><msg></msg>'))
+        self.assertEqual('<msg></msg>', xmlparse.msg_xml('<msg></msg>'))
+        self.assertEqual('', xmlparse.msg_xml('plain text'))
+
+
+class AppMsgTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender = Friend({'UserName': '@sender', 'HeadImgUrl': '', 'NickName': 'sender', 'RemarkName': '',
+                              'Sex': 0})
+
+    def msg(self, content):
+        return Msg('1', self.sender, self.sender, content, 1500000000)
+
+    def test_link(self):
+        # as sent in a chatroom, the sender prefixes the xml
+        content = '@member:<br/>' + LINK_XML
+        msg = LinkMsg(self.msg(content), content)
+        self.assertEqual(MsgType.LINK, msg.msg_type)
+        self.assertEqual((5, '今天晚上一起吃饭吗', 'http://mp.weixin.qq.com/s?__biz=MzA5&mid=2650&idx=1&sn=abcdef',
+                          '我在公司楼下等你'), (msg.app_msg_type, msg.title, msg.url, msg.des))
+        self.assertEqual({'app_msg_type': 5, 'title': msg.title, 'url': msg.url, 'des': msg.des},
+                         {key: msg.json[key] for key in ('app_msg_type', 'title', 'url', 'des')})
+
+    def test_link_without_url_and_title(self):
+        content = '<msg><appmsg><type>file</type><des>d</des></appmsg></msg>'
+        msg = LinkMsg(self.msg(content), content)
+        self.assertEqual((0, '', '', 'd'), (msg.app_msg_type, msg.title, msg.url, msg.des))
+
+    def test_link_malformed(self):
+        for content in ('', 'no xml', '<msg><appmsg><title>cut'):
+            with self.subTest(content=content):
+                msg = LinkMsg(self.msg(content), content)
+                self.assertEqual((0, '', '', ''), (msg.app_msg_type, msg.title, msg.url, msg.des))
+
+    def test_emotion(self):
+        content = '@member:<br/><msg><emoji md5="abc" cdnurl="http://emoji.qpic.cn/a?m=1&amp;n=2"></emoji></msg>'
+        self.assertEqual('http://emoji.qpic.cn/a?m=1&n=2', EmotionMsg(self.msg(content), content).url)
+        # emotions of the wechat app itself carry no xml
+        self.assertEqual('', EmotionMsg(self.msg(''), '').url)
+        self.assertEqual('', EmotionMsg(self.msg('<msg><emoji'), '<msg><emoji').url)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from webwx import metrics
+from webwx.client import WebWxClient
+from webwx.ratelimit import RateLimited
+
+
+class AsyncWebWxClient:
+    """
+    asyncio variant of WebWxClient
+
+    The long-poll loop only advances the sync key and hands AddMsgList entries over to
+    processing tasks, so a slow handler never delays the next synccheck.
+    Entries of the same conversation are processed by the same task to keep their order.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, client: WebWxClient, processing_concurrency=4):
+        # handle_xxx callbacks are still implemented on the wrapped client
+        self.client = client
+        self.processing_concurrency = processing_concurrency
+        # long-poll gets its own thread, it must never wait behind a handler
+        self._poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='webwx-poll')
+        self._executor = ThreadPoolExecutor(max_workers=processing_concurrency,
+                                            thread_name_prefix='webwx-handle')
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        metrics.QUEUE_DEPTH.set_function(lambda: self.pending, 'processing')
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _send(self, func, to_username, *args):
+        # the rate limiter never blocks an executor thread, the coroutine waits for the token instead
+        while True:
+            try:
+                return await self._run(func, to_username, *args)
+            except RateLimited as e:
+                await asyncio.sleep(e.delay)
+
+    @property
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def wait_for_login(self):
+        return await self._run(self.client.wait_for_login)
+
+    async def relogin(self) -> bool:
+        return await self._run(self.client.relogin)
+
+    async def logout(self) -> bool:
+        return await self._run(self.client.logout)
+
+    async def testsynccheck(self):
+        return await self._run(self.client.testsynccheck)
+
+    async def synccheck(self, host=None, timeout=60, failure_delay=3):
+        return await self._run(self.client.synccheck, host, timeout, failure_delay)
+
+    async def webwxsync(self):
+        return await self._run(self.client.webwxsync)
+
+    async def handle(self, res):
+        return await self._run(self.client.handle, res)
+
+    async def poll(self) -> list:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._poll_executor, self.client.poll)
+
+    async def ensure_contacts(self, username_list):
+        return await self._run(self.client.ensure_contacts, username_list)
+
+    async def webwxbatchgetcontact(self, username_list):
+        return await self._run(self.client.webwxbatchgetcontact, username_list)
+
+    async def webwxgetmsgimg(self, msgid, timeout=None, thumbnail=False):
+        return await self._run(self.client.webwxgetmsgimg, msgid, timeout=timeout, thumbnail=thumbnail)
+
+    async def webwxgetvideo(self, msgid):
+        return await self._run(self.client.webwxgetvideo, msgid)
+
+    async def webwxgetvoice(self, msgid):
+        return await self._run(self.client.webwxgetvoice, msgid)
+
+    async def webwxgetpubliclinkimg(self, msgid, timeout=None):
+        return await self._run(self.client.webwxgetpubliclinkimg, msgid, timeout=timeout)
+
+    async def webwxupdatechatroom(self, chatroom_username, new_name):
+        return await self._run(self.client.webwxupdatechatroom, chatroom_username, new_name)
+
+    async def webwxoplog(self, to_username, remark_name):
+        return await self._run(self.client.webwxoplog, to_username, remark_name)
+
+    async def webwxrevokemsg(self, msgid, to_username):
+        return await self._run(self.client.webwxrevokemsg, msgid, to_username)
+
+    async def webwxsendmsg(self, to_username, content):
+        return await self._send(self.client.webwxsendmsg, to_username, content)
+
+    async def webwxsendmsgimg(self, to_username, file_url):
+        return await self._send(self.client.webwxsendmsgimg, to_username, file_url)
+
+    async def webwxsendappmsg(self, to_username, file_url):
+        return await self._send(self.client.webwxsendappmsg, to_username, file_url)
+
+    async def fetch_full_image(self, msg_id):
+        return await self._run(self.client.fetch_full_image, msg_id)
+
+    async def get_user_nickname_in_chatroom(self, username, chatroom_username):
+        # in-memory lookups, not worth a hop to the executor
+        return self.client.get_user_nickname_in_chatroom(username, chatroom_username)
+
+    async def get_chatrooms_of_user(self, username):
+        return self.client.get_chatrooms_of_user(username)
+
+    async def start_receiving(self):
+        self.logger.info('Start receiving...')
+        self._queues = [asyncio.Queue() for _ in range(self.processing_concurrency)]
+        self._tasks = [asyncio.ensure_future(self._process(queue)) for queue in self._queues]
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                add_msg_list = await self.poll()
+                # drop replayed entries before they are queued
+                add_msg_list = await loop.run_in_executor(self._poll_executor, self.client.seen_msgs.filter,
+                                                          add_msg_list)
+                if not add_msg_list:
+                    continue
+                # fetch the unknown contacts of the whole batch in the background,
+                # processing tasks needing them wait for this request instead of issuing their own
+                future = loop.run_in_executor(self._executor, self.client.ensure_contacts,
+                                              list(self.client.usernames_of(add_msg_list)))
+                future.add_done_callback(self._log_failure)
+                for add_msg in add_msg_list:
+                    self._dispatch(add_msg)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    def _dispatch(self, add_msg):
+        conversation = self.client.conversation_of(add_msg)
+        self._queues[hash(conversation) % len(self._queues)].put_nowait(add_msg)
+
+    def _log_failure(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            self.logger.error(f'Fetching contacts failed: {future.exception()}')
+
+    async def _process(self, queue: asyncio.Queue):
+        while True:
+            add_msg = await queue.get()
+            try:
+                await self._run(self.client.handle_add_msg, add_msg)
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                queue.task_done()
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from abc import abstractmethod
+from collections import OrderedDict
+
+# magic bytes of the media webwx delivers
+_MIME_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+
+def guess_mime_type(content: bytes):
+    for signature, mime_type in _MIME_SIGNATURES:
+        if content.startswith(signature):
+            return mime_type
+    return 'application/octet-stream'
+
+
+class BlobStore:
+    """
+    content addressed storage of inbound media, messages carry a reference instead of the payload
+    """
+
+    @abstractmethod
+    def put(self, content: bytes) -> dict:
+        """
+        :return: reference published with the message: ref, sha256, size and mime_type
+        """
+        pass
+
+    @abstractmethod
+    def get(self, sha256) -> bytes:
+        """
+        :return: None if the blob is unknown or evicted
+        """
+        pass
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    blobs stored as <root>/<sha256[:2]>/<sha256[2:4]>/<sha256>, the least recently stored or read
+    blobs are deleted once the directory exceeds max_bytes
+    """
+    logger = logging.getLogger(__name__)
+    # of the files blobs are written to before their rename, the leftovers of interrupted writes are deleted
+    tmp_prefix = 'tmp'
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # sha256 -> size, least recently used first
+        self._blobs = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._load()
+
+    def path_of(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def put(self, content: bytes) -> dict:
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = self.path_of(sha256)
+        with self._lock:
+            known = sha256 in self._blobs
+            if known:
+                self._blobs.move_to_end(sha256)
+        if not known:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, readers never see a partial blob
+            fd, tmp_path = tempfile.mkstemp(prefix=self.tmp_prefix, dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            with self._lock:
+                if sha256 not in self._blobs:
+                    self._blobs[sha256] = len(content)
+                    self.total_bytes += len(content)
+                self._evict()
+        return {
+            'ref':       'file://' + path,
+            'sha256':    sha256,
+            'size':      len(content),
+            'mime_type': guess_mime_type(content)
+        }
+
+    def get(self, sha256) -> bytes:
+        with self._lock:
+            if sha256 not in self._blobs:
+                return None
+            self._blobs.move_to_end(sha256)
+        try:
+            with open(self.path_of(sha256), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._blobs) > 1:
+            sha256, size = self._blobs.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path_of(sha256))
+            except FileNotFoundError:
+                pass
+
+    def _load(self):
+        blobs = []
+        real_root = os.path.realpath(self.root)
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if file_name.startswith(self.tmp_prefix) and os.path.commonpath(
+                        [real_root, os.path.realpath(path)]) == real_root:
+                    # leftover of an interrupted write
+                    os.remove(path)
+                    continue
+                if not self._is_blob(path, file_name):
+                    self.logger.warning(f'Blob store {self.root}: {path} is not a blob, skipped')
+                    continue
+                stat = os.stat(path)
+                blobs.append((stat.st_mtime, file_name, stat.st_size))
+        for _, sha256, size in sorted(blobs):
+            self._blobs[sha256] = size
+            self.total_bytes += size
+        with self._lock:
+            self._evict()
+        self.logger.info(f'Blob store {self.root}: {len(self._blobs)} blobs, {self.total_bytes} bytes')
+
+    def _is_blob(self, path, file_name):
+        if len(file_name) != 64 or path != self.path_of(file_name) or os.path.islink(path):
+            return False
+        try:
+            int(file_name, 16)
+        except ValueError:
+            return False
+        return True
@@ -1,4 +1,6 @@
-import base64
+import bisect
+import functools
+import hashlib
 import html
 import json
 import logging
@@ -6,11 +8,13 @@ import mimetypes
 import os
 import random
 import re
+import threading
 import time
 from abc import abstractmethod
-from typing import Dict
-from urllib.parse import urlencode
-from xml.dom import minidom
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List
+from urllib.parse import urlencode, urlsplit
 
 import arrow
 import qrcode
@@ -20,17 +24,129 @@ from requests_html import HTMLResponse, HTMLSession
 from requests_toolbelt import MultipartEncoder
 from urllib3.exceptions import InsecureRequestWarning
 
-from webwx import constants
+from webwx import constants, metrics, tracing, xmlparse
+from webwx.blobstore import BlobStore
+from webwx.contacts import ContactStore
+from webwx.dedup import SeenWindow
 from webwx.enums import MsgType, QRCodeStatus, SubMsgType
+from webwx.media import MediaFetcher, MediaSource
+from webwx.media_cache import MediaIdCache, MediaIdCacheEntry
+from webwx.ratelimit import SendRateLimiter
+from webwx.recording import RecordKind, SyncRecorder, media_key
+from webwx.serializer import Serializer, get_serializer
 from webwx.models import Friend, ChatRoom, MediaPlatform, Contact, SpecialUser, TextMsg, LocationMsg, ImageMsg, Msg, \
-    EmotionMsg, ChatroomMember
+    EmotionMsg, ChatroomMember, LinkMsg
+
+
+WEBWX_REQUEST_SECONDS = metrics.histogram('webwx_request_seconds',
+                                          'webwx request latency, including the body of non streamed responses',
+                                          ('endpoint',))
+WEBWX_REQUESTS = metrics.counter('webwx_requests_total', 'webwx requests by http status, or exception if failed',
+                                 ('endpoint', 'status'))
+WEBWX_SENT_BYTES = metrics.counter('webwx_sent_bytes_total', 'webwx request body bytes', ('endpoint',))
+WEBWX_RECEIVED_BYTES = metrics.counter('webwx_received_bytes_total', 'webwx response body bytes', ('endpoint',))
+WEBWX_RETS = metrics.counter('webwx_base_response_total', 'BaseResponse.Ret of webwx json responses',
+                             ('endpoint', 'ret'))
+SYNCCHECK_RESULTS = metrics.counter('webwx_synccheck_total', 'synccheck responses', ('retcode', 'selector'))
+
+
+def endpoint_of(url):
+    return urlsplit(url).path.rsplit('/', 1)[-1]
+
+
+def _count_ret(url, dic) -> int:
+    ret = dic['BaseResponse']['Ret']
+    WEBWX_RETS.inc(endpoint_of(url), ret)
+    return ret
+
+
+class MeteredSession(HTMLSession):
+    """
+    records latency, status and bytes of every request per endpoint, when metrics are enabled
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        if not metrics.REGISTRY.enabled:
+            return super().request(method, url, *args, **kwargs)
+        endpoint = endpoint_of(url)
+        start = time.perf_counter()
+        try:
+            r = super().request(method, url, *args, **kwargs)
+        except Exception as e:
+            WEBWX_REQUESTS.inc(endpoint, type(e).__name__)
+            raise
+        WEBWX_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+        WEBWX_REQUESTS.inc(endpoint, r.status_code)
+        body = r.request.body
+        if body:
+            # MultipartEncoder tells its length
+            WEBWX_SENT_BYTES.inc(endpoint, amount=len(body) if isinstance(body, (bytes, str)) else body.len)
+        # a streamed body is not read yet
+        received = int(r.headers.get('Content-Length', 0)) if kwargs.get('stream') else len(r.content)
+        WEBWX_RECEIVED_BYTES.inc(endpoint, amount=received)
+        return r
 
 
 class WebWxClient:
     logger = logging.getLogger(__name__)
+    # see MEDIA_FETCH_WORKERS and MEDIA_FETCH_TIMEOUT in config.py
+    media_fetch_workers = 4
+    media_fetch_timeout = 30
+    # max usernames per webwxbatchgetcontact request
+    batch_get_contact_size = 50
+    # login, upload and synccheck are served by their own hosts, the rest by the base_uri given at login
+    login_uri = 'https://login.weixin.qq.com'
+    upload_uri = 'https://file.wx2.qq.com/cgi-bin/mmwebwx-bin'
+    sync_scheme = 'https'
+    sync_hosts = ['wx2.qq.com',
+                  'webpush.wx2.qq.com',
+                  'wx8.qq.com',
+                  'webpush.wx8.qq.com',
+                  'qq.com',
+                  'webpush.wx.qq.com',
+                  'web2.wechat.com',
+                  'webpush.web2.wechat.com',
+                  'wechat.com',
+                  'webpush.web.wechat.com',
+                  'webpush.weixin.qq.com',
+                  'webpush.wechat.com',
+                  'webpush1.wechat.com',
+                  'webpush2.wechat.com',
+                  'webpush.wx.qq.com',
+                  'webpush2.wx.qq.com']
+    # seconds to wait for a probing synccheck, above the ~25s WeChat holds a synccheck long-poll open
+    sync_probe_timeout = 40
+    # consecutive failed synccheck before failing over to the next ranked sync host
+    sync_host_max_failures = 3
+    # see SEND_RATE, SEND_BURST, RECIPIENT_SEND_RATE and RECIPIENT_SEND_BURST in config.py
+    send_rate = 2
+    send_burst = 5
+    recipient_send_rate = 0.5
+    recipient_send_burst = 3
+    # bytes per webwxuploadmedia request, the web client uses 512KB
+    upload_chunk_size = 512 * 1024
+    upload_chunk_retries = 3
+    # seconds
+    upload_timeout = 60
+    # inbound images are stored here and published by reference, instead of inline base64, if set
+    blob_store: BlobStore = None
+    # webwxsync responses, the contacts and the media they need are appended here for a replay, if set
+    recorder: SyncRecorder = None
+    # see SERIALIZER in config.py
+    serializer: Serializer = get_serializer()
+    # see IMAGE_INGEST_MODE and THUMBNAIL_MSGS_SIZE in config.py, and fetch_full_image
+    image_ingest_mode = 'full'
+    thumbnail_msgs_size = 1024
+    # see SEEN_MSGS_SIZE in config.py
+    seen_msgs_size = 10000
+    # see MEDIA_ID_CACHE_SIZE and MEDIA_ID_CACHE_TTL in config.py
+    media_id_cache_size = 1024
+    media_id_cache_ttl = 6 * 3600
+    # BaseResponse.Ret of a send refusing its MediaId, e.g. expired, only these invalidate a cached MediaId
+    media_id_rejected_rets = (1,)
 
     def __init__(self):
-        self.session = HTMLSession()
+        self.session = MeteredSession()
         self.session.verify = False
         urllib3.disable_warnings(InsecureRequestWarning)
         self.session.headers = {
@@ -51,16 +167,36 @@ class WebWxClient:
         self.base_request = {}
         self.sync_key_dic = {}
         self.sync_host = ''
+        # (latency, host) of the hosts answering retcode 0, fastest first
+        self.sync_hosts_ranking = []
+        self._sync_hosts_lock = threading.Lock()
+        self._sync_failures = 0
 
         self.user: Friend = None
-        self.special_users: Dict[str, Contact] = {}
         self.usernames_of_builtin_special_users = constants.BUILTIN_SPECIAL_USERS
-        # all contacts(including chatroom members media_platforms special_users)
-        self.contacts: Dict[str, Contact] = {}
+        # one instance per username, the dicts below are views of the store
+        self.contact_store = ContactStore(self.usernames_of_builtin_special_users)
+        # all contacts(including media_platforms special_users chatrooms and self)
+        self.contacts: Dict[str, Contact] = self.contact_store.contacts
+        self.special_users: Dict[str, SpecialUser] = self.contact_store.special_users
         # friends
-        self.friends: Dict[str, Friend] = {}
-        self.chatrooms: Dict[str, ChatRoom] = {}
-        self.media_platforms: Dict[str, MediaPlatform] = {}
+        self.friends: Dict[str, Friend] = self.contact_store.friends
+        self.chatrooms: Dict[str, ChatRoom] = self.contact_store.chatrooms
+        self.media_platforms: Dict[str, MediaPlatform] = self.contact_store.media_platforms
+
+        self.media_fetcher = MediaFetcher(self.media_fetch_workers)
+        metrics.QUEUE_DEPTH.set_function(lambda: self.media_fetcher.pending, 'media_fetch')
+        # username -> event set when its webwxbatchgetcontact request is finished
+        self._fetching_contacts: Dict[str, threading.Event] = {}
+        self._fetching_contacts_lock = threading.Lock()
+        # msg_id -> Msg of the images ingested as thumbnail, least recently received first
+        self._thumbnail_msgs: OrderedDict = OrderedDict()
+        self._thumbnail_msgs_lock = threading.Lock()
+        # kept across relogin, replayed messages must be dropped then too
+        self.seen_msgs = SeenWindow(self.seen_msgs_size)
+        self.media_id_cache = MediaIdCache(self.media_id_cache_size, self.media_id_cache_ttl)
+        self.send_limiter = SendRateLimiter(self.send_rate, self.send_burst,
+                                            self.recipient_send_rate, self.recipient_send_burst)
 
     @property
     def sync_key(self) -> str:
@@ -85,7 +221,7 @@ class WebWxClient:
         pass
 
     def relogin(self) -> bool:
-        r = self.session.get('https://login.weixin.qq.com/cgi-bin/mmwebwx-bin/webwxpushloginurl?uin=' + self.uin)
+        r = self.session.get(self.login_uri + '/cgi-bin/mmwebwx-bin/webwxpushloginurl?uin=' + self.uin)
         res = r.json()
         if res['ret'] != 0:
             return False
@@ -111,18 +247,17 @@ class WebWxClient:
 
     def _init(self):
         xml = self.session.get(self.redirect_uri).text
-        doc = minidom.parseString(xml)
-        root = doc.documentElement
-        for node in root.childNodes:
-            if node.nodeName == 'skey':
-                self.skey = node.childNodes[0].data
-            elif node.nodeName == 'wxsid':
-                self.sid = node.childNodes[0].data
-            elif node.nodeName == 'wxuin':
-                self.uin = node.childNodes[0].data
-            elif node.nodeName == 'pass_ticket':
-                self.pass_ticket = node.childNodes[0].data
-
+        values = xmlparse.find_texts(xml, ('skey', 'wxsid', 'wxuin', 'pass_ticket'))
+        self.skey = values.get('skey', self.skey)
+        self.sid = values.get('wxsid', self.sid)
+        self.uin = values.get('wxuin', self.uin)
+        self.pass_ticket = values.get('pass_ticket', self.pass_ticket)
+
+        # MediaId belongs to the previous session
+        self.media_id_cache.clear()
+        # images of the previous session can't be downloaded with the new skey
+        with self._thumbnail_msgs_lock:
+            self._thumbnail_msgs.clear()
         self.base_request = {
             'Uin':      int(self.uin),
             'Sid':      self.sid,
@@ -164,10 +299,19 @@ class WebWxClient:
         if dic['BaseResponse']['Ret'] != 0:
             self.logger.error(f"webwxinit error: {dic['BaseResponse']['ErrMsg']}")
             return False
+        if self.recorder:
+            self.recorder.record(RecordKind.INIT, r.content)
+        self.apply_init(dic)
+        return True
+
+    def apply_init(self, dic):
+        """
+        set the sync key, the user and the recent contacts of a webwxinit response
+        """
         self.sync_key_dic = dic['SyncKey']
         self.user = Friend(dic['User'])
+        self.contact_store.set_user(self.user)
         self._parse_contacts_json(dic['ContactList'])
-        return True
 
     def _webwxstatusnotify(self):
         url = self.base_uri + '/webwxstatusnotify'
@@ -194,6 +338,8 @@ class WebWxClient:
         if dic['BaseResponse']['Ret'] != 0:
             self.logger.error(f"webwxgetcontact error: {dic['BaseResponse']['ErrMsg']}")
             return False
+        if self.recorder:
+            self.recorder.record(RecordKind.CONTACTS, r.content)
 
         member_list = dic['MemberList'][:]
         # webwxgetcontact does not include chatroom member detail
@@ -201,55 +347,54 @@ class WebWxClient:
         return True
 
     def _parse_contacts_json(self, contacts_json, has_chatroom_member_detail=False):
-        for contact in contacts_json:
-            self.contacts[contact['UserName']] = Contact(contact)
-            # media platform
-            if contact['VerifyFlag'] & 8 != 0:
-                self.media_platforms[contact['UserName']] = MediaPlatform(contact)
-            # special users
-            elif contact['UserName'] in self.usernames_of_builtin_special_users:
-                self.special_users[contact['UserName']] = SpecialUser(contact)
-            # chatroom
-            elif '@@' in contact['UserName']:
-                if contact['UserName'] not in self.chatrooms:
-                    self.chatrooms[contact['UserName']] = ChatRoom(contact)
-                chatroom = self.chatrooms[contact['UserName']]
-                if has_chatroom_member_detail:
-                    chatroom.clear_members()
-                    for member in contact['MemberList']:
-                        chatroom.add_member(ChatroomMember(member))
-            # self
-            elif contact['UserName'] == self.user.username:
-                self.contacts[self.user.username] = self.user
-            # normal friends
-            else:
-                self.friends[contact['UserName']] = Friend(contact)
+        for contact_json in contacts_json:
+            # existing contacts are updated in place, chatroom members are kept
+            contact = self.contact_store.upsert(contact_json)
+            if has_chatroom_member_detail and isinstance(contact, ChatRoom):
+                self.contact_store.set_chatroom_members(
+                    contact, [ChatroomMember(member) for member in contact_json['MemberList']])
 
     def testsynccheck(self):
-        sync_hosts = ['wx2.qq.com',
-                      'webpush.wx2.qq.com',
-                      'wx8.qq.com',
-                      'webpush.wx8.qq.com',
-                      'qq.com',
-                      'webpush.wx.qq.com',
-                      'web2.wechat.com',
-                      'webpush.web2.wechat.com',
-                      'wechat.com',
-                      'webpush.web.wechat.com',
-                      'webpush.weixin.qq.com',
-                      'webpush.wechat.com',
-                      'webpush1.wechat.com',
-                      'webpush2.wechat.com',
-                      'webpush.wx.qq.com',
-                      'webpush2.wx.qq.com']
-        for host in sync_hosts:
-            self.sync_host = host
-            retcode, _ = self.synccheck()
-            if retcode == '0':
-                return True
-        return False
+        """
+        probe every sync host concurrently and use the fastest one answering retcode 0,
+        probes still running keep filling the ranking used to fail over later
+        """
+        self.sync_hosts_ranking = []
+        executor = ThreadPoolExecutor(max_workers=len(self.sync_hosts), thread_name_prefix='webwx-probe')
+        pending = {executor.submit(self._probe_sync_host, host) for host in self.sync_hosts}
+        executor.shutdown(wait=False)
+        while pending and not self.sync_hosts_ranking:
+            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        if not self.sync_hosts_ranking:
+            return False
+        self.sync_host = self.sync_hosts_ranking[0][1]
+        self._sync_failures = 0
+        self.logger.info(f'Sync host: {self.sync_host}')
+        return True
+
+    def _probe_sync_host(self, host):
+        start = time.monotonic()
+        retcode, _ = self.synccheck(host, timeout=self.sync_probe_timeout, failure_delay=0)
+        if retcode == '0':
+            with self._sync_hosts_lock:
+                bisect.insort(self.sync_hosts_ranking, (time.monotonic() - start, host))
+
+    def _fail_over_sync_host(self):
+        """
+        switch to the next-best ranked sync host, probe again when none is left
+        """
+        with self._sync_hosts_lock:
+            self.sync_hosts_ranking = [item for item in self.sync_hosts_ranking if item[1] != self.sync_host]
+            ranking = self.sync_hosts_ranking
+        self._sync_failures = 0
+        if ranking:
+            self.logger.warning(f'Sync host {self.sync_host} keeps failing, switch to {ranking[0][1]}')
+            self.sync_host = ranking[0][1]
+        else:
+            self.logger.warning(f'Sync host {self.sync_host} keeps failing, probing again')
+            self.testsynccheck()
 
-    def synccheck(self):
+    def synccheck(self, host=None, timeout=60, failure_delay=3):
         params = {
             'r':        int(time.time()),
             'sid':      self.sid,
@@ -259,22 +404,23 @@ class WebWxClient:
             'synckey':  self.sync_key,
             '_':        int(time.time()),
         }
-        url = 'https://' + self.sync_host + '/cgi-bin/mmwebwx-bin/synccheck?' + urlencode(params)
+        url = f'{self.sync_scheme}://{host or self.sync_host}/cgi-bin/mmwebwx-bin/synccheck?' + urlencode(params)
         try:
-            r: HTMLResponse = self.session.get(url, timeout=60)
+            r: HTMLResponse = self.session.get(url, timeout=timeout)
         except requests.exceptions.Timeout as _:
             self.logger.warning('Timeout')
-            time.sleep(3)
+            time.sleep(failure_delay)
             return [-1, -1]
         except requests.exceptions.ConnectionError as _:
             self.logger.warning('BadStatusLine')
-            time.sleep(3)
+            time.sleep(failure_delay)
             return [-1, -1]
         self.logger.debug(r.content)
         if r.text == '':
             return [-1, -1]
 
         retcode, selector = r.html.search('retcode:"{}",selector:"{}"')
+        SYNCCHECK_RESULTS.inc(retcode, selector)
         return retcode, selector
 
     def webwxsync(self):
@@ -296,168 +442,305 @@ class WebWxClient:
             return
         r.encoding = 'utf-8'
         self.logger.info('webwxsync')
-        return r.json()
+        dic = r.json()
+        if self.recorder:
+            self.recorder.record(RecordKind.SYNC, r.content)
+        _count_ret(url, dic)
+        return dic
 
     def handle(self, res):
+        with tracing.span('handle'):
+            with tracing.span('apply_sync'):
+                add_msg_list = self.apply_sync(res)
+            self.handle_add_msg_list(add_msg_list)
+
+    def handle_add_msg_list(self, add_msg_list):
+        with tracing.span('handle_add_msg_list', count=len(add_msg_list)):
+            # drop the entries replayed by a repeated webwxsync or after relogin
+            with tracing.span('dedup'):
+                add_msg_list = self.seen_msgs.filter(add_msg_list)
+            # fetch every unknown contact of the batch at once instead of one request per message
+            with tracing.span('ensure_contacts'):
+                self.ensure_contacts(self.usernames_of(add_msg_list))
+            for add_msg in add_msg_list:
+                with tracing.span('handle_add_msg', msg_type=add_msg['MsgType']):
+                    self.handle_add_msg(add_msg)
+
+    def apply_sync(self, res) -> list:
+        """
+        advance the sync key and apply contact modifications of a webwxsync response
+        :param res: webwxsync response
+        :return: the AddMsgList entries waiting to be handled
+        """
         if not res:
-            return
+            return []
         if res['BaseResponse']['Ret'] != 0:
-            return
+            return []
         self.sync_key_dic = res['SyncKey']
         if res['ModContactList']:
             # contact info updated
             self._parse_contacts_json(res['ModContactList'], True)
             # trigger update
             self.handle_update_contacts(list(map(lambda x: x['UserName'], res['ModContactList'])))
-        for add_msg in res['AddMsgList']:
-            msg_type = MsgType(int(add_msg['MsgType']))
-            # can't find fromUsername in self.contacts, the message might be from the chatroom
-            # call self.webwxbatchgetcontact to update the contacts list
-            if add_msg['FromUserName'] not in self.contacts:
-                self.webwxbatchgetcontact([add_msg['FromUserName']])
-            if add_msg['ToUserName'] not in self.contacts:
-                self.webwxbatchgetcontact([add_msg['ToUserName']])
-            # unescape html
-            content = html.unescape(add_msg['Content'])
-            msg = Msg(add_msg['MsgId'], self.contacts[add_msg['FromUserName']],
-                      self.contacts[add_msg['ToUserName']], content, add_msg['CreateTime'])
-            # message is from chatroom, check if the chatroom's member detail is fetched
-            if msg.from_user.username.startswith('@@'):
-                if len(self.chatrooms[msg.from_user.username].member_list) == 0:
-                    self.webwxbatchgetcontact([msg.from_user.username])
-            if msg_type == MsgType.TEXT:
-                # location info
-                if SubMsgType(int(add_msg['SubMsgType'])):
-                    content = self.webwxgetpubliclinkimg(msg.msg_id)
-                    msg = LocationMsg(msg, base64.b64encode(content).decode())
-                    self.handle_location(msg)
-                else:
-                    msg = TextMsg(msg, content)
-                    self.handle_text(msg)
-            # pic info
-            elif msg_type == MsgType.IMAGE:
-                content = self.webwxgetmsgimg(msg.msg_id)
-                msg = ImageMsg(msg, base64.b64encode(content).decode())
-                self.handle_image(msg)
-            elif msg_type == MsgType.VOICE:
-                self.handle_voice(msg)
-            elif msg_type == MsgType.EMOTION:
-                # HasProductId?
-                msg = EmotionMsg(msg, content)
-                self.handle_emotion(msg)
-            elif msg_type == MsgType.LINK:
-                self.handle_link(msg)
-            elif msg_type == MsgType.GET_CONTACTS_INFO:
-                self.handle_sync_contacts(msg)
-            # revoke message
-            elif msg_type == MsgType.BLOCKED:
-                pass
-            # elif msg_type == MsgType.CARD:
-            #     info = msg['RecommendInfo']
-            #     print('%s 发送了一张名片:' % name)
-            #     print('=========================')
-            #     print('= 昵称: %s' % info['NickName'])
-            #     print('= 微信号: %s' % info['Alias'])
-            #     print('= 地区: %s %s' % (info['Province'], info['City']))
-            #     print('= 性别: %s' % ['未知', '男', '女'][info['Sex']])
-            #     print('=========================')
-            #     raw_msg = {'raw_msg': msg, 'message': '%s 发送了一张名片: %s' % (
-            #         name.strip(), json.dumps(info))}
-            #     self._showMsg(raw_msg)
-            # elif msg_type == MsgType.EMOTION:
-            #     url = self._searchContent('cdnurl', content)
-            #     raw_msg = {'raw_msg': msg,
-            #                'message': '%s 发了一个动画表情，点击下面链接查看: %s' % (name, url)}
-            #     self._showMsg(raw_msg)
-            #     self._safe_open(url)
-            # elif msg_type == MsgType.LINK:
-            #     appMsgType = defaultdict(lambda: "")
-            #     appMsgType.update({5: '链接', 3: '音乐', 7: '微博'})
-            #     print('%s 分享了一个%s:' % (name, appMsgType[msg['AppMsgType']]))
-            #     print('=========================')
-            #     print('= 标题: %s' % msg['FileName'])
-            #     print('= 描述: %s' % self._searchContent('des', content, 'xml'))
-            #     print('= 链接: %s' % msg['Url'])
-            #     print('= 来自: %s' % self._searchContent('appname', content, 'xml'))
-            #     print('=========================')
-            #     card = {
-            #         'title': msg['FileName'],
-            #         'description': self._searchContent('des', content, 'xml'),
-            #         'url': msg['Url'],
-            #         'appname': self._searchContent('appname', content, 'xml')
-            #     }
-            #     raw_msg = {'raw_msg': msg, 'message': '%s 分享了一个%s: %s' % (
-            #         name, appMsgType[msg['AppMsgType']], json.dumps(card))}
-            #     self._showMsg(raw_msg)
-            # elif msgType == 51:
-            #     raw_msg = {'raw_msg': msg, 'message': '[*] 成功获取联系人信息'}
-            #     self._showMsg(raw_msg)
-            # elif msgType == 62:
-            #     video = self.webwxgetvideo(msgid)
-            #     raw_msg = {'raw_msg': msg,
-            #                'message': '%s 发了一段小视频: %s' % (name, video)}
-            #     self._showMsg(raw_msg)
-            #     self._safe_open(video)
-            # elif msgType == 10002:
-            #     raw_msg = {'raw_msg': msg, 'message': '%s 撤回了一条消息' % name}
-            #     self._showMsg(raw_msg)
-            # else:
-            #     self.loggerdebug('[*] 该消息类型为: %d，可能是表情，图片, 链接或红包: %s' %
-            #                   (msg['MsgType'], json.dumps(msg)))
-            #     raw_msg = {
-            #         'raw_msg': msg, 'message': '[*] 该消息类型为: %d，可能是表情，图片, 链接或红包' % msg['MsgType']}
-            #     self._showMsg(raw_msg)
-
-    def get_user_nickname_in_chatroom(self, username, chatroom):
-        pass
+        return res['AddMsgList']
+
+    def handle_add_msg(self, add_msg):
+        msg_type = MsgType(int(add_msg['MsgType']))
+        conversation = self.conversation_of(add_msg)
+        # can't find fromUsername in self.contacts, the message might be from the chatroom
+        # usually fetched by the batch pre-pass already, otherwise wait for it here
+        self.ensure_contacts(self.usernames_of([add_msg]))
+        # unescape html
+        content = html.unescape(add_msg['Content'])
+        msg = Msg(add_msg['MsgId'], self.contacts[add_msg['FromUserName']],
+                  self.contacts[add_msg['ToUserName']], content, add_msg['CreateTime'])
+        if msg_type == MsgType.TEXT:
+            # location info
+            if SubMsgType(int(add_msg['SubMsgType'])):
+                self._fetch_media(conversation, msg, self.webwxgetpubliclinkimg, LocationMsg, self.handle_location)
+            else:
+                # emoji unescaping and @mention resolution
+                with tracing.span('parse_text'):
+                    msg = TextMsg(msg, content, self.chatrooms.get(conversation))
+                self.media_fetcher.submit(conversation, functools.partial(self.handle_text, msg))
+        # pic info
+        elif msg_type == MsgType.IMAGE:
+            if self.image_ingest_mode == 'thumbnail':
+                self._remember_thumbnail(msg)
+                self._fetch_media(conversation, msg, functools.partial(self.webwxgetmsgimg, thumbnail=True),
+                                  functools.partial(ImageMsg, thumbnail=True), self.handle_image)
+            else:
+                self._fetch_media(conversation, msg, self.webwxgetmsgimg, ImageMsg, self.handle_image)
+        elif msg_type == MsgType.VOICE:
+            self.media_fetcher.submit(conversation, functools.partial(self.handle_voice, msg))
+        elif msg_type == MsgType.EMOTION:
+            # HasProductId?
+            msg = EmotionMsg(msg, content)
+            self.media_fetcher.submit(conversation, functools.partial(self.handle_emotion, msg))
+        elif msg_type == MsgType.LINK:
+            msg = LinkMsg(msg, content)
+            self.media_fetcher.submit(conversation, functools.partial(self.handle_link, msg))
+        elif msg_type == MsgType.GET_CONTACTS_INFO:
+            self.media_fetcher.submit(conversation, functools.partial(self.handle_sync_contacts, msg))
+        # revoke message
+        elif msg_type == MsgType.BLOCKED:
+            pass
+        # elif msg_type == MsgType.CARD:
+        #     info = msg['RecommendInfo']
+        #     print('%s 发送了一张名片:' % name)
+        #     print('=========================')
+        #     print('= 昵称: %s' % info['NickName'])
+        #     print('= 微信号: %s' % info['Alias'])
+        #     print('= 地区: %s %s' % (info['Province'], info['City']))
+        #     print('= 性别: %s' % ['未知', '男', '女'][info['Sex']])
+        #     print('=========================')
+        #     raw_msg = {'raw_msg': msg, 'message': '%s 发送了一张名片: %s' % (
+        #         name.strip(), json.dumps(info))}
+        #     self._showMsg(raw_msg)
+        # elif msg_type == MsgType.EMOTION:
+        #     url = self._searchContent('cdnurl', content)
+        #     raw_msg = {'raw_msg': msg,
+        #                'message': '%s 发了一个动画表情，点击下面链接查看: %s' % (name, url)}
+        #     self._showMsg(raw_msg)
+        #     self._safe_open(url)
+        # elif msg_type == MsgType.LINK:
+        #     appMsgType = defaultdict(lambda: "")
+        #     appMsgType.update({5: '链接', 3: '音乐', 7: '微博'})
+        #     print('%s 分享了一个%s:' % (name, appMsgType[msg['AppMsgType']]))
+        #     print('=========================')
+        #     print('= 标题: %s' % msg['FileName'])
+        #     print('= 描述: %s' % self._searchContent('des', content, 'xml'))
+        #     print('= 链接: %s' % msg['Url'])
+        #     print('= 来自: %s' % self._searchContent('appname', content, 'xml'))
+        #     print('=========================')
+        #     card = {
+        #         'title': msg['FileName'],
+        #         'description': self._searchContent('des', content, 'xml'),
+        #         'url': msg['Url'],
+        #         'appname': self._searchContent('appname', content, 'xml')
+        #     }
+        #     raw_msg = {'raw_msg': msg, 'message': '%s 分享了一个%s: %s' % (
+        #         name, appMsgType[msg['AppMsgType']], json.dumps(card))}
+        #     self._showMsg(raw_msg)
+        # elif msgType == 51:
+        #     raw_msg = {'raw_msg': msg, 'message': '[*] 成功获取联系人信息'}
+        #     self._showMsg(raw_msg)
+        # elif msgType == 62:
+        #     video = self.webwxgetvideo(msgid)
+        #     raw_msg = {'raw_msg': msg,
+        #                'message': '%s 发了一段小视频: %s' % (name, video)}
+        #     self._showMsg(raw_msg)
+        #     self._safe_open(video)
+        # elif msgType == 10002:
+        #     raw_msg = {'raw_msg': msg, 'message': '%s 撤回了一条消息' % name}
+        #     self._showMsg(raw_msg)
+        # else:
+        #     self.loggerdebug('[*] 该消息类型为: %d，可能是表情，图片, 链接或红包: %s' %
+        #                   (msg['MsgType'], json.dumps(msg)))
+        #     raw_msg = {
+        #         'raw_msg': msg, 'message': '[*] 该消息类型为: %d，可能是表情，图片, 链接或红包' % msg['MsgType']}
+        #     self._showMsg(raw_msg)
+
+    def _fetch_media(self, conversation, msg, fetch, msg_cls, handler):
+        """
+        download the media on the fetcher pool, the handler is called in conversation order
+        """
+
+        def fetch_content():
+            with tracing.span('fetch_media', msg_id=msg.msg_id):
+                return fetch(msg.msg_id, timeout=self.media_fetch_timeout)
+
+        def deliver(content):
+            # claim check: only the reference is published when a blob store is configured
+            with tracing.span('blob_store'):
+                blob = self.blob_store.put(content) if self.blob_store else None
+            with tracing.span('handle_media', msg_id=msg.msg_id):
+                handler(msg_cls(msg, content, blob))
+
+        self.media_fetcher.submit(conversation, deliver, fetch_content)
+
+    def _remember_thumbnail(self, msg: Msg):
+        with self._thumbnail_msgs_lock:
+            self._thumbnail_msgs[str(msg.msg_id)] = msg
+            while len(self._thumbnail_msgs) > self.thumbnail_msgs_size:
+                self._thumbnail_msgs.popitem(last=False)
+
+    def fetch_full_image(self, msg_id) -> ImageMsg:
+        """
+        download the full image of a message ingested as thumbnail, only possible with the skey it was received with
+        :raise KeyError: the message is unknown, evicted or from a previous session
+        :return: None if the download failed
+        """
+        with self._thumbnail_msgs_lock:
+            msg = self._thumbnail_msgs[str(msg_id)]
+        content = self.webwxgetmsgimg(msg.msg_id, timeout=self.media_fetch_timeout)
+        if not content:
+            return None
+        return ImageMsg(msg, content, self.blob_store.put(content) if self.blob_store else None)
+
+    def get_user_nickname_in_chatroom(self, username, chatroom_username):
+        """
+        display name of the user in the chatroom, or the nickname if the user has not set one
+        :return: None if the user is not a known member of the chatroom
+        """
+        member = self.contact_store.get_member(chatroom_username, username)
+        if member is None:
+            return None
+        return member.display_name or member.nickname
+
+    def get_chatrooms_of_user(self, username) -> List[ChatRoom]:
+        return self.contact_store.chatrooms_of(username)
 
     def start_receiving(self):
         self.logger.info('Start receiving...')
         while True:
-            retcode, selector = self.synccheck()
-            if retcode == '0':
-                if selector == '0':
-                    pass
-                elif selector == '1':
-                    msg = self.webwxsync()
-                    self.logger.info(msg)
-                elif selector == '2':
-                    msg = self.webwxsync()
-                    self.handle(msg)
-                elif selector == '3':
-                    msg = self.webwxsync()
-                    self.handle(msg)
-                elif selector == '4':
-                    self.logger.info("Contact info updated")
-                    self.webwxsync()
-                elif selector == '5':
-                    self.webwxsync()
-                elif selector == '6':
-                    self.logger.info('App message: red package, article, etc.')
-                    msg = self.webwxsync()
-                    self.handle(msg)
-                elif selector == '7':
-                    self.logger.info("Enter/leave chat window by phone")
-                    self.webwxsync()
-                    msg = self.webwxsync()
-                    self.handle(msg)
-                else:
-                    self.logger.info(f"Unknown selector: {selector}")
-            elif retcode == '1100':
-                self.logger.info("Logout")
-                self.wait_for_login()
-            elif retcode == '1101':
-                self.logger.info("Cookie expired")
-                if not self.relogin():
-                    self.wait_for_login()
-            elif retcode == '1102':
-                self.logger.info('1102')
-                if not self.relogin():
-                    self.wait_for_login()
-            else:
-                self.logger.warning(f"Unknown retcode: {retcode}")
+            self.handle_add_msg_list(self.poll())
+
+    def poll(self) -> list:
+        """
+        one round of synccheck long-poll, followed by webwxsync when the selector asks for it
+        :return: the AddMsgList entries waiting to be handled
+        """
+        if not self.sync_host and not self.testsynccheck():
+            # no host answered the probes, there is nothing to long-poll
+            self.logger.warning('No sync host available, probing again')
+            time.sleep(3)
+            return []
+        retcode, selector = self.synccheck()
+        if retcode == -1:
+            self._sync_failures += 1
+            if self._sync_failures >= self.sync_host_max_failures:
+                self._fail_over_sync_host()
+        elif retcode == '0':
+            self._sync_failures = 0
+        if retcode == '0':
+            if selector == '0':
+                pass
+            elif selector == '1':
                 msg = self.webwxsync()
-                self.handle(msg)
+                self.logger.info(msg)
+            elif selector == '2':
+                return self.apply_sync(self.webwxsync())
+            elif selector == '3':
+                return self.apply_sync(self.webwxsync())
+            elif selector == '4':
+                self.logger.info("Contact info updated")
+                self.webwxsync()
+            elif selector == '5':
+                self.webwxsync()
+            elif selector == '6':
+                self.logger.info('App message: red package, article, etc.')
+                return self.apply_sync(self.webwxsync())
+            elif selector == '7':
+                self.logger.info("Enter/leave chat window by phone")
+                self.webwxsync()
+                return self.apply_sync(self.webwxsync())
+            else:
+                self.logger.info(f"Unknown selector: {selector}")
+        elif retcode == '1100':
+            self.logger.info("Logout")
+            self.wait_for_login()
+        elif retcode == '1101':
+            self.logger.info("Cookie expired")
+            if not self.relogin():
+                self.wait_for_login()
+        elif retcode == '1102':
+            self.logger.info('1102')
+            if not self.relogin():
+                self.wait_for_login()
+        else:
+            self.logger.warning(f"Unknown retcode: {retcode}")
+            return self.apply_sync(self.webwxsync())
+        return []
+
+    def conversation_of(self, add_msg) -> str:
+        """
+        username of the conversation an AddMsgList entry belongs to, messages sent by
+        ourselves belong to the receiver's conversation
+        """
+        if self.user and add_msg['FromUserName'] == self.user.username:
+            return add_msg['ToUserName']
+        return add_msg['FromUserName']
+
+    def ensure_contacts(self, username_list):
+        """
+        fetch the missing contacts with as few webwxbatchgetcontact requests as possible,
+        usernames already being fetched by another thread are waited for instead of requested twice
+        :param username_list: usernames, either missing or not
+        """
+        to_fetch = []
+        to_wait = []
+        with self._fetching_contacts_lock:
+            for username in dict.fromkeys(username_list):
+                if username in self._fetching_contacts:
+                    to_wait.append(self._fetching_contacts[username])
+                elif self._is_contact_missing(username):
+                    self._fetching_contacts[username] = threading.Event()
+                    to_fetch.append(username)
+        try:
+            for i in range(0, len(to_fetch), self.batch_get_contact_size):
+                self.webwxbatchgetcontact(to_fetch[i:i + self.batch_get_contact_size])
+        finally:
+            with self._fetching_contacts_lock:
+                for username in to_fetch:
+                    self._fetching_contacts.pop(username).set()
+        for event in to_wait:
+            event.wait()
+
+    def _is_contact_missing(self, username):
+        if username not in self.contacts:
+            return True
+        # chatroom member detail is not fetched yet
+        if username.startswith('@@'):
+            chatroom = self.chatrooms.get(username)
+            return chatroom is None or len(chatroom.member_list) == 0
+        return False
+
+    @staticmethod
+    def usernames_of(add_msg_list):
+        for add_msg in add_msg_list:
+            yield add_msg['FromUserName']
+            yield add_msg['ToUserName']
 
     def webwxbatchgetcontact(self, username_list):
         if not username_list:
@@ -479,6 +762,8 @@ class WebWxClient:
         if dic['BaseResponse']['Ret'] != 0:
             self.logger.error(f"webwxbatchgetcontact error: {dic['BaseResponse']['ErrMsg']}")
             return []
+        if self.recorder:
+            self.recorder.record(RecordKind.BATCH_CONTACTS, r.content)
         self._parse_contacts_json(dic['ContactList'], True)
         username_list = []
         for contact_json in dic['ContactList']:
@@ -487,10 +772,14 @@ class WebWxClient:
         self.handle_update_contacts(username_list)
         return True
 
-    def webwxgetmsgimg(self, msgid):
-        # add param type=slave to get the thumbnail instead of the whole image
+    def webwxgetmsgimg(self, msgid, timeout=None, thumbnail=False):
         url = self.base_uri + '/webwxgetmsgimg?MsgID=%s&skey=%s' % (msgid, self.skey)
-        return self.session.get(url).content
+        if thumbnail:
+            url += '&type=slave'
+        content = self.session.get(url, timeout=timeout).content
+        if self.recorder:
+            self.recorder.record_media(media_key(msgid, 'thumbnail' if thumbnail else 'image'), content)
+        return content
 
     # Not work now for weixin haven't support this API
     def webwxgetvideo(self, msgid):
@@ -501,9 +790,12 @@ class WebWxClient:
         url = self.base_uri + '/webwxgetvoice?msgid=%s&skey=%s' % (msgid, self.skey)
         return self.session.get(url).content
 
-    def webwxgetpubliclinkimg(self, msgid):
+    def webwxgetpubliclinkimg(self, msgid, timeout=None):
         url = self.base_uri + '/webwxgetpubliclinkimg?url=xxx&msgid=%s&pictype=location' % msgid
-        return self.session.get(url).content
+        content = self.session.get(url, timeout=timeout).content
+        if self.recorder:
+            self.recorder.record_media(media_key(msgid, 'location'), content)
+        return content
 
     def webwxupdatechatroom(self, chatroom_username, new_name):
         url = self.base_uri + '/webwxupdatechatroom?fun=modtopic&pass_ticket=%s' % self.pass_ticket
@@ -514,7 +806,7 @@ class WebWxClient:
         }
         r = self._send_request(url, data)
         dic = r.json()
-        success = dic['BaseResponse']['Ret'] == 0
+        success = _count_ret(r.url, dic) == 0
         return success
 
     def webwxoplog(self, to_username, remark_name):
@@ -533,7 +825,7 @@ class WebWxClient:
         }
         r = self._send_request(url, data)
         dic = r.json()
-        success = dic['BaseResponse']['Ret'] == 0
+        success = _count_ret(r.url, dic) == 0
         return success
 
     def webwxrevokemsg(self, msgid, to_username):
@@ -548,10 +840,12 @@ class WebWxClient:
         }
         r = self._send_request(url, data)
         dic = r.json()
-        success = dic['BaseResponse']['Ret'] == 0
+        success = _count_ret(r.url, dic) == 0
         return success
 
     def webwxsendmsg(self, to_username, content):
+        # raises RateLimited instead of waiting for a token, the caller defers the send
+        self.send_limiter.check(to_username)
         url = self.base_uri + '/webwxsendmsg?pass_ticket=%s' % self.pass_ticket
         client_msg_id = self._gen_client_msg_id()
         data = {
@@ -567,20 +861,24 @@ class WebWxClient:
         }
         r = self._send_request(url, data)
         dic = r.json()
-        success = dic['BaseResponse']['Ret'] == 0
+        success = _count_ret(r.url, dic) == 0
         return success
 
     def webwxsendmsgimg(self, to_username, file_url):
-        media_id, _ = self._webwxuploadmedia(file_url)
-        if not media_id:
-            return
+        return self._send_media(to_username, file_url, self._webwxsendmsgimg)
+
+    def webwxsendappmsg(self, to_username, file_url):
+        return self._send_media(to_username, file_url, self._webwxsendappmsg)
+
+    def _webwxsendmsgimg(self, to_username, file_url, media: MediaIdCacheEntry) -> int:
+        self.send_limiter.check(to_username)
         url = self.base_uri + '/webwxsendmsgimg?fun=async&f=json&pass_ticket=%s' % self.pass_ticket
         client_msg_id = self._gen_client_msg_id()
         data = {
             'BaseRequest': self.base_request,
             'Msg':         {
                 'Type':         3,
-                'MediaId':      media_id,
+                'MediaId':      media.media_id,
                 'FromUserName': self.user.username,
                 'ToUserName':   to_username,
                 'LocalID':      client_msg_id,
@@ -588,14 +886,10 @@ class WebWxClient:
             }
         }
         r = self._send_request(url, data)
-        dic = r.json()
-        success = dic['BaseResponse']['Ret'] == 0
-        return success
+        return _count_ret(r.url, r.json())
 
-    def webwxsendappmsg(self, to_username, file_url):
-        media_id, file_size = self._webwxuploadmedia(file_url)
-        if not media_id:
-            return
+    def _webwxsendappmsg(self, to_username, file_url, media: MediaIdCacheEntry) -> int:
+        self.send_limiter.check(to_username)
         url = self.base_uri + '/webwxsendappmsg?fun=async&f=json&pass_ticket=' + self.pass_ticket
         client_msg_id = self._gen_client_msg_id()
         params = {
@@ -603,8 +897,8 @@ class WebWxClient:
             'Msg':         {
                 'Type':         6,
                 'Content':      "<appmsg appid='wxeb7ec651dd0aefa9' sdkver=''><title>%s</title><des></des><action></action><type>6</type><content></content><url></url><lowurl></lowurl><appattach><totallen>%s</totallen><attachid>%s</attachid><fileext>%s</fileext></appattach><extinfo></extinfo></appmsg>" % (
-                    os.path.basename(file_url), file_size,
-                    media_id,
+                    os.path.basename(file_url), media.file_size,
+                    media.media_id,
                     file_url.split('.')[-1]),
                 'FromUserName': self.user.username,
                 'ToUserName':   to_username,
@@ -614,12 +908,57 @@ class WebWxClient:
         }
         data = json.dumps(params, ensure_ascii=False).encode()
         dic = self.session.post(url, data=data).json()
-        success = dic['BaseResponse']['Ret'] == 0
-        return success
+        return _count_ret(url, dic)
+
+    def _send_media(self, to_username, file_url, send):
+        """
+        upload file_url, or reuse its cached MediaId, and send it
+        :param send: posts the message for (to_username, file_url, MediaIdCacheEntry), returns BaseResponse.Ret
+        :return: None if the upload failed
+        """
+        media, cached = self._upload_media_cached(file_url)
+        if not media:
+            return
+        ret = send(to_username, file_url, media)
+        if cached and ret in self.media_id_rejected_rets:
+            # the cached MediaId expired, upload once more and send once more, other failures are
+            # left to the caller's retry
+            self.logger.info(f'Cached MediaId of {file_url} rejected with Ret {ret}, uploading again')
+            self.media_id_cache.invalidate(media)
+            media, _ = self._upload_media_cached(file_url)
+            if not media:
+                return
+            ret = send(to_username, file_url, media)
+        return ret == 0
+
+    def _upload_media_cached(self, file_url):
+        """
+        :return: (MediaIdCacheEntry, whether it came from the cache), entry is None if the upload failed
+        """
+        # local files are looked up by content, they may change under the same path
+        sha256 = self._sha256_of_file(file_url) if os.path.isfile(file_url) else None
 
-    def _webwxuploadmedia(self, file_url):
-        url = 'https://file.wx2.qq.com/cgi-bin/mmwebwx-bin/webwxuploadmedia?f=json'
+        def upload():
+            digest = hashlib.sha256()
+            media_id, file_size = self._webwxuploadmedia(file_url, digest)
+            return media_id, file_size, digest.hexdigest()
 
+        return self.media_id_cache.get_or_upload(file_url, upload, sha256)
+
+    @staticmethod
+    def _sha256_of_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(functools.partial(f.read, 1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _webwxuploadmedia(self, file_url, digest=None):
+        """
+        upload a local file or the file of an url, chunk by chunk, at most one chunk is held in memory
+        :param digest: hashlib object updated with the uploaded content
+        :return: (MediaId, file size), (None, 0) if failed
+        """
         file_name = os.path.basename(file_url)
         # MIME type
         # mime_type = application/pdf, image/jpeg, image/png, etc.
@@ -632,25 +971,26 @@ class WebWxClient:
             media_type = 'doc'
         now = arrow.now()
         last_modified_datetime = f'{now:ddd MMM DD YYYY HH:mm:ss} GMT{now:Z} (CST)'
-        file_content = requests.get(file_url).content
-        file_size = len(file_content)
         client_media_id = self._gen_client_msg_id()
         # get webwx_data_ticket from cookie
         webwx_data_ticket = self.session.cookies['webwx_data_ticket']
 
-        uploadmediarequest = json.dumps({
-            'BaseRequest':   self.base_request,
-            'ClientMediaId': client_media_id,
-            'TotalLen':      file_size,
-            'StartPos':      0,
-            'DataLen':       file_size,
-            'MediaType':     4
-        }, ensure_ascii=False).encode()
-
-        # counter
-        self.media_count += 1
-        multipart_encoder = MultipartEncoder(
-            fields={
+        with MediaSource(file_url, timeout=self.upload_timeout) as source:
+            file_size = source.size
+            chunks = max(1, -(-file_size // self.upload_chunk_size))
+            # the web client describes the whole file in every chunk, chunk/chunks locate the part
+            uploadmediarequest = json.dumps({
+                'BaseRequest':   self.base_request,
+                'ClientMediaId': client_media_id,
+                'TotalLen':      file_size,
+                'StartPos':      0,
+                'DataLen':       file_size,
+                'MediaType':     4
+            }, ensure_ascii=False).encode()
+
+            # counter
+            self.media_count += 1
+            fields = {
                 'id':                 'WU_FILE_' + str(self.media_count),
                 'name':               file_name,
                 'type':               'application/octet-stream',
@@ -659,30 +999,57 @@ class WebWxClient:
                 'mediatype':          media_type,
                 'uploadmediarequest': uploadmediarequest,
                 'webwx_data_ticket':  webwx_data_ticket,
-                'pass_ticket':        self.pass_ticket,
-                'filename':           (file_name, file_content, 'application/octet-stream')
-            },
-            boundary='-----------------------------1575017231431605357584454111'
-        )
-
-        headers = {
-            'Host':            'file2.wx.qq.com',
-            'User-Agent':      'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:42.0) Gecko/20100101 Firefox/42.0',
-            'Accept':          'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate',
-            'Referer':         'https://wx2.qq.com/',
-            'Content-Type':    multipart_encoder.content_type,
-            'Origin':          'https://wx2.qq.com',
-            'Connection':      'keep-alive',
-            'Pragma':          'no-cache',
-            'Cache-Control':   'no-cache'
-        }
+                'pass_ticket':        self.pass_ticket
+            }
+            media_id = None
+            for index, chunk in enumerate(source.chunks(self.upload_chunk_size)):
+                if digest is not None:
+                    digest.update(chunk)
+                if chunks > 1:
+                    fields['chunks'] = str(chunks)
+                    fields['chunk'] = str(index)
+                media_id = self._upload_chunk(fields, file_name, chunk)
+                if media_id is None:
+                    self.logger.error(f'Uploading chunk {index}/{chunks} of {file_url} failed')
+                    return None, 0
+        if not media_id:
+            return None, 0
+        return media_id, file_size
 
-        r = self.session.post(url, data=multipart_encoder, headers=headers)
-        response_json = r.json()
-        if response_json['BaseResponse']['Ret'] == 0:
-            return response_json['MediaId'], file_size
+    def _upload_chunk(self, fields, file_name, chunk):
+        """
+        upload one chunk, retried upload_chunk_retries times from the chunk kept in memory
+        :return: MediaId, empty until the last chunk, None if failed
+        """
+        url = self.upload_uri + '/webwxuploadmedia?f=json'
+        for attempt in range(self.upload_chunk_retries):
+            multipart_encoder = MultipartEncoder(
+                fields=dict(fields, filename=(file_name, chunk, 'application/octet-stream')),
+                boundary='-----------------------------1575017231431605357584454111'
+            )
+            headers = {
+                'Host':            'file2.wx.qq.com',
+                'User-Agent':      'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.10; rv:42.0) Gecko/20100101 Firefox/42.0',
+                'Accept':          'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'en-US,en;q=0.5',
+                'Accept-Encoding': 'gzip, deflate',
+                'Referer':         'https://wx2.qq.com/',
+                'Content-Type':    multipart_encoder.content_type,
+                'Origin':          'https://wx2.qq.com',
+                'Connection':      'keep-alive',
+                'Pragma':          'no-cache',
+                'Cache-Control':   'no-cache'
+            }
+            try:
+                r = self.session.post(url, data=multipart_encoder, headers=headers, timeout=self.upload_timeout)
+                response_json = r.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.logger.warning(f'Uploading chunk failed, attempt {attempt + 1}: {e}')
+                continue
+            if _count_ret(url, response_json) == 0:
+                return response_json['MediaId']
+            self.logger.warning(f"Uploading chunk failed, attempt {attempt + 1}: {response_json['BaseResponse']}")
+        return None
 
     @abstractmethod
     def handle_text(self, msg):
@@ -749,7 +1116,7 @@ class WebWxClient:
         生成uuid
         :return:
         """
-        url = 'https://login.weixin.qq.com/jslogin'
+        url = self.login_uri + '/jslogin'
         params = {
             'appid': 'wx782c26e4c19acffb',
             'fun':   'new',
@@ -766,16 +1133,15 @@ class WebWxClient:
     def _gen_device_id():
         return 'e' + repr(random.random())[2:17]
 
-    @staticmethod
-    def _print_login_qrcode(uuid):
+    def _print_login_qrcode(self, uuid):
         qr = qrcode.QRCode()
         qr.border = 1
-        qr.add_data(f'https://login.weixin.qq.com/l/{uuid}')
+        qr.add_data(f'{self.login_uri}/l/{uuid}')
         qr.make()
         qr.print_ascii(invert=True)
 
     def _get_qrcode_status(self, tip=1):
-        url = 'https://login.weixin.qq.com/cgi-bin/mmwebwx-bin/login'
+        url = self.login_uri + '/cgi-bin/mmwebwx-bin/login'
         params = {
             'loginicon': True,
             'tip':       tip,
@@ -819,5 +1185,5 @@ class WebWxClient:
 
     def _send_request(self, url, data):
         headers = {'content-type': 'application/json;charset=UTF-8'}
-        data = json.dumps(data, ensure_ascii=False).encode()
+        data = self.serializer.dumps(data)
         return self.session.post(url, data=data, headers=headers)
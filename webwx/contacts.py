@@ -0,0 +1,163 @@
+import threading
+from typing import Dict, Set, List, Union, Iterable
+
+from webwx.models import Contact, Friend, ChatRoom, MediaPlatform, SpecialUser, ChatroomMember
+
+
+class ContactStore:
+    """
+    one instance per username, typed views and name indexes all point at the same instances
+
+    Views are plain dicts which are never rebound, so they can be shared as attributes of the client.
+    """
+
+    def __init__(self, special_usernames):
+        self.special_usernames = set(special_usernames)
+        self.user: Friend = None
+        # all contacts(including media_platforms special_users chatrooms and self)
+        self.contacts: Dict[str, Contact] = {}
+        self.friends: Dict[str, Friend] = {}
+        self.chatrooms: Dict[str, ChatRoom] = {}
+        self.media_platforms: Dict[str, MediaPlatform] = {}
+        self.special_users: Dict[str, SpecialUser] = {}
+        # name -> username, or a set of usernames when the name is shared
+        self.by_remark_name: Dict[str, Union[str, Set[str]]] = {}
+        self.by_nickname: Dict[str, Union[str, Set[str]]] = {}
+        # chatroom member username -> chatroom username, or a set of them
+        self.member_chatrooms: Dict[str, Union[str, Set[str]]] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.contacts)
+
+    def __contains__(self, username):
+        return username in self.contacts
+
+    def get(self, username) -> Contact:
+        return self.contacts.get(username)
+
+    def set_user(self, user: Friend):
+        with self._lock:
+            if self.user:
+                self._remove(self.user.username)
+            self.user = user
+            self.contacts[user.username] = user
+            self._index(user)
+
+    def upsert(self, contact_json: dict) -> Contact:
+        """
+        create the contact, or update the existing instance in place
+        """
+        username = contact_json['UserName']
+        cls, view = self._classify(contact_json)
+        with self._lock:
+            contact = self.contacts.get(username)
+            if contact is not None and type(contact) is cls:
+                self._unindex(contact)
+                contact.update(contact_json)
+            else:
+                if contact is not None:
+                    # the contact changed its type, e.g. a friend turned into a media platform
+                    self._remove(username)
+                contact = cls(contact_json)
+                self.contacts[username] = contact
+                if view is not None:
+                    view[username] = contact
+            self._index(contact)
+            return contact
+
+    def find_by_remark_name(self, remark_name) -> List[Contact]:
+        return self._find(self.by_remark_name, remark_name)
+
+    def find_by_nickname(self, nickname) -> List[Contact]:
+        return self._find(self.by_nickname, nickname)
+
+    def set_chatroom_members(self, chatroom: ChatRoom, members: Iterable[ChatroomMember]):
+        """
+        replace the member list of the chatroom and update the reverse membership index
+        """
+        with self._lock:
+            old_members = chatroom.member_list
+            chatroom.set_members(members)
+            for username in chatroom.member_list:
+                if username not in old_members:
+                    _index_add(self.member_chatrooms, username, chatroom.username)
+            for username in old_members:
+                if username not in chatroom.member_list:
+                    _index_discard(self.member_chatrooms, username, chatroom.username)
+
+    def chatrooms_of(self, username) -> List[ChatRoom]:
+        """
+        chatrooms the user is a member of, only chatrooms with fetched member detail are known
+        """
+        return self._find(self.member_chatrooms, username)
+
+    def get_member(self, chatroom_username, username) -> ChatroomMember:
+        chatroom = self.chatrooms.get(chatroom_username)
+        if chatroom is None:
+            return None
+        return chatroom.member_list.get(username)
+
+    def _find(self, index, key):
+        with self._lock:
+            usernames = index.get(key)
+            if usernames is None:
+                return []
+            if isinstance(usernames, str):
+                return [self.contacts[usernames]]
+            return [self.contacts[username] for username in usernames]
+
+    def _classify(self, contact_json):
+        username = contact_json['UserName']
+        if self.user and username == self.user.username:
+            return Friend, None
+        if contact_json['VerifyFlag'] & 8 != 0:
+            return MediaPlatform, self.media_platforms
+        if username in self.special_usernames:
+            return SpecialUser, self.special_users
+        if '@@' in username:
+            return ChatRoom, self.chatrooms
+        return Friend, self.friends
+
+    def _remove(self, username):
+        contact = self.contacts.pop(username)
+        self._unindex(contact)
+        if isinstance(contact, ChatRoom):
+            self.set_chatroom_members(contact, ())
+        for view in (self.friends, self.chatrooms, self.media_platforms, self.special_users):
+            view.pop(username, None)
+
+    def _index(self, contact: Contact):
+        if contact.remark_name:
+            _index_add(self.by_remark_name, contact.remark_name, contact.username)
+        if contact.nickname:
+            _index_add(self.by_nickname, contact.nickname, contact.username)
+
+    def _unindex(self, contact: Contact):
+        _index_discard(self.by_remark_name, contact.remark_name, contact.username)
+        _index_discard(self.by_nickname, contact.nickname, contact.username)
+
+
+def _index_add(index, key, username):
+    usernames = index.get(key)
+    if usernames is None:
+        # most keys map to a single username, a set per key would cost more than the contact itself
+        index[key] = username
+    elif isinstance(usernames, str):
+        if usernames != username:
+            index[key] = {usernames, username}
+    else:
+        usernames.add(username)
+
+
+def _index_discard(index, key, username):
+    usernames = index.get(key)
+    if usernames is None:
+        return
+    if isinstance(usernames, str):
+        if usernames == username:
+            del index[key]
+    else:
+        usernames.discard(username)
+        if len(usernames) == 1:
+            index[key] = usernames.pop()
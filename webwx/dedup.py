@@ -0,0 +1,106 @@
+import logging
+import threading
+from abc import abstractmethod
+from collections import deque
+from typing import List
+
+from webwx import metrics
+
+SEEN_MSGS = metrics.counter('chatbot_seen_msgs_total', 'AddMsgList entries checked for replays, by result',
+                            ('result',))
+SEEN_BACKEND_FAILURES = metrics.counter('chatbot_seen_backend_failures_total',
+                                        'failed lookups of the seen MsgId backend')
+
+class SeenBackend:
+    """
+    MsgIds seen by previous processes, e.g. before a restart
+    """
+
+    @abstractmethod
+    def add_many(self, msg_ids: List[str]) -> List[bool]:
+        """
+        :return: for every MsgId, whether it was not seen before
+        """
+        pass
+
+
+class SeenWindow:
+    """
+    the last max_size MsgIds received, replayed AddMsgList entries are dropped before any download or publish
+
+    Memory is constant: a ring buffer evicts the oldest MsgId from the hash set.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_size=10000, backend: SeenBackend = None):
+        """
+        :param backend: asked about the MsgIds missing from the window, the window alone is used if it fails
+        """
+        self.max_size = max_size
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._ring = deque(maxlen=max_size)
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._seen
+
+    def filter(self, add_msg_list) -> list:
+        """
+        :return: the entries not seen before, in order, they are marked as seen
+        """
+        with self._lock:
+            fresh = []
+            msg_ids = set()
+            for add_msg in add_msg_list:
+                msg_id = add_msg['MsgId']
+                # a batch may repeat an entry too
+                if msg_id in self._seen or msg_id in msg_ids:
+                    self.hits += 1
+                    SEEN_MSGS.inc('duplicate')
+                    continue
+                msg_ids.add(msg_id)
+                fresh.append(add_msg)
+            if fresh and self.backend is not None:
+                fresh = self._filter_backend(fresh)
+            for add_msg in fresh:
+                self._add(add_msg['MsgId'])
+            self.misses += len(fresh)
+            if fresh:
+                SEEN_MSGS.inc('new', amount=len(fresh))
+        return fresh
+
+    def clear(self):
+        with self._lock:
+            self._ring.clear()
+            self._seen.clear()
+
+    def _filter_backend(self, add_msg_list):
+        try:
+            not_seen = self.backend.add_many([add_msg['MsgId'] for add_msg in add_msg_list])
+        except Exception as e:
+            SEEN_BACKEND_FAILURES.inc()
+            self.logger.warning(f'Seen MsgId backend failed, deduplicate in memory only: {e}')
+            return add_msg_list
+        fresh = []
+        for add_msg, new in zip(add_msg_list, not_seen):
+            if new:
+                fresh.append(add_msg)
+            else:
+                self.hits += 1
+                SEEN_MSGS.inc('duplicate_backend')
+                # seen by a previous process, remember it here as well
+                self._add(add_msg['MsgId'])
+        return fresh
+
+    def _add(self, msg_id):
+        if len(self._ring) == self.max_size:
+            # appending drops the oldest from the ring
+            self._seen.discard(self._ring[0])
+        self._ring.append(msg_id)
+        self._seen.add(msg_id)
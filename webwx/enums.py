@@ -35,6 +35,8 @@ class MsgType(IntEnum):
 class EventType(IntEnum):
     # message
     SEND_MESSAGE = 101
+    # publish the full image of a message ingested as thumbnail
+    FETCH_FULL_IMAGE = 102
 
     # friend management
     AGREE_FRIEND_REQUEST = 201
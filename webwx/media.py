@@ -0,0 +1,177 @@
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import requests
+
+
+class _Entry:
+    __slots__ = ('deliver', 'ready', 'failed', 'args')
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.ready = False
+        self.failed = False
+        self.args = ()
+
+
+class MediaFetcher:
+    """
+    download media of incoming messages on a bounded thread pool
+
+    Deliveries are ordered per conversation: a message is delivered only after every message
+    submitted before it in the same conversation, whether or not those needed a download.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='webwx-media')
+        self._lock = threading.Lock()
+        # notified when nothing is pending or being delivered any more
+        self._idle = threading.Condition(self._lock)
+        # conversation -> entries waiting to be delivered
+        self._pending: Dict[str, deque] = {}
+        # conversations currently being delivered by some thread
+        self._draining = set()
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(entries) for entries in self._pending.values())
+
+    def submit(self, conversation, deliver, fetch=None):
+        """
+        :param conversation: deliveries with the same conversation keep the submitting order
+        :param deliver: called with the fetched content, or without arguments when fetch is None
+        :param fetch: callable downloading the content on the pool, None if nothing to download
+        """
+        entry = _Entry(deliver)
+        with self._lock:
+            if fetch is None and conversation not in self._pending:
+                # nothing is waiting in this conversation, deliver on the caller's thread
+                entry = None
+            else:
+                self._pending.setdefault(conversation, deque()).append(entry)
+        if entry is None:
+            self._safe_deliver(deliver)
+        elif fetch is None:
+            self._complete(conversation, entry, (), False)
+        else:
+            self._executor.submit(self._fetch, conversation, entry, fetch)
+
+    def join(self, timeout=None) -> bool:
+        """
+        wait until every submitted message is delivered
+        :return: False on timeout
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending and not self._draining, timeout)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _fetch(self, conversation, entry, fetch):
+        try:
+            content = fetch()
+        except Exception as e:
+            self.logger.error(f'Fetching media failed: {e}')
+            self._complete(conversation, entry, (), True)
+        else:
+            self._complete(conversation, entry, (content,), False)
+
+    def _complete(self, conversation, entry, args, failed):
+        with self._lock:
+            entry.args = args
+            entry.failed = failed
+            entry.ready = True
+            if conversation in self._draining:
+                # the draining thread will pick this entry up
+                return
+            self._draining.add(conversation)
+        self._drain(conversation)
+
+    def _drain(self, conversation):
+        while True:
+            with self._lock:
+                entries = self._pending[conversation]
+                if not entries or not entries[0].ready:
+                    self._draining.discard(conversation)
+                    if not entries:
+                        del self._pending[conversation]
+                        if not self._pending and not self._draining:
+                            self._idle.notify_all()
+                    return
+                entry = entries.popleft()
+            if not entry.failed:
+                self._safe_deliver(entry.deliver, *entry.args)
+
+    def _safe_deliver(self, deliver, *args):
+        try:
+            deliver(*args)
+        except Exception as e:
+            self.logger.exception(e)
+
+
+class MediaSource:
+    """
+    sized byte stream over a local file or the response of an url, read chunk by chunk
+
+    Responses without a usable Content-Length are spooled to a temporary file first.
+    """
+    # bytes of a spooled response kept in memory before rolling over to disk
+    spool_max_memory = 1024 * 1024
+
+    def __init__(self, file_url, timeout=None):
+        self._response = None
+        if os.path.isfile(file_url):
+            self._file = open(file_url, 'rb')
+            self.size = os.path.getsize(file_url)
+            return
+        r = requests.get(file_url, stream=True, timeout=timeout)
+        r.raise_for_status()
+        length = r.headers.get('Content-Length')
+        if length and not r.headers.get('Content-Encoding'):
+            self._response = r
+            self._file = r.raw
+            self.size = int(length)
+        else:
+            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_memory)
+            for block in r.iter_content(64 * 1024):
+                spool.write(block)
+            r.close()
+            self.size = spool.tell()
+            spool.seek(0)
+            self._file = spool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def chunks(self, chunk_size):
+        while True:
+            chunk = self._read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        else:
+            self._file.close()
+
+    def _read(self, size):
+        # raw responses may return less than asked before the end of stream
+        chunk = self._file.read(size)
+        while chunk and len(chunk) < size:
+            more = self._file.read(size - len(chunk))
+            if not more:
+                break
+            chunk += more
+        return chunk
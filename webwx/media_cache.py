@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+
+
+class MediaIdCacheEntry:
+    __slots__ = ('media_id', 'file_size', 'sha256', 'expires_at')
+
+    def __init__(self, media_id, file_size, sha256, expires_at):
+        self.media_id = media_id
+        self.file_size = file_size
+        self.sha256 = sha256
+        self.expires_at = expires_at
+
+
+class MediaIdCache:
+    """
+    MediaId of uploaded files keyed by source url and by content hash, with LRU and TTL eviction
+
+    Concurrent misses of the same url are collapsed into a single upload.
+    """
+
+    def __init__(self, max_entries=1024, ttl=6 * 3600):
+        """
+        :param max_entries: keys kept, the least recently used are evicted
+        :param ttl: seconds a MediaId is reused
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 'url:...' or 'sha256:...' -> entry
+        self._entries: OrderedDict = OrderedDict()
+        # url -> event set when its upload finished
+        self._loading: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, file_url, sha256=None) -> MediaIdCacheEntry:
+        """
+        :param sha256: content hash if known up front, it takes precedence over the url whose
+                       content may have changed
+        """
+        with self._lock:
+            entry = self._get('sha256:' + sha256) if sha256 else self._get('url:' + file_url)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if sha256:
+                # alias the url of a content hit
+                self._put('url:' + file_url, entry)
+            return entry
+
+    def put(self, file_url, sha256, media_id, file_size) -> MediaIdCacheEntry:
+        entry = MediaIdCacheEntry(media_id, file_size, sha256, time.monotonic() + self.ttl)
+        with self._lock:
+            self._put('url:' + file_url, entry)
+            if sha256:
+                self._put('sha256:' + sha256, entry)
+        return entry
+
+    def get_or_upload(self, file_url, upload, sha256=None):
+        """
+        :param upload: called on a miss, returns (media_id, file_size, sha256), media_id None if failed
+        :return: (entry or None if the upload failed, whether the entry came from the cache)
+        """
+        while True:
+            entry = self.get(file_url, sha256)
+            if entry is not None:
+                return entry, True
+            with self._lock:
+                event = self._loading.get(file_url)
+                if event is None:
+                    event = self._loading[file_url] = threading.Event()
+                    break
+            # another thread uploads the same url, use its result
+            event.wait()
+        try:
+            media_id, file_size, sha256 = upload()
+            if not media_id:
+                return None, False
+            return self.put(file_url, sha256, media_id, file_size), False
+        finally:
+            with self._lock:
+                del self._loading[file_url]
+            event.set()
+
+    def invalidate(self, entry: MediaIdCacheEntry):
+        """
+        drop every key pointing at the entry, e.g. when sending its MediaId failed
+        """
+        with self._lock:
+            for key in [key for key, value in self._entries.items() if value is entry]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
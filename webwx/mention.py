@@ -0,0 +1,59 @@
+from typing import List
+
+# characters following a mentioned name, see README
+MENTION_TERMINATORS = ('\ufe0f', '\u2005', ' ')
+
+
+class MentionIndex:
+    """
+    the names chatroom members can be mentioned by, i.e. display names and nicknames
+
+    Several members may share a name, every one of them is reported when the name is mentioned.
+    Only a name -> usernames dict and the longest name length are kept, the names are those of the members.
+    """
+    __slots__ = ('_names', '_max_length')
+
+    def __init__(self, members=()):
+        # name -> username, or a tuple of usernames for the names shared by several members
+        self._names = {}
+        self._max_length = 0
+        for member in members:
+            self._add(member.display_name, member.username)
+            self._add(member.nickname, member.username)
+
+    def _add(self, name, username):
+        if not name:
+            return
+        usernames = self._names.get(name)
+        if usernames is None:
+            self._names[name] = username
+        elif isinstance(usernames, str):
+            if usernames != username:
+                self._names[name] = (usernames, username)
+        elif username not in usernames:
+            self._names[name] = usernames + (username,)
+        self._max_length = max(self._max_length, len(name))
+
+    def find_mentions(self, text) -> List[str]:
+        """
+        usernames mentioned by @name in the text, the longest name followed by a terminator wins
+        """
+        mentioned = []
+        start = text.find('@')
+        while start != -1:
+            usernames = None
+            end = min(len(text), start + 1 + self._max_length)
+            while end > start + 1:
+                if end == len(text) or text[end] in MENTION_TERMINATORS:
+                    usernames = self._names.get(text[start + 1:end])
+                    if usernames is not None:
+                        break
+                end -= 1
+            if usernames is not None:
+                for username in (usernames,) if isinstance(usernames, str) else usernames:
+                    if username not in mentioned:
+                        mentioned.append(username)
+                start = text.find('@', end)
+            else:
+                start = text.find('@', start + 1)
+        return mentioned
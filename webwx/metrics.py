@@ -0,0 +1,247 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from typing import Callable, Dict, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from webwx.utils import NullContext, ThreadingHTTPServer
+
+# seconds, from a cached request to a long poll
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_NULL_CONTEXT = NullContext()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, registry: 'Registry', name, documentation, labelnames=()):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+    def _samples(self):
+        return []
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        super().__init__(registry, name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount=1):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {value}' for labels, value in values]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        super().__init__(registry, name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set(self, value, *labels):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, func: Callable[[], float], *labels):
+        """
+        the value is read from func on every scrape, e.g. a queue depth
+        """
+        with self._lock:
+            self._functions[labels] = func
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.items())
+        for labels, func in functions:
+            try:
+                values[labels] = func()
+            except Exception:
+                continue
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {value}' for labels, value in values.items()]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count of every bucket, +Inf count, sum]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value, *labels):
+        if not self._registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        """
+        context manager observing the seconds its block took
+        """
+        if not self._registry.enabled:
+            return _NULL_CONTEXT
+        return self._time(labels)
+
+    @contextmanager
+    def _time(self, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        samples = []
+        for labels, counts in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, f'le="{bucket}"')
+                samples.append(f'{self.name}_bucket{le} {cumulative}')
+            samples.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {counts[-1]}')
+            samples.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}')
+        return samples
+
+
+class Registry:
+    """
+    metrics rendered in the Prometheus text format
+
+    Disabled until enable is called, recording on a disabled registry returns at once.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'{name} is registered as a {metric.type} already')
+            return metric
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# depths of the in-process queues, set_function(lambda: ..., '<queue>') by their owners
+QUEUE_DEPTH = gauge('chatbot_queue_depth', 'items waiting in an in-process queue', ('queue',))
+
+
+class MetricsServer:
+    """
+    serve GET /metrics of the registry from a daemon thread
+
+    routes maps further paths to functions taking the query parameters and returning (content type, body).
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, port, host='127.0.0.1', registry: Registry = REGISTRY):
+        self.registry = registry
+        self.routes: Dict[str, Callable[[Dict[str, str]], Tuple[str, bytes]]] = {
+            '/metrics': lambda query: ('text/plain; version=0.0.4; charset=utf-8', self.registry.render().encode())
+        }
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                route = server.routes.get(url.path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    content_type, body = route(query)
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.registry.enable()
+        threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True).start()
+        self.logger.info(f'Serving metrics on :{self.port}/metrics')
@@ -1,27 +1,76 @@
-from typing import Dict
-from xml.dom import minidom
-
-from webwx import utils
+import base64
+from abc import abstractmethod
+from typing import Dict, Iterable
+from webwx import utils, xmlparse
 from webwx.enums import VerifyFlag, Sex, MsgType
+from webwx.mention import MentionIndex
 
 
 def _unescape_emoji(text):
-    if 'emoji' not in text:
-        return text
-    return utils.replace_emoji(text)
+    return utils.replace_emoji_in_name(text)
+
+
+class Encodable:
+    """
+    json and its encoding, built on every call
+    """
+    __slots__ = ()
 
+    @abstractmethod
+    def _build_json(self) -> dict:
+        pass
+
+    @property
+    def json(self) -> dict:
+        return self._build_json()
 
-class Contact:
+    def encode(self, serializer):
+        return serializer.dumps(self.json)
+
+
+class CachedEncodable(Encodable):
+    """
+    json built once, and its encoding by the last serializer used, cached until invalidate is called
+    """
+    __slots__ = ('_json', '_encoded')
+
+    @property
+    def json(self) -> dict:
+        """
+        shared by every caller, don't modify it
+        """
+        if self._json is None:
+            self._json = self._build_json()
+        return self._json
+
+    def encode(self, serializer):
+        encoded = self._encoded
+        if encoded is None or encoded[0] is not serializer:
+            encoded = self._encoded = (serializer, serializer.dumps(self.json))
+        return encoded[1]
+
+    def invalidate(self):
+        self._json = None
+        self._encoded = None
+
+
+class Contact(Encodable):
+    """
+    not cached, contacts live as long as the session and RedisHashMirror skips the unchanged fields anyway
+    """
+    __slots__ = ('username', 'head_img_url', 'nickname', 'remark_name', 'sex')
 
     def __init__(self, user_dict: dict):
         self.username = user_dict['UserName']
+        self.update(user_dict)
+
+    def update(self, user_dict: dict):
         self.head_img_url = user_dict['HeadImgUrl']
         self.nickname = _unescape_emoji(user_dict['NickName'])
         self.remark_name = _unescape_emoji(user_dict['RemarkName'])
         self.sex = Sex(user_dict['Sex'])
 
-    @property
-    def json(self):
+    def _build_json(self):
         return {
             'username':     self.username,
             'head_img_url': self.head_img_url,
@@ -32,10 +81,12 @@ class Contact:
 
 
 class SpecialUser(Contact):
+    __slots__ = ()
     verify_flag = VerifyFlag.PERSON
 
 
 class Friend(Contact):
+    __slots__ = ()
     verify_flag = VerifyFlag.PERSON
 
     def __init__(self, user_dict: dict):
@@ -43,6 +94,8 @@ class Friend(Contact):
 
 
 class ChatroomMember:
+    __slots__ = ('username', 'nickname', 'display_name')
+
     def __init__(self, user_dict: dict):
         self.username = user_dict['UserName']
         # remark name if contact is remarked, else is nickname
@@ -52,27 +105,51 @@ class ChatroomMember:
 
 
 class ChatRoom(Contact):
+    __slots__ = ('member_list', '_mention_index')
 
     def __init__(self, user_dict: dict):
         super().__init__(user_dict)
         # chatroom member profile is different from user profile
         self.member_list: Dict[str, ChatroomMember] = {}
+        # (member_list it was built from, MentionIndex), None until a text message mentions someone
+        self._mention_index = None
+
+    @property
+    def mention_index(self) -> MentionIndex:
+        """
+        built on the first text message with an @ in the chatroom, rebuilt once the members changed,
+        most chatrooms never need one
+        """
+        members = self.member_list
+        cached = self._mention_index
+        if cached is None or cached[0] is not members:
+            cached = self._mention_index = (members, MentionIndex(list(members.values())))
+        return cached[1]
+
+    def set_members(self, members: Iterable[ChatroomMember]):
+        # a new dict, readers iterating the former one are not disturbed
+        self.member_list = {member.username: member for member in members}
 
     def add_member(self, member: ChatroomMember):
         self.member_list[member.username] = member
+        self._mention_index = None
 
     def clear_members(self):
         self.member_list.clear()
+        self._mention_index = None
 
 
 class MediaPlatform(Contact):
+    __slots__ = ()
     verify_flag = VerifyFlag.COMMON_MP
 
     def __init__(self, user_dict: dict):
         super().__init__(user_dict)
 
 
-class Msg:
+class Msg(CachedEncodable):
+    __slots__ = ('msg_id', 'from_user', 'to_user', 'msg_type', 'create_time', 'content')
+
     def __init__(self, msg_id, from_user, to_user, content, create_time, msg_type=MsgType.UNHANDLED):
         self.msg_id = msg_id
         self.from_user = from_user
@@ -80,9 +157,9 @@ class Msg:
         self.msg_type = msg_type
         self.create_time = create_time
         self.content = content
+        self.invalidate()
 
-    @property
-    def json(self):
+    def _build_json(self):
         return {
             'msg_id':           self.msg_id,
             'msg_type':         self.msg_type,
@@ -98,52 +175,102 @@ class Msg:
 
 
 class TextMsg(Msg):
-    def __init__(self, msg: Msg, content):
+    __slots__ = ('mentioned_usernames',)
+
+    def __init__(self, msg: Msg, content, chatroom: 'ChatRoom' = None):
         super().__init__(msg.msg_id, msg.from_user, msg.to_user, msg.content, msg.create_time, MsgType.TEXT)
         self.content = utils.replace_emoji(content)
+        # members mentioned by @name when the message is sent in a chatroom
+        self.mentioned_usernames = chatroom.mention_index.find_mentions(self.content) \
+            if chatroom and '@' in self.content else []
+
+    def _build_json(self):
+        dic = super()._build_json()
+        dic.update({
+            'mentioned_usernames': self.mentioned_usernames
+        })
+        return dic
 
 
 class ImageMsg(Msg):
-    def __init__(self, msg: Msg, base64_content):
+    __slots__ = ('image', 'blob', 'thumbnail')
+
+    def __init__(self, msg: Msg, image: bytes, blob: dict = None, thumbnail=False):
+        """
+        :param image: image content
+        :param blob: reference of the image in a BlobStore, published instead of the content if set
+        :param thumbnail: the image is the thumbnail, the full image is published on FETCH_FULL_IMAGE
+        """
         super().__init__(msg.msg_id, msg.from_user, msg.to_user, msg.content, msg.create_time, MsgType.IMAGE)
-        self.base64_content = base64_content
+        self.image = image
+        self.blob = blob
+        self.thumbnail = thumbnail
 
     @property
-    def json(self):
-        dic = super().json
-        dic.update({
-            'base64_content': self.base64_content
-        })
+    def base64_content(self):
+        return base64.b64encode(self.image).decode()
+
+    def _build_json(self):
+        dic = super()._build_json()
+        dic['thumbnail'] = self.thumbnail
+        if self.blob:
+            dic.update({
+                'blob': self.blob
+            })
+        else:
+            dic.update({
+                'base64_content': self.base64_content
+            })
         return dic
 
 
 class EmotionMsg(Msg):
+    __slots__ = ('url',)
+
     def __init__(self, msg: Msg, content):
         super().__init__(msg.msg_id, msg.from_user, msg.to_user, msg.content, msg.create_time, MsgType.EMOTION)
         # wechat inside emotion has no content
-        self.url = ''
-        if content:
-            index = content.find('<msg>')
-            if index != -1:
-                content = content[index:]
-                self.url = self._parse_emotion_url(content)
+        self.url = xmlparse.find_attrs(xmlparse.msg_xml(content), 'emoji').get('cdnurl', '') if content else ''
 
-    @property
-    def json(self):
-        dic = super().json
+    def _build_json(self):
+        dic = super()._build_json()
         dic.update({
             'url': self.url
         })
         return dic
 
-    @staticmethod
-    def _parse_emotion_url(content):
-        doc = minidom.parseString(content)
-        root = doc.documentElement
-        return root.getElementsByTagName('emoji')[0].getAttribute('cdnurl')
+
+class LinkMsg(Msg):
+    """
+    shared article, music, file and other app messages
+    """
+    __slots__ = ('app_msg_type', 'title', 'url', 'des')
+
+    def __init__(self, msg: Msg, content):
+        super().__init__(msg.msg_id, msg.from_user, msg.to_user, msg.content, msg.create_time, MsgType.LINK)
+        values = xmlparse.find_texts(xmlparse.msg_xml(content),
+                                     ('appmsg/type', 'appmsg/title', 'appmsg/url', 'appmsg/des'))
+        # 5 is a shared article, 3 music, 6 a file, see README
+        app_msg_type = values.get('appmsg/type', '')
+        self.app_msg_type = int(app_msg_type) if app_msg_type.isdigit() else 0
+        self.title = values.get('appmsg/title', '')
+        self.url = values.get('appmsg/url', '')
+        self.des = values.get('appmsg/des', '')
+
+    def _build_json(self):
+        dic = super()._build_json()
+        dic.update({
+            'app_msg_type': self.app_msg_type,
+            'title':        self.title,
+            'url':          self.url,
+            'des':          self.des
+        })
+        return dic
 
 
 class LocationMsg(ImageMsg):
-    def __init__(self, msg: Msg, base64_content):
-        super().__init__(msg, base64_content)
+    __slots__ = ()
+
+    def __init__(self, msg: Msg, image: bytes, blob: dict = None):
+        super().__init__(msg, image, blob)
         self.msg_type = MsgType.LOCATION
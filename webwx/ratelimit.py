@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    """
+    raised by a send that would exceed the rate limit, nothing was sent, it may be tried again in delay seconds
+    """
+
+    def __init__(self, to_username, delay):
+        super().__init__(f'Sending to {to_username} is rate limited for {delay:.3f}s')
+        self.to_username = to_username
+        self.delay = delay
+
+
+class TokenBucket:
+    """
+    tokens are refilled at rate per second up to capacity, a token is taken only when one is available
+    """
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated_at')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def wait_time(self, now=None) -> float:
+        """
+        not thread safe
+        :return: seconds until a token is available, 0 if one is
+        """
+        now = time.monotonic() if now is None else now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self):
+        """
+        take the token wait_time found available, not thread safe
+        """
+        self._tokens -= 1
+
+
+class SendRateLimiter:
+    """
+    per-account and per-recipient token buckets in front of the send endpoints, they never block:
+    a send without tokens is deferred by its caller
+    """
+
+    def __init__(self, rate, burst, recipient_rate, recipient_burst, max_recipients=10000):
+        """
+        :param rate: messages per second of the whole account
+        :param burst: messages the account may send at once
+        :param recipient_rate: messages per second to one recipient
+        :param recipient_burst: messages one recipient may receive at once
+        :param max_recipients: recipient buckets kept, the least recently used are dropped
+        """
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_recipients = max_recipients
+        self._account = TokenBucket(rate, burst)
+        self._recipients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, to_username) -> float:
+        """
+        take a token of the account and of the recipient if both have one
+        :return: 0 if taken, else seconds until both may have one, nothing is taken then
+        """
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._recipients.get(to_username)
+            if bucket is None:
+                bucket = self._recipients[to_username] = TokenBucket(self.recipient_rate, self.recipient_burst)
+                if len(self._recipients) > self.max_recipients:
+                    self._recipients.popitem(last=False)
+            else:
+                self._recipients.move_to_end(to_username)
+            delay = max(self._account.wait_time(now), bucket.wait_time(now))
+            if delay == 0:
+                self._account.take()
+                bucket.take()
+        return delay
+
+    def check(self, to_username):
+        """
+        :raise RateLimited: no token was taken
+        """
+        delay = self.acquire(to_username)
+        if delay > 0:
+            raise RateLimited(to_username, delay)
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from enum import IntEnum
+from typing import Dict, Iterator, Tuple
+
+MAGIC = b'WXSYNC1\n'
+# kind, flags, payload length
+_HEADER = struct.Struct('>BBI')
+_COMPRESSED = 1
+# key length of a media payload, the key and the content follow
+_MEDIA_KEY = struct.Struct('>H')
+
+
+class RecordKind(IntEnum):
+    # raw response bodies
+    INIT = 1
+    CONTACTS = 2
+    BATCH_CONTACTS = 3
+    SYNC = 4
+    # key and content of a download, see media_key
+    MEDIA = 5
+
+
+def media_key(msg_id, kind='image'):
+    """
+    :param kind: 'image', 'thumbnail' or 'location'
+    """
+    return f'{msg_id}:{kind}'
+
+
+class SyncRecorder:
+    """
+    append the responses a session is built from, and the media they trigger, to a log replayed by ReplayClient
+
+    Every record is a header and its payload, compressed with zlib unless that does not make it smaller,
+    e.g. for JPEG. Records are flushed one by one, a log cut by a crash is readable up to its last record.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path, level=6):
+        """
+        :param path: appended to if it exists
+        :param level: zlib compression level
+        """
+        self.path = path
+        self.level = level
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def record(self, kind: RecordKind, payload: bytes):
+        flags = 0
+        compressed = zlib.compress(payload, self.level)
+        if len(compressed) < len(payload):
+            payload, flags = compressed, _COMPRESSED
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(_HEADER.pack(kind, flags, len(payload)))
+            self._file.write(payload)
+            self._file.flush()
+
+    def record_media(self, key, content: bytes):
+        key = key.encode()
+        self.record(RecordKind.MEDIA, _MEDIA_KEY.pack(len(key)) + key + content)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _decode(flags, payload):
+    return zlib.decompress(payload) if flags & _COMPRESSED else payload
+
+
+class SyncLog:
+    """
+    a log written by SyncRecorder, indexed for replays: contacts by username and media by key,
+    media are read from disk when asked for
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        # username -> the latest webwxbatchgetcontact json, with the chatroom members
+        self.contacts: Dict[str, dict] = {}
+        # key -> (flags, offset, length) of the payload
+        self._media: Dict[str, Tuple[int, int, int]] = {}
+        self.counts = {kind: 0 for kind in RecordKind}
+        for kind, flags, offset, length in self._scan(warn=True):
+            self.counts[kind] += 1
+            if kind == RecordKind.BATCH_CONTACTS:
+                for contact_json in json.loads(self._read(flags, offset, length))['ContactList']:
+                    self.contacts[contact_json['UserName']] = contact_json
+            elif kind == RecordKind.MEDIA:
+                self._media[self._media_key(flags, offset, length)] = (flags, offset, length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def records(self) -> Iterator[Tuple[RecordKind, bytes]]:
+        """
+        the INIT, CONTACTS and SYNC records in recording order, the others are served by contact and media
+        """
+        for kind, flags, offset, length in self._scan():
+            if kind in (RecordKind.INIT, RecordKind.CONTACTS, RecordKind.SYNC):
+                yield kind, self._read(flags, offset, length)
+
+    def media(self, key) -> bytes:
+        """
+        :return: None if it was not recorded
+        """
+        location = self._media.get(key)
+        if location is None:
+            return None
+        content = self._read(*location)
+        key_length, = _MEDIA_KEY.unpack_from(content)
+        return content[_MEDIA_KEY.size + key_length:]
+
+    def close(self):
+        os.close(self._fd)
+
+    def _scan(self, warn=False):
+        size = os.fstat(self._fd).st_size
+        if os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+            raise ValueError(f'{self.path} is not a sync log')
+        offset = len(MAGIC)
+        while offset + _HEADER.size <= size:
+            kind, flags, length = _HEADER.unpack(os.pread(self._fd, _HEADER.size, offset))
+            offset += _HEADER.size
+            if offset + length > size:
+                break
+            yield RecordKind(kind), flags, offset, length
+            offset += length
+        if offset != size and warn:
+            self.logger.warning(f'{self.path} ends with a truncated record, ignored')
+
+    def _read(self, flags, offset, length):
+        # pread is safe from the media fetcher threads
+        return _decode(flags, os.pread(self._fd, length, offset))
+
+    def _media_key(self, flags, offset, length):
+        if flags & _COMPRESSED:
+            content = self._read(flags, offset, length)
+            key_length, = _MEDIA_KEY.unpack_from(content)
+            return content[_MEDIA_KEY.size:_MEDIA_KEY.size + key_length].decode()
+        # the key alone, the content may be large
+        key_length, = _MEDIA_KEY.unpack(os.pread(self._fd, _MEDIA_KEY.size, offset))
+        return os.pread(self._fd, key_length, offset + _MEDIA_KEY.size).decode()
+
+
+class ReplayClient:
+    """
+    mixin feeding a SyncLog through the handle of a WebWxClient offline, as fast as it goes,
+    the missing contacts and the media are served from the log instead of webwx
+
+    class Replaying(ReplayClient, CustomClient): ...
+    """
+    sync_log: SyncLog = None
+
+    def replay(self, sync_log: SyncLog, wait=True) -> int:
+        """
+        :param wait: until the messages waiting for the media fetcher are handled too
+        :return: webwxsync responses handled
+        """
+        self.sync_log = sync_log
+        handled = 0
+        for kind, payload in sync_log.records():
+            dic = json.loads(payload)
+            if kind == RecordKind.SYNC:
+                self.handle(dic)
+                handled += 1
+            elif kind == RecordKind.INIT:
+                self.apply_init(dic)
+            else:
+                self._parse_contacts_json(dic['MemberList'])
+        if wait:
+            self.media_fetcher.join()
+        return handled
+
+    def webwxbatchgetcontact(self, username_list):
+        contact_list = []
+        for username in username_list:
+            contact_json = self.sync_log.contacts.get(username)
+            if contact_json is None:
+                # fetched before the recording started
+                self.logger.warning(f'{username} is not recorded, replayed with an empty profile')
+                contact_json = {'UserName': username, 'NickName': '', 'RemarkName': '', 'HeadImgUrl': '',
+                                'Sex': 0, 'VerifyFlag': 0, 'MemberList': []}
+            contact_list.append(contact_json)
+        self._parse_contacts_json(contact_list, True)
+        self.handle_update_contacts(username_list)
+        return True
+
+    def webwxgetmsgimg(self, msgid, timeout=None, thumbnail=False):
+        return self.sync_log.media(media_key(msgid, 'thumbnail' if thumbnail else 'image')) or b''
+
+    def webwxgetpubliclinkimg(self, msgid, timeout=None):
+        return self.sync_log.media(media_key(msgid, 'location')) or b''
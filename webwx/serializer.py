@@ -0,0 +1,106 @@
+import json
+from abc import abstractmethod
+from enum import Enum
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _default(obj):
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f'{type(obj).__name__} is not serializable')
+
+
+class Serializer:
+    """
+    encoding of the json of messages, contacts and webwx requests
+    """
+    name = ''
+
+    @abstractmethod
+    def dumps(self, obj):
+        pass
+
+
+class JsonSerializer(Serializer):
+    name = 'json'
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default).encode()
+
+
+class OrjsonSerializer(Serializer):
+    name = 'orjson'
+
+    def dumps(self, obj) -> bytes:
+        # enums, including IntEnum, are serialized natively
+        return orjson.dumps(obj, default=_default)
+
+
+class MsgpackSerializer(Serializer):
+    """
+    binary, the consumers have to decode msgpack instead of json
+    """
+    name = 'msgpack'
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+class RedisHashSerializer(Serializer):
+    """
+    json dict to a redis hash mapping, redis-py writes IntEnum members by repr instead of by value
+    """
+    name = 'redis_hash'
+
+    def __init__(self, serializer: Serializer = None):
+        """
+        :param serializer: encodes nested values, e.g. lists
+        """
+        self.serializer = serializer or get_serializer()
+
+    def dumps(self, obj: dict) -> dict:
+        return {key: self._value(value) for key, value in obj.items()}
+
+    def _value(self, value):
+        if isinstance(value, (str, bytes)):
+            return value
+        if isinstance(value, int):
+            # IntEnum and bool as plain numbers
+            return int(value)
+        if isinstance(value, float):
+            return value
+        if isinstance(value, Enum):
+            return self._value(value.value)
+        if value is None:
+            return ''
+        return self.serializer.dumps(value)
+
+
+def get_serializer(name=None) -> Serializer:
+    """
+    :param name: 'json', 'orjson' or 'msgpack', None for the fastest json one installed
+    """
+    if name is None:
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'json':
+        return JsonSerializer()
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        return OrjsonSerializer()
+    if name == 'msgpack':
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return MsgpackSerializer()
+    raise ValueError(f'Unknown serializer {name}')
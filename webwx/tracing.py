@@ -0,0 +1,191 @@
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from webwx.utils import NullContext
+
+_NULL_CONTEXT = NullContext()
+
+
+class Tracer:
+    """
+    spans of the ingest and send stages recorded as Chrome trace events, for chrome://tracing or Perfetto
+
+    Disabled until enable is called, span then returns a shared no-op context manager.
+    """
+
+    def __init__(self, max_events=100000):
+        """
+        :param max_events: spans kept, the oldest are dropped
+        """
+        self.enabled = False
+        self._events = collections.deque(maxlen=max_events)
+        # thread ident -> name, for the metadata events
+        self._threads: Dict[int, str] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name, **args):
+        """
+        context manager recording the duration of its block
+        :param args: shown with the span, e.g. msg_id
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            if thread.ident not in self._threads:
+                self._threads[thread.ident] = thread.name
+            # complete event, timestamps in microseconds
+            self._events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                                 'pid': os.getpid(), 'tid': thread.ident, 'args': args})
+
+    def export(self) -> dict:
+        pid = os.getpid()
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in list(self._threads.items())]
+        return {'traceEvents': metadata + list(self._events), 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.export(), f, default=str)
+
+
+TRACER = Tracer()
+
+span = TRACER.span
+
+
+class SamplingProfiler:
+    """
+    samples the stack of every thread, the result is in the folded format of flamegraph.pl and speedscope
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, interval=0.005):
+        """
+        :param interval: seconds between two samples
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def profile(self, seconds) -> collections.Counter:
+        """
+        sample for seconds, blocks the calling thread
+        :raise ValueError: a profile is running already
+        :return: folded stack -> samples
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ValueError('A profile is running already')
+        try:
+            return self._sample(seconds)
+        finally:
+            self._lock.release()
+
+    def profile_to_file(self, seconds, path):
+        """
+        profile in a background thread and write the folded stacks to path
+        """
+
+        def run():
+            try:
+                stacks = self.profile(seconds)
+            except ValueError as e:
+                self.logger.warning(e)
+                return
+            with open(path, 'w') as f:
+                f.write(self.fold(stacks))
+            self.logger.info(f'Profile of {seconds}s written to {path}')
+
+        threading.Thread(target=run, name='profiler', daemon=True).start()
+
+    @staticmethod
+    def fold(stacks: collections.Counter) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    def _sample(self, seconds):
+        stacks = collections.Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(calls))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+
+PROFILER = SamplingProfiler()
+
+
+def install_signal_handler(seconds=30, directory='.', signum=signal.SIGUSR1):
+    """
+    on signum, profile for seconds into <directory>/profile-<time>.folded, and dump the spans recorded so far
+    into <directory>/trace-<time>.json if tracing is enabled, must be called from the main thread
+    """
+
+    def handler(signum, frame):
+        os.makedirs(directory, exist_ok=True)
+        now = time.strftime('%Y%m%d-%H%M%S')
+        if TRACER.enabled:
+            TRACER.dump(os.path.join(directory, f'trace-{now}.json'))
+        PROFILER.profile_to_file(seconds, os.path.join(directory, f'profile-{now}.folded'))
+
+    signal.signal(signum, handler)
+
+
+def debug_routes(max_seconds=300) -> dict:
+    """
+    routes of a MetricsServer:
+    /debug/trace returns the spans as Chrome trace JSON, ?enable=1 or 0 switches tracing on or off,
+    /debug/profile?seconds=N profiles for N seconds and returns the folded stacks
+    """
+
+    def trace(query):
+        if query.get('enable') == '1':
+            TRACER.enable()
+        elif query.get('enable') == '0':
+            TRACER.disable()
+        return 'application/json', json.dumps(TRACER.export(), default=str).encode()
+
+    def profile(query):
+        seconds = float(query.get('seconds', 10))
+        if not 0 < seconds <= max_seconds:
+            raise ValueError(f'seconds must be in (0, {max_seconds}]')
+        return 'text/plain; charset=utf-8', SamplingProfiler.fold(PROFILER.profile(seconds)).encode()
+
+    return {
+        '/debug/trace':   trace,
+        '/debug/profile': profile
+    }
@@ -1,16 +1,64 @@
+import functools
+import os
 import re
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
 
-EMOJI_DICT = {}
-with open('webwx/emoji.txt') as f:
-    for line in f:
-        arr = line.strip().split(',')
-        EMOJI_DICT[arr[0]] = arr[1]
+EMOJI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emoji.txt')
+EMOJI_PATTERN = re.compile(r'<span class="emoji emoji([a-zA-Z0-9]+)"></span>')
+
+_emoji_dict = None
+
+
+def emoji_dict():
+    """
+    emoji code -> emoji, loaded on first use
+    """
+    global _emoji_dict
+    if _emoji_dict is None:
+        dic = {}
+        with open(EMOJI_FILE, encoding='utf-8') as f:
+            for line in f:
+                arr = line.strip().split(',')
+                dic[arr[0]] = arr[1]
+        _emoji_dict = dic
+    return _emoji_dict
+
+
+def _replace_func(match):
+    return emoji_dict().get(match.group(1), '')
 
 
 def replace_emoji(text):
-    def replace_func(match):
-        if match:
-            return EMOJI_DICT.get(match.group(1), '')
+    # most texts have no emoji at all
+    if 'emoji' not in text:
+        return text
+    return EMOJI_PATTERN.sub(_replace_func, text)
+
+
+@functools.lru_cache(maxsize=65536)
+def replace_emoji_in_name(name):
+    """
+    memoized replace_emoji for nicknames, remark names and display names,
+    which are unescaped again on every contact update
+    """
+    return replace_emoji(name)
+
+
+class NullContext:
+    """
+    no-op context manager, contextlib.nullcontext needs python 3.7
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
 
-    replaced_text = re.sub(r'<span class="emoji emoji([a-zA-Z0-9]+)"></span>', replace_func, text)
-    return replaced_text
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    http.server.ThreadingHTTPServer, new in python 3.7
+    """
+    daemon_threads = True
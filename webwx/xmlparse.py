@@ -0,0 +1,113 @@
+from typing import Dict, Iterable
+from xml.parsers import expat
+
+
+class _Done(Exception):
+    pass
+
+
+def msg_xml(content):
+    """
+    the <msg> document of an app, emotion or card message, without the sender prefix of chatroom messages
+    :return: '' if the content has none
+    """
+    index = content.find('<msg>')
+    return content[index:] if index != -1 else ''
+
+
+def _parser():
+    parser = expat.ParserCreate()
+    # character data of an element in one callback
+    parser.buffer_text = True
+    return parser
+
+
+def _parse(parser, xml):
+    try:
+        parser.Parse(xml, True)
+    except _Done:
+        pass
+    except expat.ExpatError:
+        # the values found before the error are kept
+        pass
+
+
+def _split(path):
+    tags = path.split('/')
+    return tags[-1], tags[:-1]
+
+
+def _matches(stack, parents):
+    """
+    whether the element on top of the stack is preceded by the parents
+    """
+    return len(stack) > len(parents) and stack[-1 - len(parents):-1] == parents
+
+
+def find_texts(xml, paths: Iterable[str]) -> Dict[str, str]:
+    """
+    text of the first element matching each path, without building a tree, parsing stops once all are found
+    :param paths: tag names, optionally preceded by their parents, e.g. 'appmsg/title'
+    :return: path -> text, paths not found or after a parse error are missing
+    """
+    # tag -> (parents, path)
+    wanted = {}
+    for path in paths:
+        tag, parents = _split(path)
+        wanted.setdefault(tag, []).append((parents, path))
+    remaining = sum(len(value) for value in wanted.values())
+    found = {}
+    stack = []
+    # (depth, path, text parts) of the matching elements open
+    capturing = []
+
+    def start(name, attrs):
+        stack.append(name)
+        for parents, path in wanted.get(name, ()):
+            if path not in found and _matches(stack, parents):
+                capturing.append((len(stack), path, []))
+
+    def char_data(data):
+        for depth, _, parts in capturing:
+            if depth == len(stack):
+                parts.append(data)
+
+    def end(name):
+        nonlocal remaining
+        while capturing and capturing[-1][0] == len(stack):
+            _, path, parts = capturing.pop()
+            if path not in found:
+                found[path] = ''.join(parts)
+                remaining -= 1
+        stack.pop()
+        if not remaining:
+            raise _Done
+
+    parser = _parser()
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = char_data
+    parser.EndElementHandler = end
+    _parse(parser, xml)
+    return found
+
+
+def find_attrs(xml, path) -> Dict[str, str]:
+    """
+    attributes of the first element matching the path, parsing stops at its start tag
+    :return: empty if no element matches
+    """
+    tag, parents = _split(path)
+    found = {}
+    stack = []
+
+    def start(name, attrs):
+        stack.append(name)
+        if name == tag and _matches(stack, parents):
+            found.update(attrs)
+            raise _Done
+
+    parser = _parser()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = lambda name: stack.pop()
+    _parse(parser, xml)
+    return found